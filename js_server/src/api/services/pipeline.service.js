@@ -2,7 +2,6 @@ import axios from 'axios';
 import fs from 'fs';
 import { promises as fsPromises } from 'fs';
 import path from 'path';
-import FormData from 'form-data'; // Make sure you have this import
 import AppError from '../../utils/AppError.js';
 import { PYTHON_API_BASE_URL } from '../../config/index.js';
 
@@ -10,36 +9,135 @@ const UPLOAD_FOLDER = path.resolve(process.cwd(), 'uploads');
 const MAPPED_FILE_PATH = path.join(UPLOAD_FOLDER, 'mapped_data.xlsx');
 const RAW_DATA_PATH = path.join(UPLOAD_FOLDER, 'raw_data.xlsx');
 const MASTER_FILE_PATH = path.join(UPLOAD_FOLDER, 'master_file.xlsx'); // Define path to master file
+const JOB_POLL_INTERVAL_MS = 1000;
+const JOB_TIMEOUT_MS = 15 * 60 * 1000;
+const UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024;
+const UPLOAD_CHUNK_ATTEMPTS = 3;
+const RUN_QUEUE_ATTEMPTS = 5;
+const MAX_RETRY_AFTER_MS = 60 * 1000;
+
+// Token of the Python-side workspace holding this server's current uploads/results
+let pythonWorkspaceToken = null;
+
+// ETag of the mapped file last saved to MAPPED_FILE_PATH, for conditional re-downloads
+let mappedFileEtag = null;
+
+const workspaceHeaders = () => (pythonWorkspaceToken ? { 'X-Workspace-Token': pythonWorkspaceToken } : {});
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
 
 /**
- * Helper function to upload a file to the Python server
+ * Polls the Python server until a queued pipeline job has finished.
+ * Resolves with the job's result dict, throws if the job failed.
  */
-const uploadFileToPython = async (filePath, fieldName, endpoint) => {
+const waitForPipelineJob = async (jobId) => {
+    const jobUrl = `${PYTHON_API_BASE_URL}/jobs/${jobId}`;
+    const deadline = Date.now() + JOB_TIMEOUT_MS;
+
+    while (Date.now() < deadline) {
+        const { data: job } = await axios.get(jobUrl, { headers: workspaceHeaders() });
+        if (job.status === 'success') {
+            return job.result;
+        }
+        if (job.status === 'error') {
+            const errorMessage = job.result?.message || 'An unknown error occurred in the Python pipeline.';
+            throw new AppError(errorMessage, 500);
+        }
+        const position = job.queue_position ? `, position ${job.queue_position} in queue` : '';
+        console.log(`Pipeline job ${jobId}: ${job.status} (${job.progress}% - ${job.stage}${position})`);
+        await sleep(JOB_POLL_INTERVAL_MS);
+    }
+    throw new AppError('Timed out waiting for the Python pipeline to finish.', 504);
+};
+
+/**
+ * Queues a pipeline run. While the Python server is saturated (429 for a
+ * workspace that already has a run, 503 for a full queue) waits for its
+ * Retry-After and tries again, up to RUN_QUEUE_ATTEMPTS times.
+ */
+const queuePipelineRun = async (url) => {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await axios.post(url, null, { headers: workspaceHeaders(), params: { format: 'csv' } });
+        } catch (error) {
+            const status = error.response?.status;
+            if (attempt >= RUN_QUEUE_ATTEMPTS || (status !== 429 && status !== 503)) {
+                throw error;
+            }
+            const retryAfter = Number(error.response.headers['retry-after']) || 1;
+            console.log(`Python server busy (${status}), retrying in ${retryAfter}s...`);
+            await sleep(Math.min(retryAfter * 1000, MAX_RETRY_AFTER_MS));
+        }
+    }
+};
+
+/**
+ * Sends one chunk of a resumable upload. If the request fails without a
+ * response (e.g. a timeout), asks the Python server how much it received
+ * and resumes from there instead of resending the whole file.
+ */
+const sendUploadChunk = async (uploadUrl, filePath, offset, end) => {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const { data } = await axios.patch(uploadUrl, fs.createReadStream(filePath, { start: offset, end: end - 1 }), {
+                headers: {
+                    'Content-Type': 'application/offset+octet-stream',
+                    'Content-Length': end - offset,
+                    'Upload-Offset': offset,
+                    ...workspaceHeaders(),
+                },
+                maxContentLength: Infinity,
+                maxBodyLength: Infinity,
+            });
+            return data.offset;
+        } catch (error) {
+            if (error.response?.status === 409) {
+                return error.response.data.offset;
+            }
+            if (error.response || attempt >= UPLOAD_CHUNK_ATTEMPTS) {
+                throw error;
+            }
+            console.warn(`Upload chunk at offset ${offset} failed (${error.message}), resuming...`);
+            const { data } = await axios.get(uploadUrl, { headers: workspaceHeaders() });
+            if (data.offset >= end) {
+                return data.offset;
+            }
+            offset = data.offset;
+        }
+    }
+};
+
+/**
+ * Helper function to upload a file to the Python server. The file is sent
+ * as a resumable upload in UPLOAD_CHUNK_BYTES pieces.
+ */
+const uploadFileToPython = async (filePath, kind) => {
     try {
         // Check if file exists
-        await fsPromises.access(filePath);
-        
-        // Create form data
-        const form = new FormData();
-        form.append(fieldName, fs.createReadStream(filePath));
-        
-        const uploadUrl = `${PYTHON_API_BASE_URL}${endpoint}`;
-        console.log(`Uploading file (${fieldName}) to Python server: ${uploadUrl}`);
-        
-        // Upload to Python server
-        const response = await axios.post(uploadUrl, form, {
-            headers: {
-                ...form.getHeaders(),
-            },
-            maxContentLength: Infinity,
-            maxBodyLength: Infinity,
-        });
-        
-        console.log(`File (${fieldName}) uploaded successfully to Python server:`, response.data);
+        const { size } = await fsPromises.stat(filePath);
+        const filename = path.basename(filePath);
+
+        console.log(`Uploading file (${kind}) to Python server: ${PYTHON_API_BASE_URL}/uploads`);
+        const { data: session } = await axios.post(
+            `${PYTHON_API_BASE_URL}/uploads`,
+            null,
+            { params: { kind, filename, length: size }, headers: workspaceHeaders() }
+        );
+        // The first upload without a token creates the workspace
+        pythonWorkspaceToken = session.workspace || pythonWorkspaceToken;
+
+        const uploadUrl = `${PYTHON_API_BASE_URL}${session.upload_url}`;
+        let offset = 0;
+        while (offset < size) {
+            offset = await sendUploadChunk(uploadUrl, filePath, offset, Math.min(offset + UPLOAD_CHUNK_BYTES, size));
+        }
+
+        const response = await axios.post(`${uploadUrl}/complete`, null, { headers: workspaceHeaders() });
+        console.log(`File (${kind}) uploaded successfully to Python server:`, response.data);
         return response.data;
         
     } catch (error) {
-        console.error(`Error uploading file (${fieldName}) to Python server:`, error.message);
+        console.error(`Error uploading file (${kind}) to Python server:`, error.message);
         
         if (error.code === 'ENOENT') {
             throw new AppError(`Required file not found on JS server: ${path.basename(filePath)}`, 404);
@@ -77,28 +175,31 @@ export const processData = async () => {
         }
     }
 
-    // Step 2: Upload raw data file to Python server
+    // Step 2: Upload raw data file to Python server (into a fresh workspace)
     console.log('Step 2: Uploading raw data file...');
-    // Note: Python's field name is 'raw_data' and endpoint is '/upload_raw'
-    await uploadFileToPython(RAW_DATA_PATH, 'raw_data', '/upload_raw');
+    pythonWorkspaceToken = null;
+    await uploadFileToPython(RAW_DATA_PATH, 'raw');
     
     // Step 3: Upload master file to Python server
     console.log('Step 3: Uploading master file...');
-    // Note: Python's field name is 'master_file' and endpoint is '/upload_master'
-    await uploadFileToPython(MASTER_FILE_PATH, 'master_file', '/upload_master');
+    await uploadFileToPython(MASTER_FILE_PATH, 'master');
 
-    // Step 4: Trigger pipeline execution
+    // Step 4: Queue pipeline execution and wait for the job to finish
     console.log('Step 4: Triggering pipeline execution...');
-    const response = await axios.post(RUN_PIPELINE_URL);
+    const response = await queuePipelineRun(RUN_PIPELINE_URL);
     console.log('Python server responded:', response.data);
 
-    if (response.data && response.data.status === 'success') {
-      return `Pipeline executed successfully by Python server. ${response.data.message}`;
-    } else {
+    if (!response.data || !response.data.job_id) {
       const errorMessage = response.data?.message || 'An unknown error occurred in the Python pipeline.';
       throw new AppError(errorMessage, response.status || 500);
     }
 
+    // Unchanged inputs come back finished, straight from the result cache
+    const result = response.data.status === 'success' && response.data.result
+      ? response.data.result
+      : await waitForPipelineJob(response.data.job_id);
+    return `Pipeline executed successfully by Python server. ${result.message}`;
+
   } catch (error) {
     console.error('Error triggering the Python pipeline:', error.message);
     if (error instanceof AppError) {
@@ -130,20 +231,43 @@ export const getMappedFile = async () => {
             await fsPromises.mkdir(UPLOAD_FOLDER, { recursive: true });
         }
 
+        // Revalidate the copy we already have instead of downloading it again
+        const conditionalHeaders = {};
+        if (mappedFileEtag) {
+            try {
+                await fsPromises.access(MAPPED_FILE_PATH);
+                conditionalHeaders['If-None-Match'] = mappedFileEtag;
+            } catch {
+                mappedFileEtag = null;
+            }
+        }
+
+        // The run writes csv; the workbook is built from it on the first download
         const response = await axios.get(DOWNLOAD_URL, {
             responseType: 'stream',
+            params: { format: 'xlsx' },
+            headers: { ...workspaceHeaders(), ...conditionalHeaders },
+            validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
         });
 
+        if (response.status === 304) {
+            response.data.resume();
+            console.log(`Mapped file unchanged, using local copy: ${MAPPED_FILE_PATH}`);
+            return { filePath: MAPPED_FILE_PATH, fileName: 'mapped_data.xlsx' };
+        }
+
         const writer = fs.createWriteStream(MAPPED_FILE_PATH);
         response.data.pipe(writer);
 
         return new Promise((resolve, reject) => {
             writer.on('finish', () => {
                 console.log(`Mapped file saved successfully to: ${MAPPED_FILE_PATH}`);
+                mappedFileEtag = response.headers.etag || null;
                 resolve({ filePath: MAPPED_FILE_PATH, fileName: 'mapped_data.xlsx' });
             });
             writer.on('error', (err) => {
                 console.error('Error writing downloaded file:', err);
+                mappedFileEtag = null;
                 fsPromises.unlink(MAPPED_FILE_PATH).catch(unlinkErr => console.error('Error cleaning up failed download:', unlinkErr));
                 reject(new AppError('Failed to save the downloaded mapped file.', 500));
             });
@@ -176,10 +300,16 @@ export const getMappedFile = async () => {
 export const resetPythonFiles = async () => {
     const resetUrl = `${PYTHON_API_BASE_URL}/reset`;
     
+    if (!pythonWorkspaceToken) {
+        return 'No Python workspace to reset.';
+    }
+
     try {
         console.log(`Requesting file reset from: ${resetUrl}`);
-        const response = await axios.post(resetUrl);
+        const response = await axios.post(resetUrl, null, { headers: workspaceHeaders() });
         console.log('Python reset response:', response.data);
+        pythonWorkspaceToken = null;
+        mappedFileEtag = null;
         
         if (response.data && response.data.status === 'success') {
             return response.data.message;
@@ -1,7 +1,12 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify
+from downloads import send_download
 import os
+import shutil
 from werkzeug.utils import secure_filename
-from config import DATA_FOLDER, RAW_DATA_PATH, MASTER_FILE_PATH, MAPPED_FILE_PATH, MAX_FILE_SIZE
+from config import MAX_FILE_SIZE
+from pipeline.result_cache import forget_workspace_results
+from uploads import UploadTooLarge, stream_to_path
+from workspaces import create_workspace, open_workspace, request_workspace_token, workspace_paths
 
 files_bp = Blueprint("files", __name__)
 
@@ -10,11 +15,31 @@ ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def workspace_not_found():
+    return jsonify({
+        "status": "error",
+        "message": "Missing, unknown or expired workspace token. Upload a file first to get one."
+    }), 404
+
+def resolve_workspace():
+    """Token and folder of the workspace named in the request, or (None, None)"""
+    token = request_workspace_token(request)
+    folder = open_workspace(token) if token else None
+    return (token, folder) if folder else (None, None)
+
 @files_bp.route("/reset", methods=["POST"])
 def reset_files():
-    """Delete raw and master files"""
+    """
+    Delete raw and master files (and the saved incremental state, batch
+    inputs and the cached results of this workspace's runs)
+    """
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+    paths = workspace_paths(token)
+
     deleted_files = []
-    for file_path in [RAW_DATA_PATH, MASTER_FILE_PATH]:
+    for file_path in [paths["raw"], paths["master"], paths["incremental_state"]]:
         if os.path.exists(file_path):
             try:
                 os.remove(file_path)
@@ -24,108 +49,162 @@ def reset_files():
                     "status": "error", 
                     "message": f"Failed to delete {os.path.basename(file_path)}: {str(e)}"
                 }), 500
+    if os.path.isdir(paths["batch"]):
+        shutil.rmtree(paths["batch"], ignore_errors=True)
+        deleted_files.append(os.path.basename(paths["batch"]))
     
     return jsonify({
         "status": "success", 
         "message": "Files deleted successfully",
-        "deleted_files": deleted_files
+        "workspace": token,
+        "deleted_files": deleted_files,
+        "cached_results_removed": forget_workspace_results(folder)
     })
 
-@files_bp.route("/upload_raw", methods=["POST"])
-def upload_raw():
-    """Receive raw data file from JS server"""
-    if "raw_data" not in request.files:
-        return jsonify({"status": "error", "message": "No file provided"}), 400
-    
-    file = request.files["raw_data"]
-    
-    if file.filename == '':
-        return jsonify({"status": "error", "message": "No file selected"}), 400
-    
-    if not allowed_file(file.filename):
-        return jsonify({
-            "status": "error", 
-            "message": "Invalid file type. Only .xlsx and .xls files are allowed"
-        }), 400
-    
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
-    
-    if file_size > MAX_FILE_SIZE:
-        return jsonify({
-            "status": "error", 
-            "message": f"File too large. Maximum size is {MAX_FILE_SIZE / (1024*1024)}MB"
-        }), 400
-    
+def upload_workspace():
+    """
+    (token, error response) for an upload: the workspace named in the
+    request, or a new one when no token was sent.
+    """
+    if request_workspace_token(request):
+        token, folder = resolve_workspace()
+        if token is None:
+            return None, workspace_not_found()
+        return token, None
+    return create_workspace(), None
+
+def upload_response(token, saved_path, label, file_size, content_hash, cache_parsed_master=False):
+    """Success response shared by every upload path"""
+    response = {
+        "status": "success", 
+        "message": f"{label} uploaded successfully",
+        "workspace": token,
+        "saved_path": saved_path,
+        "file_size": file_size,
+        "content_hash": content_hash
+    }
+    if cache_parsed_master:
+        # Parse once now so pipeline runs load the master from the cache.
+        # Imported here: the web layer starts without the pipeline engine
+        from pipeline.master_cache import cache_master
+        _, hit = cache_master(saved_path, content_hash)
+        response["cache"] = "hit" if hit else "miss"
+        if hit:
+            response["message"] = f"{label} uploaded successfully (cache hit)"
+    return jsonify(response)
+
+def file_too_large(status=400):
+    return jsonify({
+        "status": "error", 
+        "message": f"File too large. Maximum size is {MAX_FILE_SIZE / (1024*1024)}MB"
+    }), status
+
+def invalid_file_type():
+    return jsonify({
+        "status": "error", 
+        "message": "Invalid file type. Only .xlsx and .xls files are allowed"
+    }), 400
+
+def save_streamed_upload(path_key, label, cache_parsed_master=False):
+    """
+    Upload sent as the raw request body (not multipart), with the file name
+    in ?filename= or the X-Filename header. The body is streamed straight
+    into the workspace, size-checked and hashed on the way.
+    """
+    filename = request.args.get("filename") or request.headers.get("X-Filename", "")
+    if not filename:
+        return jsonify({"status": "error", "message": "No file name provided"}), 400
+    if not allowed_file(filename):
+        return invalid_file_type()
+    if request.content_length is not None and request.content_length > MAX_FILE_SIZE:
+        return file_too_large()
+
+    token, error = upload_workspace()
+    if error:
+        return error
+    saved_path = workspace_paths(token)[path_key]
+
     try:
-        file.save(RAW_DATA_PATH)
-        return jsonify({
-            "status": "success", 
-            "message": "Raw data file uploaded successfully",
-            "saved_path": RAW_DATA_PATH,
-            "file_size": file_size
-        })
+        file_size, content_hash = stream_to_path(request.stream, saved_path)
+        return upload_response(token, saved_path, label, file_size, content_hash, cache_parsed_master)
+    except UploadTooLarge:
+        return file_too_large()
     except Exception as e:
         return jsonify({
             "status": "error", 
             "message": f"Failed to save file: {str(e)}"
         }), 500
 
-@files_bp.route("/upload_master", methods=["POST"])
-def upload_master():
-    """Receive master file from JS server"""
-    if "master_file" not in request.files:
+def save_upload(field_name, path_key, label, cache_parsed_master=False):
+    """
+    Shared body of /upload_raw and /upload_master. Uploads without a
+    workspace token start a new workspace; its token is returned.
+    Re-uploading a file identical to the one already in the workspace is
+    a no-op.
+
+    A multipart file part is not buffered: the form parser writes it to a
+    temp file next to the workspaces as it arrives, size-checked and hashed
+    (see uploads.UploadPart), and it is renamed into the workspace.
+    """
+    if request.mimetype != "multipart/form-data":
+        return save_streamed_upload(path_key, label, cache_parsed_master)
+
+    try:
+        files = request.files
+    except UploadTooLarge:
+        return file_too_large()
+
+    if field_name not in files:
         return jsonify({"status": "error", "message": "No file provided"}), 400
     
-    file = request.files["master_file"]
+    file = files[field_name]
     
     if file.filename == '':
         return jsonify({"status": "error", "message": "No file selected"}), 400
     
     if not allowed_file(file.filename):
-        return jsonify({
-            "status": "error", 
-            "message": "Invalid file type. Only .xlsx and .xls files are allowed"
-        }), 400
-    
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
-    
-    if file_size > MAX_FILE_SIZE:
-        return jsonify({
-            "status": "error", 
-            "message": f"File too large. Maximum size is {MAX_FILE_SIZE / (1024*1024)}MB"
-        }), 400
+        return invalid_file_type()
+
+    token, error = upload_workspace()
+    if error:
+        return error
+    saved_path = workspace_paths(token)[path_key]
     
     try:
-        file.save(MASTER_FILE_PATH)
-        return jsonify({
-            "status": "success", 
-            "message": "Master file uploaded successfully",
-            "saved_path": MASTER_FILE_PATH,
-            "file_size": file_size
-        })
+        part = file.stream
+        part.place(saved_path)
+        return upload_response(token, saved_path, label, part.size, part.sha256, cache_parsed_master)
     except Exception as e:
         return jsonify({
             "status": "error", 
             "message": f"Failed to save file: {str(e)}"
         }), 500
 
+@files_bp.route("/upload_raw", methods=["POST"])
+def upload_raw():
+    """Receive raw data file from JS server (multipart field or raw body)"""
+    return save_upload("raw_data", "raw", "Raw data file")
+
+@files_bp.route("/upload_master", methods=["POST"])
+def upload_master():
+    """Receive master file from JS server (multipart field or raw body)"""
+    return save_upload("master_file", "master", "Master file", cache_parsed_master=True)
+
 @files_bp.route("/list_files", methods=["GET"])
 def list_files():
-    """List all files in data folder"""
+    """List all files in the workspace"""
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+
     try:
-        files = os.listdir(DATA_FOLDER)
+        files = os.listdir(folder)
         file_info = {}
         for f in files:
-            file_path = os.path.join(DATA_FOLDER, f)
-            if os.path.isfile(file_path):
+            file_path = os.path.join(folder, f)
+            if os.path.isfile(file_path) and not f.endswith(".tmp") and not f.startswith("."):
                 file_info[f] = {
-                    "download_url": f"/download/{f}",
+                    "download_url": f"/download/{f}?workspace={token}",
                     "size": os.path.getsize(file_path)
                 }
         return jsonify(file_info)
@@ -138,17 +217,21 @@ def list_files():
 @files_bp.route("/download/<filename>", methods=["GET"])
 def download_file(filename):
     """Download a specific file"""
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+
     # Secure the filename to prevent directory traversal attacks
     filename = secure_filename(filename)
-    path = os.path.join(DATA_FOLDER, filename)
+    path = os.path.join(folder, filename)
     
     if not os.path.exists(path):
         return jsonify({"status": "error", "message": "File not found"}), 404
     
     try:
-        return send_file(path, as_attachment=True)
+        return send_download(path)
     except Exception as e:
         return jsonify({
             "status": "error", 
             "message": f"Failed to send file: {str(e)}"
-        }), 500
\ No newline at end of file
+        }), 500
@@ -0,0 +1,42 @@
+from flask import Blueprint, jsonify
+import os
+from downloads import send_download
+from pipeline.jobs import get_job, scheduler_status, JOB_SUCCESS, JOB_ERROR
+
+jobs_bp = Blueprint("jobs", __name__)
+
+@jobs_bp.route("/jobs", methods=["GET"])
+def jobs_status():
+    """Scheduler load: running and queued runs, memory in use, wait times and Retry-After"""
+    return jsonify({"status": "success", "scheduler": scheduler_status()})
+
+@jobs_bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Status, progress, timings and result dict of a pipeline job"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify(job)
+
+@jobs_bp.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    """Download the mapped file produced by a finished job"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+
+    if job["status"] == JOB_ERROR:
+        message = (job["result"] or {}).get("message", "Pipeline job failed")
+        return jsonify({"status": "error", "message": message}), 500
+
+    if job["status"] != JOB_SUCCESS:
+        return jsonify({
+            "status": "error",
+            "message": f"Job is still {job['status']} ({job['progress']}%). Try again later."
+        }), 409
+
+    output_file = job["output_file"]
+    if not output_file or not os.path.exists(output_file):
+        return jsonify({"status": "error", "message": "Mapped file for this job no longer exists"}), 410
+
+    return send_download(output_file)
@@ -0,0 +1,9 @@
+from flask import Blueprint, Response
+from metrics import render_prometheus
+
+metrics_bp = Blueprint("metrics", __name__)
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """Pipeline and request metrics in Prometheus text format."""
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
@@ -1,40 +1,159 @@
-from flask import Blueprint, request, jsonify, send_file
-from pipeline.pp import run_pipeline_api
-from config import RAW_DATA_PATH, MASTER_FILE_PATH, DATA_FOLDER
+from flask import Blueprint, Response, request, jsonify
+from config import DEFAULT_OUTPUT_FORMAT, MAPPED_QUERY_DEFAULT_LIMIT, MAPPED_QUERY_MAX_LIMIT
+from downloads import content_hash, prepare_download, send_download
+from ledger import apply_run_rows
+from metrics import record_result_cache, result_cache_counts
+from pipeline.jobs import (
+    SchedulerBusy, check_admission, record_cached_job, submit_batch_pipeline_job, submit_pipeline_job,
+)
+from pipeline.result_cache import restore_result, result_key
+from api.files import allowed_file, invalid_file_type, resolve_workspace, workspace_not_found
+from workspaces import create_workspace, request_workspace_token, save_atomically, workspace_paths
+from werkzeug.utils import secure_filename
+import json
 import os
+import shutil
+import sqlite3
 
 pipeline_bp = Blueprint("pipeline", __name__)
 
-# This is the file we need to delete
-MAPPED_FILE_PATH = os.path.join(DATA_FOLDER, "mapped.xlsx")
+# Columns GET /mapped can filter on
+MAPPED_FILTER_COLUMNS = ("FEES", "TYPE", "sem", "br_code")
+
+def scheduler_busy(error):
+    """429/503 with Retry-After, so the caller backs off instead of piling on"""
+    response = jsonify({"status": "error", "message": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, error.status
+
+def lookup_cached_run(token, paths, input_paths, **options):
+    """
+    (result key, cache block, response) for a run over input_paths with the
+    given output options. On a hit the cached outputs are put back into the
+    workspace and response is the finished run; on a miss it is None and
+    the job should be queued with the key.
+    """
+    key = result_key([content_hash(path) for path in input_paths], **options)
+    result = restore_result(key, paths["folder"])
+    record_result_cache(result is not None)
+    cache = {"status": "hit" if result else "miss", **result_cache_counts()}
+    if result is None:
+        return key, cache, None
+
+    for field in ("output_file", "unmapped_file"):
+        if result.get(field):
+            prepare_download(result[field])
+    if os.path.exists(paths["ledger_rows"]):
+        # A re-run re-applies its rows; they stamp the time of the cached run,
+        # so they don't overwrite what a newer run has put in the ledger
+        try:
+            apply_run_rows(paths["ledger_rows"])
+        except sqlite3.Error as e:
+            print(f"Warning: Could not update the fee ledger: {e}")
+    job_id = record_cached_job(input_paths[0], input_paths[-1], paths["folder"], result)
+    print(f"Pipeline inputs unchanged; served the cached result (job {job_id})")
+    return key, cache, (jsonify({
+        "status": "success",
+        "message": f"{result.get('message', 'Pipeline executed successfully')} (cached result)",
+        "workspace": token,
+        "format": options["format"],
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+        "result": result,
+        "cache": cache
+    }), 200)
+
+def save_batch_files(file_storages, folder):
+    """
+    Saves the posted files of a batch run in order (the order decides ties
+    between transactions of the same date) and returns their paths.
+    """
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    paths = []
+    for position, file_storage in enumerate(file_storages):
+        path = os.path.join(folder, f"{position:03d}_{secure_filename(file_storage.filename)}")
+        save_atomically(file_storage, path)
+        paths.append(path)
+    return paths
 
 @pipeline_bp.route("/run_pipeline", methods=["POST"])
 def run_pipeline():
-    raw_path = RAW_DATA_PATH
-    master_path = MASTER_FILE_PATH
+    # The pipeline engine is loaded on first use (unless gunicorn preloaded it)
+    from pipeline.writer import OUTPUT_FORMATS, format_available, output_path
+
+    # format: csv (default), parquet, ndjson or xlsx
+    output_format = request.values.get("format", DEFAULT_OUTPUT_FORMAT).lower()
+    if not format_available(output_format):
+        return jsonify({
+            "status": "error",
+            "message": f"Unsupported output format: {output_format}. Available: "
+                       + ", ".join(fmt for fmt in OUTPUT_FORMATS if format_available(fmt))
+        }), 400
+
+    # Several raw_data / master_file parts, or sheets=all, make a batch run
+    raw_uploads = request.files.getlist("raw_data")
+    master_uploads = request.files.getlist("master_file")
+    sheets = request.values.get("sheets", "first").lower()
+    incremental = request.values.get("incremental", "").lower() in ("1", "true", "yes")
+    if sheets not in ("first", "all"):
+        return jsonify({"status": "error", "message": "sheets must be 'first' or 'all'"}), 400
+    batch = len(raw_uploads) > 1 or len(master_uploads) > 1 or sheets == "all"
+    if batch:
+        if incremental:
+            return jsonify({"status": "error", "message": "Incremental runs take a single raw file"}), 400
+        if not all(allowed_file(f.filename or "") for f in raw_uploads + master_uploads):
+            return invalid_file_type()
+
+    # Files may also be posted straight to this route; without a token
+    # that starts a new workspace
+    if request_workspace_token(request) or not request.files:
+        token, folder = resolve_workspace()
+        if token is None:
+            return workspace_not_found()
+    else:
+        token = create_workspace()
+
+    paths = workspace_paths(token)
+    # Refuse before touching the workspace's files, which a running job may be reading
+    try:
+        check_admission(paths["folder"])
+    except SchedulerBusy as e:
+        return scheduler_busy(e)
+
+    raw_path = paths["raw"]
+    master_path = paths["master"]
+    old_outputs = [paths["mapped_result"], paths["ledger_rows"], paths["snapshot"]] + [
+        output_path(paths["folder"], fmt, part) for fmt in OUTPUT_FORMATS for part in ("mapped", "unmapped")
+    ]
 
     # --- THIS IS THE CRITICAL FIX ---
-    # Step 1: Delete any old mapped file *before* running the pipeline.
+    # Step 1: Delete any old mapped files *before* running the pipeline.
     # This prevents sending a stale file if the pipeline fails.
-    try:
-        if os.path.exists(MAPPED_FILE_PATH):
-            os.remove(MAPPED_FILE_PATH)
-            print(f"Removed old mapped file: {MAPPED_FILE_PATH}")
-        else:
-            print("No old mapped file to remove.")
-    except Exception as e:
-        print(f"Warning: Could not delete old mapped file: {e}")
+    removed = 0
+    for old_path in old_outputs:
+        try:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+                removed += 1
+                print(f"Removed old mapped file: {old_path}")
+        except Exception as e:
+            print(f"Warning: Could not delete old mapped file: {e}")
+    if not removed:
+        print("No old mapped file to remove.")
     # --- END OF FIX ---
 
 
+    if batch:
+        return run_batch_pipeline(token, paths, raw_uploads, master_uploads, sheets == "all", output_format)
+
     # Step 2: Check for files (which should have been uploaded by JS server)
     if "raw_data" in request.files:
-        request.files["raw_data"].save(RAW_DATA_PATH)
-        raw_path = RAW_DATA_PATH
+        save_atomically(request.files["raw_data"], raw_path)
 
     if "master_file" in request.files:
-        request.files["master_file"].save(MASTER_FILE_PATH)
-        master_path = MASTER_FILE_PATH
+        save_atomically(request.files["master_file"], master_path)
 
     if not os.path.exists(raw_path) or not os.path.exists(master_path):
         return jsonify({
@@ -42,17 +161,175 @@ def run_pipeline():
             "message": "Missing input files. Upload via /upload_raw and /upload_master first."
         }), 400
 
-    # Step 3: Run the pipeline
-    result = run_pipeline_api(raw_path, master_path)
-    return jsonify(result)
+    # Step 3: Unchanged inputs are answered from the result cache. Incremental
+    # runs always run, since each one advances the workspace's saved state
+    key, cache = None, None
+    if not incremental:
+        key, cache, cached_response = lookup_cached_run(token, paths, [raw_path, master_path], format=output_format)
+        if cached_response:
+            return cached_response
+
+    # Step 4: Queue the pipeline; the client polls /jobs/<job_id> for the outcome.
+    # incremental=1 only applies raw rows the previous incremental run hasn't seen
+    try:
+        job_id = submit_pipeline_job(
+            raw_path, master_path, incremental=incremental, output_format=output_format, result_key=key
+        )
+    except SchedulerBusy as e:
+        return scheduler_busy(e)
+    return jsonify({
+        "status": "queued",
+        "message": "Pipeline job queued",
+        "workspace": token,
+        "incremental": incremental,
+        "format": output_format,
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+        "cache": cache
+    }), 202
+
+def run_batch_pipeline(token, paths, raw_uploads, master_uploads, all_sheets, output_format):
+    """
+    Queues a batch run. Posted files replace the previous batch's; without
+    posted raw (or master) files the workspace's uploaded one is used.
+    """
+    batch_folder = paths["batch"]
+    if raw_uploads:
+        raw_paths = save_batch_files(raw_uploads, os.path.join(batch_folder, "raw"))
+    else:
+        raw_paths = [paths["raw"]]
+    if master_uploads:
+        master_paths = save_batch_files(master_uploads, os.path.join(batch_folder, "master"))
+    else:
+        master_paths = [paths["master"]]
+
+    if not all(os.path.exists(path) for path in raw_paths + master_paths):
+        return jsonify({
+            "status": "error",
+            "message": "Missing input files. Post them as raw_data / master_file or upload them first."
+        }), 400
+
+    key, cache, cached_response = lookup_cached_run(
+        token, paths, raw_paths + master_paths,
+        format=output_format, sheets="all" if all_sheets else "first", raw_files=len(raw_paths)
+    )
+    if cached_response:
+        return cached_response
+
+    try:
+        job_id = submit_batch_pipeline_job(
+            raw_paths, master_paths, paths["folder"], all_sheets=all_sheets, output_format=output_format,
+            result_key=key
+        )
+    except SchedulerBusy as e:
+        return scheduler_busy(e)
+    return jsonify({
+        "status": "queued",
+        "message": f"Batch pipeline job queued ({len(raw_paths)} raw files, {len(master_paths)} master files)",
+        "workspace": token,
+        "batch": True,
+        "sheets": "all" if all_sheets else "first",
+        "format": output_format,
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+        "cache": cache
+    }), 202
 
 @pipeline_bp.route("/download_mapped", methods=["GET"])
 def download_mapped():
-    if os.path.exists(MAPPED_FILE_PATH):
-        return send_file(MAPPED_FILE_PATH, as_attachment=True)
+    """
+    The last run's output. ?format= picks xlsx, csv, parquet or ndjson
+    (without it: the mapped.xlsx workbook, or the unmapped rows in the
+    run's own format) and ?part=unmapped the unmapped rows. Formats the
+    run didn't write, xlsx included, are converted from its saved frames
+    on first request and then cached.
+    """
+    from pipeline.writer import OUTPUT_FORMATS, export_mapped_result, format_available, output_path
+
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+
+    paths = workspace_paths(token)
+    output_format = request.args.get("format", "").lower()
+    part = request.args.get("part", "mapped")
+    if part not in ("mapped", "unmapped") or (output_format and not format_available(output_format)):
+        return jsonify({"status": "error", "message": "Unsupported format or part"}), 400
+
+    # Clients that don't name a format get the workbook, as they always have
+    if not output_format and part == "mapped":
+        output_format = "xlsx"
+    if output_format:
+        path = output_path(folder, output_format, part)
+        if not os.path.exists(path) and os.path.exists(paths["mapped_result"]):
+            print(f"Converting the last run's {part} output to {output_format}...")
+            path = export_mapped_result(paths["mapped_result"], folder, output_format, part)
+            prepare_download(path)
+    else:
+        existing = [output_path(folder, fmt, part) for fmt in OUTPUT_FORMATS]
+        path = next((p for p in existing if os.path.exists(p)), None)
+
+    if path and os.path.exists(path):
+        return send_download(path)
     
     # If the file doesn't exist (because the pipeline failed), this is now the correct response
     return jsonify({
         "status": "error",
         "message": "Mapped file not found. Run the pipeline first."
-    }), 404
\ No newline at end of file
+    }), 404
+
+def stream_mapped_page(snapshot, total, page, next_cursor, columns):
+    """The JSON body of a /mapped page, produced row by row"""
+    yield json.dumps({"status": "success", "version": snapshot.version, "total": total,
+                      "count": len(page), "columns": columns, "next_after": next_cursor})[:-1]
+    yield ', "rows": ['
+    for position, record in enumerate(snapshot.records(page, columns)):
+        yield ("," if position else "") + json.dumps(record, default=str)
+    yield "]}"
+
+@pipeline_bp.route("/mapped", methods=["GET"])
+def query_mapped():
+    """
+    Query the last run's mapped rows without downloading the file.
+    ?FEES=, ?TYPE=, ?sem=, ?br_code= filter (repeat a parameter to allow
+    several values), ?sort=column (or -column for descending) orders the
+    rows, ?columns=a,b,c picks the columns and ?limit= sets the page size.
+    Each page carries next_after; pass it as ?after= for the next page.
+    """
+    from pipeline.snapshot import StaleCursor, open_snapshot
+
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+
+    path = workspace_paths(token)["snapshot"]
+    if not os.path.exists(path):
+        return jsonify({"status": "error", "message": "No mapped result yet. Run the pipeline first."}), 404
+    snapshot = open_snapshot(path)
+
+    sort = request.args.get("sort") or None
+    descending = bool(sort) and sort.startswith("-")
+    if descending:
+        sort = sort[1:]
+    columns = request.args.get("columns")
+    columns = [name.strip() for name in columns.split(",")] if columns else snapshot.columns
+    filters = {name: request.args.getlist(name) for name in MAPPED_FILTER_COLUMNS if name in request.args}
+    unknown = [name for name in columns + list(filters) + ([sort] if sort else []) if name not in snapshot.columns]
+    if unknown:
+        return jsonify({"status": "error", "message": f"Unknown column(s): {', '.join(unknown)}"}), 400
+    try:
+        limit = int(request.args.get("limit", MAPPED_QUERY_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAPPED_QUERY_MAX_LIMIT:
+        return jsonify({"status": "error", "message": f"limit must be between 1 and {MAPPED_QUERY_MAX_LIMIT}"}), 400
+
+    try:
+        total, page, next_cursor = snapshot.query(filters, sort, descending, request.args.get("after"), limit)
+    except StaleCursor as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return Response(stream_mapped_page(snapshot, total, page, next_cursor, columns), mimetype="application/json")
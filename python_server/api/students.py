@@ -0,0 +1,40 @@
+from flask import Blueprint, request, jsonify
+from config import LEDGER_LOOKUP_MAX_ERNOS
+from ledger import get_student, get_students
+
+students_bp = Blueprint("students", __name__)
+
+@students_bp.route("/students/<erno>", methods=["GET"])
+def student_fees(erno):
+    """Ledger entry of one enrollment number: its latest mapped fee row"""
+    erno = erno.strip()
+    student = get_student(erno)
+    if student is None:
+        return jsonify({"status": "error", "message": f"No ledger entry for enrollment number {erno}"}), 404
+    return jsonify({"status": "success", "student": student})
+
+@students_bp.route("/students/lookup", methods=["POST"])
+def lookup_students():
+    """
+    Batch lookup: a JSON body {"ernos": [...]} with up to
+    LEDGER_LOOKUP_MAX_ERNOS enrollment numbers. Returns the entries found,
+    keyed by erno, and the ernos with no entry.
+    """
+    body = request.get_json(silent=True) or {}
+    ernos = body.get("ernos")
+    if not isinstance(ernos, list) or not all(isinstance(erno, (str, int)) for erno in ernos):
+        return jsonify({"status": "error", "message": "Send a JSON body {\"ernos\": [...]}"}), 400
+    if len(ernos) > LEDGER_LOOKUP_MAX_ERNOS:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {LEDGER_LOOKUP_MAX_ERNOS} enrollment numbers per lookup"
+        }), 400
+
+    ernos = list(dict.fromkeys(str(erno).strip() for erno in ernos))
+    students = get_students(ernos)
+    return jsonify({
+        "status": "success",
+        "found": len(students),
+        "students": students,
+        "missing": [erno for erno in ernos if erno not in students]
+    })
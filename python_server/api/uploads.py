@@ -0,0 +1,130 @@
+from flask import Blueprint, request, jsonify
+from api.files import (
+    allowed_file, file_too_large, invalid_file_type, resolve_workspace, upload_response,
+    upload_workspace, workspace_not_found,
+)
+from uploads import (
+    UploadOffsetMismatch, UploadTooLarge, append_upload_chunk, complete_upload, create_upload, get_upload,
+)
+from workspaces import workspace_paths
+
+uploads_bp = Blueprint("uploads", __name__)
+
+# kind -> (workspace path key, label, parse and cache the file once stored)
+UPLOAD_KINDS = {
+    "raw": ("raw", "Raw data file", False),
+    "master": ("master", "Master file", True),
+}
+
+def upload_not_found():
+    return jsonify({"status": "error", "message": "Unknown upload id"}), 404
+
+def offset_mismatch(offset):
+    return jsonify({
+        "status": "error",
+        "message": f"Upload offset mismatch. The server has {offset} bytes; resume from there.",
+        "offset": offset
+    }), 409
+
+def _int_value(name, header):
+    value = request.headers.get(header) or request.values.get(name)
+    return int(value) if value not in (None, "") else None
+
+@uploads_bp.route("/uploads", methods=["POST"])
+def start_upload():
+    """
+    Starts a resumable upload. Form/query fields: kind (raw or master),
+    filename, and optionally length (or the Upload-Length header).
+    """
+    kind = request.values.get("kind", "")
+    filename = request.values.get("filename", "")
+    if kind not in UPLOAD_KINDS:
+        return jsonify({"status": "error", "message": "kind must be 'raw' or 'master'"}), 400
+    if not allowed_file(filename):
+        return invalid_file_type()
+    try:
+        length = _int_value("length", "Upload-Length")
+    except ValueError:
+        return jsonify({"status": "error", "message": "Upload length must be an integer"}), 400
+
+    token, error = upload_workspace()
+    if error:
+        return error
+    try:
+        upload_id = create_upload(workspace_paths(token)["folder"], kind, filename, length)
+    except UploadTooLarge:
+        return file_too_large(413)
+    return jsonify({
+        "status": "success",
+        "message": "Upload started",
+        "workspace": token,
+        "upload_id": upload_id,
+        "offset": 0,
+        "upload_url": f"/uploads/{upload_id}"
+    }), 201
+
+@uploads_bp.route("/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    """How many bytes of an upload the server has, to resume after a failure"""
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+    meta = get_upload(folder, upload_id)
+    if meta is None:
+        return upload_not_found()
+    return jsonify({
+        "status": "success",
+        "upload_id": upload_id,
+        "kind": meta["kind"],
+        "offset": meta["offset"],
+        "length": meta["length"]
+    })
+
+@uploads_bp.route("/uploads/<upload_id>", methods=["PATCH", "PUT"])
+def upload_chunk(upload_id):
+    """
+    Appends the request body at Upload-Offset (header or ?offset=), which
+    must equal the server's current offset.
+    """
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+    if get_upload(folder, upload_id) is None:
+        return upload_not_found()
+    try:
+        offset = _int_value("offset", "Upload-Offset")
+    except ValueError:
+        offset = None
+    if offset is None:
+        return jsonify({"status": "error", "message": "Upload-Offset is required"}), 400
+
+    try:
+        new_offset = append_upload_chunk(folder, upload_id, offset, request.stream)
+    except UploadOffsetMismatch as e:
+        return offset_mismatch(e.offset)
+    except UploadTooLarge:
+        return file_too_large(413)
+    return jsonify({"status": "success", "upload_id": upload_id, "offset": new_offset})
+
+@uploads_bp.route("/uploads/<upload_id>/complete", methods=["POST"])
+def finish_upload(upload_id):
+    """Stores the uploaded file as the workspace's raw or master file"""
+    token, folder = resolve_workspace()
+    if token is None:
+        return workspace_not_found()
+    meta = get_upload(folder, upload_id)
+    if meta is None:
+        return upload_not_found()
+
+    path_key, label, cache_parsed_master = UPLOAD_KINDS[meta["kind"]]
+    saved_path = workspace_paths(token)[path_key]
+    try:
+        file_size, content_hash = complete_upload(folder, upload_id, saved_path)
+        return upload_response(token, saved_path, label, file_size, content_hash, cache_parsed_master)
+    except UploadOffsetMismatch as e:
+        return offset_mismatch(e.offset)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to save file: {str(e)}"
+        }), 500
@@ -1,10 +1,50 @@
-from flask import Flask
+from flask import Flask, g, request
 from api.files import files_bp
 from api.pipeline_routes import pipeline_bp
 from api.health import health_bp
+from api.jobs import jobs_bp
+from api.metrics import metrics_bp
+from api.students import students_bp
+from api.uploads import uploads_bp
+from config import USE_X_SENDFILE, print_config
+from metrics import record_request
+from uploads import StreamedUploadRequest, UploadTooLarge
 import os
+import time
 
 app = Flask(__name__)
+# Multipart uploads are parsed straight into the workspaces folder
+app.request_class = StreamedUploadRequest
+
+# Routes whose latency is exported as http_request_duration_seconds
+TIMED_ENDPOINTS = {
+    "files.upload_raw": "upload_raw",
+    "files.upload_master": "upload_master",
+    "uploads.upload_chunk": "upload_chunk",
+    "uploads.finish_upload": "upload_complete",
+    "files.download_file": "download",
+    "pipeline.download_mapped": "download_mapped",
+    "pipeline.query_mapped": "mapped",
+    "jobs.job_result": "job_result",
+    "students.student_fees": "student",
+    "students.lookup_students": "student_lookup",
+}
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    route = TIMED_ENDPOINTS.get(request.endpoint)
+    started = g.get("request_started")
+    if route is not None and started is not None:
+        method, status = request.method, response.status_code
+        # Recorded once the body (e.g. a streamed file) has been sent
+        response.call_on_close(
+            lambda: record_request(route, method, status, time.perf_counter() - started)
+        )
+    return response
 
 # Configure CORS manually (no flask-cors dependency needed for local development)
 @app.after_request
@@ -12,20 +52,26 @@ def after_request(response):
     allowed_origins = os.getenv("ALLOWED_ORIGINS", "*")
     origin = "*" if allowed_origins == "*" else allowed_origins.split(",")[0]
     response.headers.add('Access-Control-Allow-Origin', origin)
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Workspace-Token,X-Filename,Upload-Length,Upload-Offset')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,PATCH,DELETE,OPTIONS')
     return response
 
 # Configure max content length (16MB)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
 
 # Register blueprints
 app.register_blueprint(files_bp)
 app.register_blueprint(pipeline_bp)
 app.register_blueprint(health_bp)
+app.register_blueprint(jobs_bp)
+app.register_blueprint(metrics_bp)
+app.register_blueprint(students_bp)
+app.register_blueprint(uploads_bp)
 
 # Error handlers
 @app.errorhandler(413)
+@app.errorhandler(UploadTooLarge)
 def request_entity_too_large(error):
     return {
         "status": "error",
@@ -52,6 +98,7 @@ if __name__ == "__main__":
     debug = os.getenv("FLASK_DEBUG", "False").lower() == "true"
     host = os.getenv("HOST", "0.0.0.0")
     
+    print_config()
     print(f"Starting Flask server on {host}:{port}")
     print(f"Debug mode: {debug}")
     
@@ -0,0 +1,98 @@
+"""
+Parity check for GET /download_mapped across output formats.
+
+Generates a raw export and master, then, through the Flask test client,
+runs the pipeline once per output format in its own workspace and
+downloads every other format from each run (produced from the run's saved
+frames on first request). Every download must match what a run in that
+format wrote itself: byte for byte for csv and ndjson, cell for cell for
+xlsx (its zip carries timestamps). A download without ?format must still
+be the xlsx workbook, whatever the run wrote. Exits non-zero if any
+download differs.
+
+Run from python_server/:
+    python -m benchmarks.format_parity
+    python -m benchmarks.format_parity --master-rows 5000 --raw-rows 20000
+"""
+import argparse
+import contextlib
+import io
+import sys
+import tempfile
+import time
+
+from openpyxl import load_workbook
+
+from app import app
+from benchmarks.generator import generate
+from pipeline.writer import OUTPUT_FORMATS, format_available
+
+
+def _run(client, raw_path, master_path, output_format):
+    """Uploads the inputs to a new workspace, runs the pipeline and waits for it. Returns the token."""
+    with open(raw_path, "rb") as f:
+        token = client.post("/upload_raw", data={"raw_data": (f, "raw.xlsx")}).get_json()["workspace"]
+    headers = {"X-Workspace-Token": token}
+    with open(master_path, "rb") as f:
+        client.post("/upload_master", data={"master_file": (f, "master.xlsx")}, headers=headers)
+    response = client.post(f"/run_pipeline?format={output_format}", headers=headers).get_json()
+    while response["status"] in ("queued", "running"):
+        time.sleep(0.2)
+        response = client.get(f"/jobs/{response['job_id']}", headers=headers).get_json()
+    if response["status"] != "success":
+        raise RuntimeError(f"{output_format} run failed: {response}")
+    return token
+
+
+def _download(client, token, output_format, part):
+    query = f"format={output_format}&part={part}" if output_format else f"part={part}"
+    response = client.get(f"/download_mapped?{query}", headers={"X-Workspace-Token": token})
+    return response.status_code, response.get_data()
+
+
+def _comparable(output_format, body):
+    if output_format == "xlsx":
+        return list(load_workbook(io.BytesIO(body), read_only=True).active.iter_rows(values_only=True))
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check cross-format downloads of a pipeline run.")
+    parser.add_argument("--master-rows", type=int, default=2000)
+    parser.add_argument("--raw-rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    # parquet files embed writer metadata, so they are only checked for being served
+    formats = [fmt for fmt in OUTPUT_FORMATS if format_available(fmt)]
+    client = app.test_client()
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_path, master_path = generate(tmp, args.master_rows, args.raw_rows)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tokens = {fmt: _run(client, raw_path, master_path, fmt) for fmt in formats}
+            for run_format in formats:
+                for output_format in formats:
+                    for part in ("mapped", "unmapped"):
+                        if output_format == "xlsx" and part == "unmapped":
+                            continue  # xlsx keeps the unmapped rows in the mapped workbook
+                        status, body = _download(client, tokens[run_format], output_format, part)
+                        _, expected = _download(client, tokens[output_format], output_format, part)
+                        same = output_format == "parquet" or \
+                            _comparable(output_format, body) == _comparable(output_format, expected)
+                        if status != 200 or not same:
+                            failures.append(f"{run_format} run -> {part} {output_format}: HTTP {status}"
+                                            + ("" if same else ", content differs"))
+                status, body = _download(client, tokens[run_format], "", "mapped")
+                _, expected = _download(client, tokens["xlsx"], "xlsx", "mapped")
+                if status != 200 or _comparable("xlsx", body) != _comparable("xlsx", expected):
+                    failures.append(f"{run_format} run -> mapped without ?format: HTTP {status}, not the workbook")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print(f"Every format downloads from every run ({', '.join(formats)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Synthetic raw bank export and master roster workbooks for benchmarking.
+
+The raw export follows the layout the parser expects: 8 preamble rows, then
+"Category Name" header blocks (repeated, with both the "Enrollment No" and
+"Enrollment/ACPC merit No" variants and shuffled column orders),
+transactions with enrollment numbers written as text, numbers and
+scientific notation, blank and junk rows in between, and a 4-row footer.
+
+Run from python_server/:
+    python -m benchmarks.generator /tmp/bench --master-rows 20000 --raw-rows 50000
+"""
+import argparse
+import os
+import random
+
+from openpyxl import Workbook
+
+PREAMBLE_ROWS = 8
+FOOTER_ROWS = 4
+
+RAW_HEADERS = [
+    ["Category Name", "Name of Student", "Enrollment No", "Amount",
+     "Bank Reference No", "Status", "Transaction Date"],
+    ["Category Name", "Transaction Date", "Enrollment/ACPC merit No", "Name of Student",
+     "Status", "Amount", "Bank Reference No", "Remarks"],
+    ["Category Name", "Enrollment No", "Amount", "Status", "Bank Reference No"],
+]
+CATEGORIES = ["Tuition Fee", "Exam Fee", "Hostel Fee", "Library Fee"]
+STATUSES = ["Success", "Paid"]
+BRANCHES = ["CE", "IT", "ME", "EE", "CV"]
+
+
+def _erno(index):
+    return 200000000000 + index * 7
+
+
+def _erno_cell(erno, rnd):
+    """An enrollment number written the ways real exports do."""
+    kind = rnd.random()
+    if kind < 0.5:
+        return str(erno)
+    if kind < 0.7:
+        return erno
+    if kind < 0.85:
+        return float(erno)
+    if kind < 0.95:
+        return f"{erno:.11E}"
+    return f" {erno} "
+
+
+def write_master_workbook(path, master_rows, seed=0, name_prefix=""):
+    """
+    Master roster: erno, name, sem, br_code, an unnamed column and extras.
+    Every name starts with name_prefix, which makes the rows traceable.
+    """
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(["erno", "name", "sem", "br_code", None, "mobile", "email"])
+    for i in range(master_rows):
+        erno = _erno(i)
+        ws.append([
+            erno if i % 3 else str(erno), f"{name_prefix}Student {i}", rnd.randint(1, 8),
+            rnd.choice(BRANCHES), None, f"9{rnd.randint(100000000, 999999999)}", f"s{i}@example.edu",
+        ])
+    wb.save(path)
+
+
+def write_raw_workbook(path, raw_rows, master_rows, seed=0, header_every=2000,
+                       new_student_ratio=0.05, blank_ratio=0.02, junk_ratio=0.02):
+    """
+    Raw bank export with about raw_rows transaction rows. A new header
+    block starts on average every header_every rows.
+    """
+    rnd = random.Random(seed)
+    new_students = max(1, int(master_rows * new_student_ratio))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+
+    for i in range(PREAMBLE_ROWS):
+        ws.append([f"Fee collection report line {i + 1}", None, "generated"])
+
+    header = RAW_HEADERS[0]
+    ws.append(header)
+    for i in range(raw_rows):
+        r = rnd.random()
+        if r < 1 / header_every:
+            header = rnd.choice(RAW_HEADERS)
+            ws.append(header)
+            continue
+        if r < blank_ratio:
+            ws.append([None] * len(header))
+            continue
+        if r < blank_ratio + junk_ratio:
+            ws.append([rnd.choice(["Sub Total", "Page total", "---"]), None, "junk", "  "])
+            continue
+
+        if rnd.random() < new_student_ratio:
+            erno = 300000000000 + rnd.randrange(new_students)
+        else:
+            erno = _erno(rnd.randrange(master_rows))
+        values = {
+            "Category Name": rnd.choice(CATEGORIES),
+            "Name of Student": f"Payer {i}",
+            "Enrollment No": _erno_cell(erno, rnd),
+            "Enrollment/ACPC merit No": _erno_cell(erno, rnd),
+            "Amount": rnd.choice([1500, 2500.5, "3000", 45000]),
+            "Bank Reference No": f"BR{seed:03d}{i:09d}",
+            "Status": rnd.choice(STATUSES),
+            "Transaction Date": f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:{rnd.randint(0, 59):02d}:00",
+            "Remarks": "online",
+        }
+        ws.append([values[col] for col in header])
+
+    for i in range(FOOTER_ROWS):
+        ws.append([f"Footer {i + 1}", "Grand total" if i == 0 else None])
+    wb.save(path)
+
+
+def generate(out_dir, master_rows=10000, raw_rows=20000, seed=0, name_prefix="", **raw_options):
+    """Writes master.xlsx and raw.xlsx into out_dir and returns their paths."""
+    os.makedirs(out_dir, exist_ok=True)
+    master_path = os.path.join(out_dir, "master.xlsx")
+    raw_path = os.path.join(out_dir, "raw.xlsx")
+    write_master_workbook(master_path, master_rows, seed, name_prefix)
+    write_raw_workbook(raw_path, raw_rows, master_rows, seed, **raw_options)
+    return raw_path, master_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic raw/master workbooks.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--master-rows", type=int, default=10000)
+    parser.add_argument("--raw-rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--header-every", type=int, default=2000)
+    args = parser.parse_args()
+    raw_path, master_path = generate(
+        args.out_dir, args.master_rows, args.raw_rows, args.seed, header_every=args.header_every
+    )
+    print(f"Wrote {raw_path} and {master_path}")
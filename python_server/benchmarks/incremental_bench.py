@@ -0,0 +1,115 @@
+"""
+Benchmark of incremental runs on a bank export that keeps growing.
+
+Generates a master and a raw export, does the first incremental run, then
+appends rows to the export a few times (the same seed, so earlier rows stay
+as they were). After every growth step the export is mapped twice: by a
+full run in one folder and by an incremental run in another, which resumes
+reading below the rows it has already read. Prints the seconds per stage
+of both and exits non-zero if their mapped or unmapped files differ.
+
+Run from python_server/:
+    python -m benchmarks.incremental_bench
+    python -m benchmarks.incremental_bench --raw-rows 200000 --grow-rows 2000 --steps 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.generator import write_master_workbook, write_raw_workbook
+from pipeline.pp import run_pipeline_api
+
+STAGES = ["read_master", "read_raw", "clean", "map", "new_students", "write", "ledger"]
+
+
+def _run(raw_path, master_path, incremental):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = run_pipeline_api(raw_path, master_path, incremental=incremental)
+        seconds = time.perf_counter() - start
+    if result["status"] != "success":
+        raise RuntimeError(result["message"])
+    return result, seconds
+
+
+def _output_bytes(result):
+    """Contents of the run's mapped and unmapped files (csv, the default format)."""
+    contents = []
+    for path in (result["output_file"], result["unmapped_file"]):
+        if path:
+            with open(path, "rb") as f:
+                contents.append(f.read())
+        else:
+            contents.append(None)
+    return contents
+
+
+def run_benchmark(master_rows, raw_rows, grow_rows, steps, seed=0, work_dir=None):
+    """Returns one dict per growth step with the timings of both runs."""
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="incremental_bench_")
+    try:
+        raw_path = os.path.join(work_dir, "raw.xlsx")
+        folders = {mode: os.path.join(work_dir, mode) for mode in ("full", "incremental")}
+        for folder in folders.values():
+            os.makedirs(folder, exist_ok=True)
+        write_master_workbook(os.path.join(folders["full"], "master.xlsx"), master_rows, seed)
+        shutil.copy(os.path.join(folders["full"], "master.xlsx"), folders["incremental"])
+
+        write_raw_workbook(raw_path, raw_rows, master_rows, seed)
+        _run(raw_path, os.path.join(folders["incremental"], "master.xlsx"), incremental=True)
+
+        steps_report = []
+        for step in range(1, steps + 1):
+            rows = raw_rows + step * grow_rows
+            write_raw_workbook(raw_path, rows, master_rows, seed)
+            full, full_seconds = _run(raw_path, os.path.join(folders["full"], "master.xlsx"), incremental=False)
+            inc, inc_seconds = _run(raw_path, os.path.join(folders["incremental"], "master.xlsx"), incremental=True)
+            steps_report.append({
+                "raw_rows": rows,
+                "delta_rows": inc["delta_rows"],
+                "read_resumed": inc["read_resumed"],
+                "full": {"seconds": full_seconds, "stages": full["metrics"]["stages"]},
+                "incremental": {"seconds": inc_seconds, "stages": inc["metrics"]["stages"]},
+                "same_output": _output_bytes(full) == _output_bytes(inc),
+            })
+        return steps_report
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(steps_report):
+    for step in steps_report:
+        print(f"{step['raw_rows']:,} raw rows, {step['delta_rows']:,} new "
+              f"(read {'resumed' if step['read_resumed'] else 'from the top'}, "
+              f"output {'identical' if step['same_output'] else 'DIFFERENT'})")
+        print(f"  {'stage':<14}{'full':>10}{'incremental':>13}")
+        for name in STAGES + ["total"]:
+            if name == "total":
+                full, inc = step["full"]["seconds"], step["incremental"]["seconds"]
+            else:
+                full = step["full"]["stages"].get(name, 0.0)
+                inc = step["incremental"]["stages"].get(name, 0.0)
+            print(f"  {name:<14}{full:9.3f}s{inc:12.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time full vs incremental runs on a growing export.")
+    parser.add_argument("--master-rows", type=int, default=10000)
+    parser.add_argument("--raw-rows", type=int, default=50000)
+    parser.add_argument("--grow-rows", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="keep the generated workbooks and outputs here")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.master_rows, args.raw_rows, args.grow_rows, args.steps, args.seed, args.work_dir)
+    print_report(report)
+    if not all(step["same_output"] for step in report):
+        sys.exit(1)
@@ -0,0 +1,64 @@
+"""
+Check of the fee ledger's upsert rules, against a scratch ledger database.
+
+Applies the ledger rows of a few runs in the order the web app can see
+them and checks every entry after each step:
+  - a student without a transaction in a later run keeps the Paid entry
+    an earlier run gave them,
+  - replaying an older run (a result cache hit) doesn't undo a newer one,
+  - a newer transaction still replaces an older one, and a student new to
+    the ledger is added with or without a transaction.
+Exits non-zero on the first wrong entry.
+
+Run from python_server/:
+    python -m benchmarks.ledger_check
+"""
+import os
+import sys
+import tempfile
+
+import ledger
+from ledger import LEDGER_COLUMNS, apply_run_rows, get_students, write_run_rows
+
+
+def _row(erno, fees="Not Paid", reference="", date=""):
+    values = {"erno": erno, "NAME": f"Student {erno}", "AMOUNT": 1000 if reference else 0,
+              "epaymerchantorderno": reference, "TYPE": "Tuition" if reference else "",
+              "FEES": fees, "modifydate": date, "sem": 1, "br_code": "CE"}
+    return tuple(values[column] for column in LEDGER_COLUMNS)
+
+
+# (step, rows file, ran_at, rows) -> expected (FEES, epaymerchantorderno) per erno
+STEPS = [
+    ("first run", "a", 1.0, [_row("X", "Paid", "R1", "2024-01-05"), _row("Y")],
+     {"X": ("Paid", "R1"), "Y": ("Not Paid", "")}),
+    ("X missing from the next export", "b", 2.0, [_row("X"), _row("Y", "Paid", "R2", "2024-01-09")],
+     {"X": ("Paid", "R1"), "Y": ("Paid", "R2")}),
+    ("first run replayed from the cache", "a", None, None,
+     {"X": ("Paid", "R1"), "Y": ("Paid", "R2")}),
+    ("X pays again, Z is new", "c", 3.0, [_row("X", "Failed", "R3", "2024-02-01"), _row("Z")],
+     {"X": ("Failed", "R3"), "Y": ("Paid", "R2"), "Z": ("Not Paid", "")}),
+    ("second run replayed from the cache", "b", None, None,
+     {"X": ("Failed", "R3"), "Y": ("Paid", "R2"), "Z": ("Not Paid", "")}),
+]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        # _connect's default database is bound at import; point it at a scratch file
+        ledger._connect.__wrapped__.__defaults__ = (os.path.join(tmp, "ledger.sqlite3"),)
+        for step, name, ran_at, rows, expected in STEPS:
+            path = os.path.join(tmp, f"{name}.sqlite3")
+            if rows is not None:
+                write_run_rows(path, rows, ran_at)
+            apply_run_rows(path)
+            entries = get_students(expected)
+            got = {erno: (entry["FEES"], entry["epaymerchantorderno"]) for erno, entry in entries.items()}
+            if got != expected:
+                print(f"After '{step}': ledger holds {got}, expected {expected}")
+                sys.exit(1)
+    print(f"{len(STEPS)} ledger steps: every entry as expected")
+
+
+if __name__ == "__main__":
+    main()
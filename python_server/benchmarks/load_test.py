@@ -0,0 +1,382 @@
+"""
+Concurrent load test of the web app's upload -> run -> download flow.
+
+Starts a local gunicorn (or targets --url) and runs N simulated clients at
+once. Each client owns one workspace and, per iteration, uploads its own
+generated raw/master workbooks (/upload_raw, /upload_master), runs the
+pipeline (/run_pipeline, then polls /jobs/<id>), downloads the result
+(/download_mapped, as the csv the run wrote), lists (/list_files) and resets (/reset) the workspace.
+
+Reported: throughput, p50/p95/p99 latency and error counts per endpoint,
+429/503 answers that were retried after Retry-After, and data races. A
+race is any response showing another client's data: a mapped file whose
+rows carry another client's name tag, or whose content hash is not the
+one this client's job produced, a workspace token that changed, or a file
+listing with inputs that should be gone. Exits with status 1 on errors or
+races, so it can guard against concurrency regressions.
+
+Run from python_server/:
+    python -m benchmarks.load_test --clients 8 --iterations 3 --workers 2
+    python -m benchmarks.load_test --clients 16 --url http://localhost:5000 --output load.json
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+from benchmarks.generator import generate
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ["upload_raw", "upload_master", "run_pipeline", "job_status", "download_mapped", "list_files", "reset"]
+# Per-client marker put in front of every master name, e.g. "c007-"
+CLIENT_TAG = "c{:03d}-"
+_TAG_RE = re.compile(r"^(c\d{3}-)")
+MAX_BUSY_RETRIES = 30
+JOB_POLL_SECONDS = 0.2
+REQUEST_TIMEOUT = 300
+
+
+class LoadStats:
+    """Latencies and outcomes per endpoint, shared by all client threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.throttled = {name: 0 for name in ENDPOINTS}
+        self.races = []
+        self.failures = []
+        self.flows = 0
+        self.run_seconds = []
+        self.retry_wait_seconds = 0.0
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if status in (429, 503):
+                self.throttled[endpoint] += 1
+            elif status >= 400:
+                self.errors[endpoint] += 1
+
+    def backed_off(self, seconds):
+        with self._lock:
+            self.retry_wait_seconds += seconds
+
+    def finished(self, run_seconds):
+        with self._lock:
+            self.flows += 1
+            self.run_seconds.append(run_seconds)
+
+    def race(self, client, message):
+        with self._lock:
+            self.races.append(f"client {client}: {message}")
+
+    def failure(self, client, message):
+        with self._lock:
+            self.failures.append(f"client {client}: {message}")
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def _multipart(field, path):
+    boundary = uuid.uuid4().hex
+    with open(path, "rb") as f:
+        content = f.read()
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+        f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    """One simulated user: a workspace of its own and its own input files."""
+
+    def __init__(self, number, base_url, inputs, stats):
+        self.number = number
+        self.base_url = base_url
+        self.inputs = inputs          # [(raw path, master path)] per iteration
+        self.stats = stats
+        self.tag = CLIENT_TAG.format(number)
+        self.token = None
+
+    def request(self, endpoint, method, path, body=None, content_type=None):
+        """(status, headers, body bytes) of one request, timed under endpoint."""
+        headers = {"X-Workspace-Token": self.token} if self.token else {}
+        if content_type:
+            headers["Content-Type"] = content_type
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                status, response_headers, data = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, data = e.code, e.headers, e.read()
+        self.stats.record(endpoint, time.perf_counter() - start, status)
+        return status, response_headers, data
+
+    def _json(self, endpoint, method, path, body=None, content_type=None):
+        status, headers, data = self.request(endpoint, method, path, body, content_type)
+        try:
+            return status, headers, json.loads(data)
+        except ValueError:
+            return status, headers, {"message": data[:200].decode(errors="replace")}
+
+    def upload(self, endpoint, field, path):
+        body, content_type = _multipart(field, path)
+        status, _, payload = self._json(endpoint, "POST", f"/{endpoint}", body, content_type)
+        if status != 200:
+            raise RuntimeError(f"{endpoint} answered {status}: {payload.get('message')}")
+        if self.token is None:
+            self.token = payload["workspace"]
+        elif payload["workspace"] != self.token:
+            self.stats.race(self.number, f"{endpoint} answered for workspace {payload['workspace']}")
+
+    def run_pipeline(self):
+        """The finished run's result dict; 429/503 are retried after Retry-After."""
+        for _ in range(MAX_BUSY_RETRIES):
+            status, headers, payload = self._json("run_pipeline", "POST", "/run_pipeline", b"",
+                                                  "application/x-www-form-urlencoded")
+            if status in (429, 503):
+                retry_after = float(headers.get("Retry-After", 1))
+                self.stats.backed_off(retry_after)
+                time.sleep(retry_after)
+                continue
+            if status == 200 and payload.get("result"):
+                result = payload["result"]          # served from the result cache
+                break
+            if status != 202:
+                raise RuntimeError(f"run_pipeline answered {status}: {payload.get('message')}")
+            result = self.wait_for_job(payload["job_id"])
+            break
+        else:
+            raise RuntimeError(f"run_pipeline still busy after {MAX_BUSY_RETRIES} attempts")
+        return result
+
+    def wait_for_job(self, job_id):
+        while True:
+            status, _, job = self._json("job_status", "GET", f"/jobs/{job_id}")
+            if status != 200:
+                raise RuntimeError(f"/jobs/{job_id} answered {status}")
+            if job["status"] == "success":
+                return job["result"]
+            if job["status"] == "error":
+                raise RuntimeError(f"job failed: {(job.get('result') or {}).get('message')}")
+            time.sleep(JOB_POLL_SECONDS)
+
+    def check_download(self, result):
+        status, headers, data = self.request("download_mapped", "GET", "/download_mapped?format=csv")
+        if status != 200:
+            raise RuntimeError(f"download_mapped answered {status}")
+        digest = hashlib.sha256(data).hexdigest()
+        if digest != result.get("content_hash") or (headers.get("ETag") or "").strip('"') != digest:
+            self.stats.race(self.number, "downloaded a mapped file its run did not produce")
+        rows = csv.reader(io.StringIO(data.decode("utf-8")))
+        name_column = next(rows).index("name")
+        matches = (_TAG_RE.match(row[name_column]) for row in rows if len(row) > name_column)
+        foreign = sorted({match.group(1) for match in matches if match} - {self.tag})
+        if foreign:
+            self.stats.race(self.number, f"mapped file holds rows of clients {', '.join(foreign)}")
+
+    def check_listing(self, expected, unexpected):
+        status, _, listing = self._json("list_files", "GET", "/list_files")
+        if status != 200:
+            raise RuntimeError(f"list_files answered {status}")
+        if not expected <= set(listing) or unexpected & set(listing):
+            self.stats.race(self.number, f"unexpected workspace listing {sorted(listing)}")
+
+    def reset(self):
+        status, _, payload = self._json("reset", "POST", "/reset")
+        if status != 200:
+            raise RuntimeError(f"reset answered {status}: {payload.get('message')}")
+        if payload.get("workspace") != self.token:
+            self.stats.race(self.number, f"reset answered for workspace {payload.get('workspace')}")
+
+    def run(self, start_barrier):
+        start_barrier.wait()
+        for raw_path, master_path in self.inputs:
+            try:
+                self.upload("upload_raw", "raw_data", raw_path)
+                self.upload("upload_master", "master_file", master_path)
+                started = time.perf_counter()
+                result = self.run_pipeline()
+                run_seconds = time.perf_counter() - started
+                self.check_download(result)
+                self.check_listing({"raw_data.xlsx", "master_file.xlsx", "mapped.csv"}, set())
+                self.reset()
+                self.check_listing({"mapped.csv"}, {"raw_data.xlsx", "master_file.xlsx"})
+            except Exception as e:
+                # Any failure ends this flow only; the client carries on with the next
+                self.stats.failure(self.number, f"{type(e).__name__}: {e}")
+                continue
+            self.stats.finished(run_seconds)
+
+
+def generate_inputs(work_dir, clients, iterations, master_rows, raw_rows, reuse_inputs=False):
+    """[(raw, master) per iteration] per client; every client's master names carry its tag."""
+    inputs = []
+    for client in range(clients):
+        pairs = []
+        for iteration in range(1 if reuse_inputs else iterations):
+            out_dir = os.path.join(work_dir, f"client{client:03d}", f"iteration{iteration}")
+            pairs.append(generate(out_dir, master_rows, raw_rows, seed=client * 1000 + iteration,
+                                  name_prefix=CLIENT_TAG.format(client), header_every=200))
+        inputs.append(pairs * iterations if reuse_inputs else pairs)
+    return inputs
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, data_dir, log_path):
+    """Starts gunicorn with its data under data_dir; returns (process, base URL)."""
+    port = _free_port()
+    env = dict(os.environ, HOST="127.0.0.1", PORT=str(port), WEB_CONCURRENCY=str(workers), TMPDIR=data_dir)
+    log = open(log_path, "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app"], cwd=SERVER_DIR, env=env, stdout=log, stderr=log,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}; see {log_path}")
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1).read()
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"gunicorn did not come up within 60s; see {log_path}")
+
+
+def run_load_test(base_url, inputs):
+    """Runs every client at once and returns (LoadStats, wall seconds)."""
+    stats = LoadStats()
+    barrier = threading.Barrier(len(inputs))
+    clients = [Client(number, base_url, pairs, stats) for number, pairs in enumerate(inputs)]
+    threads = [threading.Thread(target=client.run, args=(barrier,)) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def build_report(stats, seconds, clients, iterations, workers):
+    requests = sum(len(values) for values in stats.latencies.values())
+    endpoints = {}
+    for name in ENDPOINTS:
+        values = sorted(stats.latencies[name])
+        endpoints[name] = {
+            "requests": len(values),
+            "errors": stats.errors[name],
+            "throttled": stats.throttled[name],
+            "error_rate": round(stats.errors[name] / len(values), 4) if values else 0,
+            **{f"p{p}_ms": round(_percentile(values, p) * 1000, 1) if values else None for p in (50, 95, 99)},
+            "max_ms": round(values[-1] * 1000, 1) if values else None,
+        }
+    run_seconds = sorted(stats.run_seconds)
+    return {
+        "clients": clients,
+        "iterations": iterations,
+        "workers": workers,
+        "seconds": round(seconds, 2),
+        "flows": stats.flows,
+        "flows_per_second": round(stats.flows / seconds, 3),
+        "requests_per_second": round(requests / seconds, 1),
+        "run_to_result_p50_s": round(_percentile(run_seconds, 50), 2) if run_seconds else None,
+        "run_to_result_p95_s": round(_percentile(run_seconds, 95), 2) if run_seconds else None,
+        "retry_wait_seconds": round(stats.retry_wait_seconds, 1),
+        "endpoints": endpoints,
+        "failures": stats.failures,
+        "races": stats.races,
+    }
+
+
+def print_report(report):
+    target = "" if report["workers"] is None else f" against {report['workers']} gunicorn workers"
+    print(f"{report['clients']} clients x {report['iterations']} iterations{target}: "
+          f"{report['flows']} flows in {report['seconds']}s "
+          f"({report['flows_per_second']} flows/s, {report['requests_per_second']} requests/s)")
+    print(f"run_pipeline to result: p50 {report['run_to_result_p50_s']}s, p95 {report['run_to_result_p95_s']}s "
+          f"({report['retry_wait_seconds']}s spent waiting out Retry-After)")
+    print(f"{'endpoint':<16} {'requests':>8} {'errors':>6} {'429/503':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for name, row in report["endpoints"].items():
+        print(f"{name:<16} {row['requests']:>8} {row['errors']:>6} {row['throttled']:>7} "
+              + " ".join(f"{'-' if row[key] is None else row[key]:>8}" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")))
+    for failure in report["failures"]:
+        print(f"FAILED: {failure}")
+    for race in report["races"]:
+        print(f"RACE: {race}")
+    print("OK" if not report["failures"] and not report["races"] else
+          f"{len(report['failures'])} failed flows, {len(report['races'])} races")
+
+
+def main(args):
+    """Runs the load test per the command line; returns True if no flow failed or raced."""
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+    server = None
+    try:
+        print(f"Generating inputs for {args.clients} clients in {work_dir}...")
+        inputs = generate_inputs(os.path.join(work_dir, "inputs"), args.clients, args.iterations,
+                                 args.master_rows, args.raw_rows, args.reuse_inputs)
+        base_url = args.url
+        if base_url is None:
+            data_dir = os.path.join(work_dir, "server")
+            os.makedirs(data_dir)
+            server, base_url = start_server(args.workers, data_dir, os.path.join(work_dir, "gunicorn.log"))
+        stats, seconds = run_load_test(base_url.rstrip("/"), inputs)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = build_report(stats, seconds, args.clients, args.iterations, None if args.url else args.workers)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return not report["failures"] and not report["races"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the upload/run/download flow with concurrent clients.")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=3, help="flows per client")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers of the local server")
+    parser.add_argument("--url", help="test this running server instead of starting one")
+    parser.add_argument("--master-rows", type=int, default=300)
+    parser.add_argument("--raw-rows", type=int, default=1000)
+    parser.add_argument("--reuse-inputs", action="store_true",
+                        help="same inputs every iteration (later runs are result cache hits)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated inputs and server data")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    sys.exit(0 if main(parser.parse_args()) else 1)
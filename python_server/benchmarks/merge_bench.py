@@ -0,0 +1,125 @@
+"""
+Benchmark for steps 4-6 of the pipeline (mapping raw transactions onto the
+master and building the new-student rows).
+
+Compares the keyed-join engine in pipeline.pp with the previous
+implementation (five set_index/to_dict maps, five map() passes, five
+fillna calls and Python sets for new students), kept below as the baseline.
+
+Run from python_server/:
+    python -m benchmarks.merge_bench
+    python -m benchmarks.merge_bench --sizes 10000 100000 --repeat 5
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+import pandas as pd
+
+from pipeline.pp import _merge_raw_records, _new_student_rows
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def make_frames(master_rows, paid_ratio=0.8, new_ratio=0.05, seed=0):
+    """Synthetic normalized master and cleaned raw frames of the given size."""
+    rng = np.random.default_rng(seed)
+    ernos = (200000000000 + np.arange(master_rows) * 7).astype(str)
+    master_df = pd.DataFrame({
+        'erno': ernos,
+        'name': [f"Student {i}" for i in range(master_rows)],
+        'sem': rng.integers(1, 9, master_rows),
+        'br_code': rng.choice(['CE', 'IT', 'ME'], master_rows),
+        'Unnamed: 4': np.nan,
+    })
+
+    paid = rng.choice(ernos, int(master_rows * paid_ratio), replace=False)
+    new = (300000000000 + np.arange(int(master_rows * new_ratio))).astype(str)
+    raw_ernos = np.concatenate([paid, new])
+    rng.shuffle(raw_ernos)
+    n = len(raw_ernos)
+    raw_df = pd.DataFrame({
+        'Enrollment No': raw_ernos,
+        'Amount': rng.choice([1000.0, 2500.5, 300.0], n),
+        'Bank Reference No': [f"REF{i}" for i in range(n)],
+        'Category Name': rng.choice(['Tuition', 'Exam', 'Hostel'], n),
+        'Status': rng.choice(['Paid', 'Success', None], n),
+        'Name of Student': [f"N{i}" for i in range(n)],
+        'Transaction Date': rng.choice(['2024-01-10', '2024-02-11', '2024-03-12'], n),
+    })
+    return master_df, raw_df
+
+
+def baseline_map(master_df, raw_df, unnamed_col_name):
+    """The map()-based steps 4-6 this benchmark compares against."""
+    amount_map = raw_df.set_index('Enrollment No')['Amount'].to_dict()
+    ref_map = raw_df.set_index('Enrollment No')['Bank Reference No'].to_dict()
+    type_map = raw_df.set_index('Enrollment No')['Category Name'].to_dict()
+    status_map = raw_df.set_index('Enrollment No')['Status'].to_dict()
+    date_map = raw_df.set_index('Enrollment No')['Transaction Date'].to_dict()
+
+    master_df['AMOUNT'] = master_df['erno'].map(amount_map)
+    master_df['epaymerchantorderno'] = master_df['erno'].map(ref_map)
+    master_df['TYPE'] = master_df['erno'].map(type_map)
+    master_df['FEES'] = master_df['erno'].map(status_map)
+    master_df['modifydate'] = master_df['erno'].map(date_map)
+    master_df['ERNO'] = master_df['erno']
+    master_df['NAME'] = master_df['name']
+    master_df['AMOUNT'] = master_df['AMOUNT'].fillna(0)
+    master_df['epaymerchantorderno'] = master_df['epaymerchantorderno'].fillna('')
+    master_df['TYPE'] = master_df['TYPE'].fillna('')
+    master_df['FEES'] = master_df['FEES'].fillna('Not Paid')
+    master_df['modifydate'] = master_df['modifydate'].fillna('')
+
+    new_student_ernos = set(raw_df['Enrollment No']) - set(master_df['erno'])
+    new_students_df = raw_df[raw_df['Enrollment No'].isin(new_student_ernos)]
+    new_rows_df = _new_student_rows(master_df.columns, new_students_df, unnamed_col_name)
+    return pd.concat([master_df, new_rows_df], ignore_index=True)
+
+
+def join_map(master_df, raw_df, unnamed_col_name):
+    master_df, new_students_df = _merge_raw_records(master_df, raw_df)
+    new_rows_df = _new_student_rows(master_df.columns, new_students_df, unnamed_col_name)
+    return pd.concat([master_df, new_rows_df], ignore_index=True)
+
+
+def _best_time(func, master_df, raw_df, repeat):
+    times = []
+    for _ in range(repeat):
+        master_copy = master_df.copy()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func(master_copy, raw_df, 'Unnamed: 4')
+            times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def run(sizes=DEFAULT_SIZES, repeat=3):
+    results = []
+    for size in sizes:
+        master_df, raw_df = make_frames(size)
+        baseline_s, expected = _best_time(baseline_map, master_df, raw_df, repeat)
+        join_s, actual = _best_time(join_map, master_df, raw_df, repeat)
+        pd.testing.assert_frame_equal(
+            actual.astype(str), expected.astype(str), check_dtype=False
+        )
+        results.append({
+            "master_rows": size,
+            "raw_rows": len(raw_df),
+            "baseline_seconds": round(baseline_s, 4),
+            "join_seconds": round(join_s, 4),
+            "speedup": round(baseline_s / join_s, 2),
+        })
+        print(f"{size:>10,} master rows: map() {baseline_s:8.3f}s   join {join_s:8.3f}s   "
+              f"x{baseline_s / join_s:.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
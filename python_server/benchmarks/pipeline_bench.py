@@ -0,0 +1,238 @@
+"""
+Stage-by-stage benchmark of the mapping pipeline on synthetic workbooks.
+
+Generates raw/master workbooks (see benchmarks.generator) and times each
+stage of run_pipeline_api separately: read master, read raw, parse, clean,
+map, new-student append, write, and unmapped append. It also records the
+peak memory after each stage and finishes with one end-to-end
+run_pipeline_api call. Results are printed and can be written as JSON and
+compared with a previous run.
+
+Run from python_server/:
+    python -m benchmarks.pipeline_bench --master-rows 20000 --raw-rows 100000 --output bench.json
+    python -m benchmarks.pipeline_bench --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.generator import generate
+from pipeline.master_cache import _normalize_master
+from pipeline.pp import (
+    RAW_SKIPFOOTER, RAW_SKIPROWS, _clean_raw_records, _concat_records, _merge_raw_records,
+    _new_student_rows, _parse_raw_frame, run_pipeline_api,
+)
+from pipeline.reader import RawSheetStream, excel_engine, read_master_file
+from pipeline.records import UnmappedRows
+from pipeline.writer import write_mapped_workbook
+
+STAGES = [
+    "read_master", "read_raw", "parse", "clean", "map",
+    "new_students", "write", "unmapped_append",
+]
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageRecorder:
+    """Collects seconds and peak memory per stage."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def add(self, name, seconds, traced_peak=None):
+        stage = self.stages.setdefault(name, {"seconds": 0.0})
+        stage["seconds"] = round(stage["seconds"] + seconds, 4)
+        stage["peak_rss_mb"] = _peak_rss_mb()
+        if traced_peak is not None:
+            stage["traced_peak_mb"] = max(stage.get("traced_peak_mb", 0), round(traced_peak / 2**20, 1))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            traced_peak = None
+            if self.trace_memory:
+                traced_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.add(name, seconds, traced_peak)
+
+
+def run_stages(raw_path, master_path, out_dir, recorder):
+    """Runs the pipeline steps one by one under the recorder. Returns row counts."""
+    with recorder.stage("read_master"):
+        master_df = _normalize_master(read_master_file(master_path))
+
+    # Reading and parsing are interleaved chunk by chunk, as in the pipeline
+    stream = RawSheetStream(raw_path, skiprows=RAW_SKIPROWS, skipfooter=RAW_SKIPFOOTER)
+    parts, unmapped_data_list, header_map = [], UnmappedRows(), {}
+    parse_seconds = 0.0
+    with recorder.stage("read_raw"):
+        for row_offset, chunk in stream:
+            start = time.perf_counter()
+            part, unmapped, unmapped_blanks, header_map = _parse_raw_frame(chunk, row_offset, header_map)
+            if not part.empty:
+                parts.append(part)
+            unmapped_data_list.append_cells(unmapped, unmapped_blanks)
+            parse_seconds += time.perf_counter() - start
+        raw_df = _concat_records(parts)
+        unmapped_data_list.pad_to(stream.max_width)
+    recorder.stages["read_raw"]["seconds"] = round(recorder.stages["read_raw"]["seconds"] - parse_seconds, 4)
+    recorder.add("parse", parse_seconds)
+    parsed_rows = len(raw_df)
+
+    with recorder.stage("clean"):
+        unnamed_col_name = master_df.columns[4]
+        raw_df = _clean_raw_records(raw_df)
+
+    with recorder.stage("map"):
+        master_df, new_students_df = _merge_raw_records(master_df, raw_df)
+
+    with recorder.stage("new_students"):
+        new_rows_df = _new_student_rows(master_df.columns, new_students_df, unnamed_col_name)
+        if new_rows_df is not None:
+            master_df = pd.concat([master_df, new_rows_df], ignore_index=True)
+
+    # The writer emits both blocks in one pass; the unmapped append is the
+    # extra time a full write takes over writing the mapped rows alone
+    output_filename = os.path.join(out_dir, "mapped.xlsx")
+    with recorder.stage("write"):
+        write_mapped_workbook(output_filename, master_df, [])
+    with recorder.stage("unmapped_append"):
+        write_mapped_workbook(output_filename, master_df, unmapped_data_list)
+    full_write = recorder.stages["unmapped_append"]["seconds"]
+    recorder.stages["unmapped_append"]["seconds"] = round(max(0.0, full_write - recorder.stages["write"]["seconds"]), 4)
+
+    return {
+        "parsed": parsed_rows,
+        "clean": len(raw_df),
+        "unmapped": len(unmapped_data_list),
+        "new_students": 0 if new_rows_df is None else len(new_rows_df),
+        "processed": len(master_df),
+        "output_bytes": os.path.getsize(output_filename),
+    }
+
+
+def run_benchmark(master_rows, raw_rows, seed=0, trace_memory=False, work_dir=None):
+    """Generates inputs, times every stage and returns the results as a dict."""
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="pipeline_bench_")
+    try:
+        start = time.perf_counter()
+        raw_path, master_path = generate(work_dir, master_rows, raw_rows, seed)
+        generate_seconds = time.perf_counter() - start
+
+        recorder = StageRecorder(trace_memory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = run_stages(raw_path, master_path, work_dir, recorder)
+            start = time.perf_counter()
+            result = run_pipeline_api(raw_path, master_path)
+            end_to_end_seconds = time.perf_counter() - start
+        if result["status"] != "success":
+            raise RuntimeError(result["message"])
+
+        return {
+            "meta": {
+                "commit": _git_commit(),
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "excel_engine": excel_engine(),
+                "master_rows": master_rows,
+                "raw_rows": raw_rows,
+                "seed": seed,
+                "raw_bytes": os.path.getsize(raw_path),
+                "master_bytes": os.path.getsize(master_path),
+                "generate_seconds": round(generate_seconds, 3),
+            },
+            "rows": rows,
+            "stages": {name: recorder.stages[name] for name in STAGES},
+            "total_seconds": round(sum(recorder.stages[name]["seconds"] for name in STAGES), 4),
+            "end_to_end_seconds": round(end_to_end_seconds, 4),
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report, baseline=None):
+    meta = report["meta"]
+    print(f"Pipeline benchmark @ {meta['commit']} ({meta['excel_engine']}): "
+          f"{meta['master_rows']:,} master rows, {meta['raw_rows']:,} raw rows")
+    for name in STAGES + ["total", "end_to_end"]:
+        if name in report["stages"]:
+            stage = report["stages"][name]
+            seconds, extra = stage["seconds"], f"peak {stage['peak_rss_mb']:8.1f} MB"
+            if "traced_peak_mb" in stage:
+                extra += f"  traced {stage['traced_peak_mb']:8.1f} MB"
+        else:
+            seconds, extra = report[f"{name}_seconds"], ""
+        line = f"  {name:<16}{seconds:9.3f}s  {extra}"
+        if baseline is not None:
+            before = (baseline["stages"].get(name, {}).get("seconds")
+                      if name in STAGES else baseline.get(f"{name}_seconds"))
+            if before:
+                line += f"  ({seconds / before:5.2f}x of {before:.3f}s)"
+        print(line)
+    print(f"  rows: {report['rows']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic workbooks.")
+    parser.add_argument("--master-rows", type=int, default=10000)
+    parser.add_argument("--raw-rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record the Python-level allocation peak of each stage (slower; "
+                             "parse is counted under read_raw)")
+    parser.add_argument("--work-dir", help="keep the generated workbooks here")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.master_rows, args.raw_rows, args.seed, args.trace_memory, args.work_dir)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
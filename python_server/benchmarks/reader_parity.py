@@ -0,0 +1,190 @@
+"""
+Parity check for the raw sheet reader.
+
+Writes workbooks full of the cells the two read paths disagree on when
+left alone (whitespace-only text, error values, NA text, booleans next to
+0/1, columns of only numbers, dates or durations, ragged rows) and checks
+that _read_raw_records gives the same records and unmapped rows as the
+pipeline did with pd.read_excel(engine='openpyxl'), once through calamine
+and once through openpyxl. Every workbook is also checked with its text
+moved to a shared strings table, the way Excel writes it (openpyxl writes
+inline strings), and each of those with the cell reference (r) of every
+cell moved behind its other attributes or left out, as other writers may.
+
+Exits non-zero on the first mismatching workbook.
+
+Run from python_server/:
+    python -m benchmarks.reader_parity
+    python -m benchmarks.reader_parity --workbooks 500 --seed 3
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import zipfile
+
+import pandas as pd
+from openpyxl import Workbook
+
+import pipeline.reader as reader
+from pipeline.pp import RAW_SKIPFOOTER, RAW_SKIPROWS, _parse_raw_frame, _read_raw_records
+
+HEADER = ["Category Name", "Enrollment No", "Amount", "Status", "Name of Student",
+          "Transaction Date", "Bank Reference No"]
+CELLS = [
+    None, "", " ", "  ", "\t", "NA", "nan", "None", "#N/A", "#DIV/0!", "x", " y ",
+    True, False, 0, 1, 2, -1, 2.5, "3000", "0300", "2.5", " 7 ",
+    210000000001, "210000000001", 2.1e11, "2.10000000001E+11",
+    datetime.datetime(2024, 1, 2, 3, 4), datetime.date(2024, 5, 6), datetime.time(1, 2),
+    datetime.timedelta(hours=5),
+]
+# Cells of a column read_excel gives its own dtype when nothing else is in it
+TYPED_CELLS = [
+    [None, 1, 2, True, False, 2.5, "7", 0],
+    [None, datetime.datetime(2024, 3, 4), datetime.datetime(2024, 3, 5, 6, 7)],
+    [None, datetime.timedelta(minutes=3), datetime.timedelta(days=1)],
+]
+
+_INLINE_CELL = re.compile(
+    r'<c r="([A-Z]+[0-9]+)"([^>]*?) t="inlineStr"><is><t(?:\s[^>]*)?>(.*?)</t></is></c>', re.S
+)
+_CELL_TAG = re.compile(rb'<c r="([A-Z]+[0-9]+)"([^>]*?)(/?)>')
+# How the cell tags of a copy are rewritten
+CELL_REFS = {
+    "reordered": lambda match: b'<c' + match[2] + b' r="' + match[1] + b'"' + match[3] + b'>',
+    "unreferenced": lambda match: b'<c' + match[2] + match[3] + b'>',
+}
+
+
+def write_workbook(path, rnd):
+    """A random raw export: preamble, header blocks, edge-case cells, footer."""
+    wb = Workbook()
+    ws = wb.active
+    width = rnd.randint(1, 8)
+    typed = {rnd.randrange(width + 2): rnd.choice(TYPED_CELLS)} if rnd.random() < 0.5 else {}
+    for _ in range(rnd.randint(0, 60)):
+        if rnd.random() < 0.1:
+            row = ["Category Name"] + rnd.sample(HEADER[1:], rnd.randint(0, 6))
+        else:
+            row = [rnd.choice(CELLS) for _ in range(rnd.randint(0, width))]
+        for column, cells in typed.items():
+            row += [None] * (column + 1 - len(row))
+            row[column] = rnd.choice(cells) if rnd.random() < 0.5 else None
+        ws.append(row)
+    wb.save(path)
+
+
+def _rewrite_sheet(src, dst, rewrite):
+    """Copy of src with rewrite(data) applied to its sheet XML."""
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            data = zin.read(item.filename)
+            if item.filename == "xl/worksheets/sheet1.xml":
+                data = rewrite(data)
+            zout.writestr(item, data)
+
+
+def to_cell_refs(src, dst, refs):
+    """Copy of src with the r attribute of its cells rewritten as CELL_REFS[refs] says."""
+    _rewrite_sheet(src, dst, lambda data: _CELL_TAG.sub(CELL_REFS[refs], data))
+
+
+def to_shared_strings(src, dst):
+    """Copy of src with its inline strings moved to xl/sharedStrings.xml."""
+    strings = {}
+
+    def shared(match):
+        index = strings.setdefault(match[3], len(strings))
+        return f'<c r="{match[1]}"{match[2]} t="s"><v>{index}</v></c>'
+
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            data = zin.read(item.filename)
+            if item.filename == "xl/worksheets/sheet1.xml":
+                data = _INLINE_CELL.sub(shared, data.decode()).encode()
+            elif item.filename == "[Content_Types].xml":
+                data = data.replace(b"</Types>", b'<Override PartName="/xl/sharedStrings.xml" ContentType='
+                                    b'"application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+                                    b"</Types>")
+            elif item.filename == "xl/_rels/workbook.xml.rels":
+                data = data.replace(b"</Relationships>", b'<Relationship Id="rIdSharedStrings" Type='
+                                    b'"http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"'
+                                    b' Target="sharedStrings.xml"/></Relationships>')
+            zout.writestr(item, data)
+        items = "".join(f'<si><t xml:space="preserve">{text}</t></si>' for text in strings)
+        zout.writestr("xl/sharedStrings.xml",
+                      '<?xml version="1.0" encoding="UTF-8"?><sst xmlns='
+                      f'"http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{len(strings)}"'
+                      f' uniqueCount="{len(strings)}">{items}</sst>')
+
+
+def baseline_records(path):
+    """(records, unmapped rows) the way the pipeline read them with read_excel."""
+    raw_df_unparsed = pd.read_excel(path, skiprows=RAW_SKIPROWS, skipfooter=RAW_SKIPFOOTER,
+                                    header=None, engine='openpyxl')
+    raw_df, unmapped_data_list, _, _ = _parse_raw_frame(raw_df_unparsed)
+    return raw_df, [list(row) for row in unmapped_data_list]
+
+
+def mismatches(path):
+    """Names of the read paths whose output differs from baseline_records."""
+    try:
+        expected_df, expected_rows = baseline_records(path)
+    except ValueError:
+        # read_excel refuses sheets shorter than the preamble and footer
+        return []
+    calamine, failed = reader.python_calamine, []
+    try:
+        for name, module in (("calamine", calamine), ("openpyxl", None)):
+            if name == "calamine" and calamine is None:
+                continue
+            reader.python_calamine = module
+            raw_df, unmapped_data_list = _read_raw_records(path)
+            same_records = (expected_df.empty and raw_df.empty) or \
+                expected_df.astype(object).equals(raw_df.astype(object))
+            if not same_records or expected_rows != [list(row) for row in unmapped_data_list]:
+                failed.append(name)
+    finally:
+        reader.python_calamine = calamine
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the raw reader against read_excel.")
+    parser.add_argument("--workbooks", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if reader.python_calamine is None:
+        print("python-calamine is not installed; only the openpyxl path is checked")
+
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        inline_path = os.path.join(tmp, "inline.xlsx")
+        shared_path = os.path.join(tmp, "shared.xlsx")
+        for number in range(args.workbooks):
+            write_workbook(inline_path, rnd)
+            to_shared_strings(inline_path, shared_path)
+            paths = [inline_path, shared_path]
+            for path in (inline_path, shared_path):
+                for refs in CELL_REFS:
+                    paths.append(os.path.join(tmp, f"{refs}_{os.path.basename(path)}"))
+                    to_cell_refs(path, paths[-1], refs)
+            for path in paths:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    failed = mismatches(path)
+                if failed:
+                    kept = os.path.join(tempfile.gettempdir(), f"reader_parity_{number}.xlsx")
+                    os.replace(path, kept)
+                    print(f"Workbook {number}: {', '.join(failed)} differ from read_excel (kept at {kept})")
+                    sys.exit(1)
+    print(f"{args.workbooks} workbooks (inline and shared strings, cell references as written, "
+          f"{' and '.join(CELL_REFS)}): all read paths match read_excel")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Startup profile of the web app: how long `import app` takes in a fresh
+interpreter, which imports dominate it, and whether the pipeline engine
+was pulled in. Workers and health checks wait on this import, so it has a
+budget; the script exits with status 1 when the median import time is
+over it or a heavy module is loaded at import.
+
+Run from python_server/:
+    python -m benchmarks.startup_bench
+    python -m benchmarks.startup_bench --budget-ms 300 --runs 7 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules the web layer must only load on first use (see pipeline.jobs.warm_pipeline)
+HEAVY_MODULES = ["pandas", "numpy", "openpyxl", "python_calamine", "pyarrow", "pipeline.pp"]
+DEFAULT_BUDGET_MS = 400
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import app
+print(round((time.perf_counter() - start) * 1000, 1))
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_probe():
+    """(milliseconds, heavy modules loaded) of one `import app` in a new interpreter."""
+    output = subprocess.check_output(
+        [sys.executable, "-c", _PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=SERVER_DIR, text=True, stderr=subprocess.DEVNULL,
+    ).splitlines()
+    heavy = [name for name in output[-1].split(",") if name]
+    return float(output[-2]), heavy
+
+
+def import_profile(top=10):
+    """The `top` slowest imports (cumulative microseconds, module) per -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=SERVER_DIR, text=True, capture_output=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), module.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def run_startup_bench(runs=5, budget_ms=DEFAULT_BUDGET_MS, top=10):
+    """Prints the profile and returns True if startup is within budget."""
+    samples, heavy = [], set()
+    for _ in range(runs):
+        ms, loaded = _run_probe()
+        samples.append(ms)
+        heavy.update(loaded)
+    median = statistics.median(samples)
+
+    print(f"import app: median {median:.1f} ms over {runs} runs "
+          f"(min {min(samples):.1f}, max {max(samples):.1f}, budget {budget_ms} ms)")
+    print("Slowest imports (cumulative, includes -X importtime overhead):")
+    for cumulative, module in import_profile(top):
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    ok = median <= budget_ms and not heavy
+    if heavy:
+        print(f"FAIL: loaded at import: {', '.join(sorted(heavy))}")
+    if median > budget_ms:
+        print(f"FAIL: import time over budget by {median - budget_ms:.1f} ms")
+    if ok:
+        print("OK")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile and check the web app's import time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+    sys.exit(0 if run_startup_bench(args.runs, args.budget_ms, args.top) else 1)
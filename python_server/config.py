@@ -6,19 +6,96 @@ import tempfile
 TEMP_DIR = tempfile.gettempdir()
 DATA_FOLDER = os.path.join(TEMP_DIR, "student_data_processing")
 
-# Create the data folder if it doesn't exist
-os.makedirs(DATA_FOLDER, exist_ok=True)
+# Every upload/run happens in its own workspace folder under here, so
+# concurrent runs never share files
+WORKSPACES_FOLDER = os.path.join(DATA_FOLDER, "workspaces")
 
-RAW_DATA_PATH = os.path.join(DATA_FOLDER, "raw_data.xlsx")
-MASTER_FILE_PATH = os.path.join(DATA_FOLDER, "master_file.xlsx")
-MAPPED_FILE_PATH = os.path.join(DATA_FOLDER, "mapped.xlsx")
+# Create the data folders if they don't exist
+os.makedirs(WORKSPACES_FOLDER, exist_ok=True)
+
+RAW_DATA_FILENAME = "raw_data.xlsx"
+MASTER_FILE_FILENAME = "master_file.xlsx"
+MAPPED_FILE_FILENAME = "mapped.xlsx"
+# Runs write this format unless asked for another; the xlsx workbook is
+# built from the run's saved frames the first time it is downloaded
+DEFAULT_OUTPUT_FORMAT = os.getenv("DEFAULT_OUTPUT_FORMAT", "csv")
+# Internal files of a workspace start with a dot, so /list_files leaves them out
+INCREMENTAL_STATE_FILENAME = ".incremental_state.pkl"
+# Frames of the last run, kept for on-demand conversion to the other formats
+MAPPED_RESULT_FILENAME = ".mapped_result.pkl"
+# Ledger rows of the last run, upserted into the fee ledger (see ledger.py)
+LEDGER_ROWS_FILENAME = ".ledger_rows.sqlite3"
+# Columnar copy of the last run's mapped rows, queried by GET /mapped
+MAPPED_SNAPSHOT_FILENAME = ".mapped_snapshot"
+
+# Workspaces unused for this long are deleted by the janitor
+WORKSPACE_TTL_SECONDS = int(os.getenv("WORKSPACE_TTL_SECONDS", 6 * 60 * 60))
+JANITOR_INTERVAL_SECONDS = int(os.getenv("JANITOR_INTERVAL_SECONDS", 10 * 60))
 
 # Maximum file size (e.g., 16MB)
 MAX_FILE_SIZE = 16 * 1024 * 1024
 
-print(f"--- Python Config (Production Ready) ---")
-print(f"Data folder: {DATA_FOLDER}")
-print(f"Raw data path: {RAW_DATA_PATH}")
-print(f"Master file path: {MASTER_FILE_PATH}")
-print(f"Mapped file path: {MAPPED_FILE_PATH}")
-print(f"----------------------------------------")
+# Uploads are streamed to disk in blocks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Downloads: let nginx (X-Accel-Redirect to this internal location, which
+# must alias DATA_FOLDER) or Apache/lighttpd (X-Sendfile) stream files, and
+# keep gzip/zstd copies of pipeline output (worth it for csv and ndjson;
+# xlsx is already compressed). Pre-compression is off by default.
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "")
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "False").lower() == "true"
+PRECOMPRESS_DOWNLOADS = os.getenv("PRECOMPRESS_DOWNLOADS", "False").lower() == "true"
+
+# Parsed master files, keyed by content hash (bounded LRU on disk + in memory)
+MASTER_CACHE_FOLDER = os.path.join(DATA_FOLDER, "master_cache")
+MASTER_CACHE_MAX_ENTRIES = int(os.getenv("MASTER_CACHE_MAX_ENTRIES", 32))
+MASTER_CACHE_MEMORY_ENTRIES = int(os.getenv("MASTER_CACHE_MEMORY_ENTRIES", 4))
+
+# Results of finished runs, keyed by the content hashes of their inputs, so
+# an unchanged re-run is answered from here (least recently used evicted)
+RESULT_CACHE_FOLDER = os.path.join(DATA_FOLDER, "result_cache")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 512))
+
+# Background pipeline jobs: state is kept in SQLite so it survives worker restarts
+JOBS_DB_PATH = os.path.join(DATA_FOLDER, "jobs.sqlite3")
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 2))
+
+# Admission control, shared by all web workers through the jobs database:
+# at most MAX_CONCURRENT_RUNS runs at once, and only while their estimated
+# memory (RUN_MEMORY_PER_INPUT_BYTE times the size of their input files)
+# fits in RUN_MEMORY_BUDGET_MB. Once MAX_QUEUED_RUNS runs are waiting,
+# /run_pipeline answers 503 with Retry-After.
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", 2))
+MAX_QUEUED_RUNS = int(os.getenv("MAX_QUEUED_RUNS", 8))
+RUN_MEMORY_BUDGET_MB = int(os.getenv("RUN_MEMORY_BUDGET_MB", 1024))
+RUN_MEMORY_PER_INPUT_BYTE = int(os.getenv("RUN_MEMORY_PER_INPUT_BYTE", 32))
+SCHEDULER_POLL_SECONDS = 0.25
+
+# Batch runs: inputs are kept in this workspace subfolder, and the raw
+# files/sheets of one run are parsed by up to this many processes
+BATCH_FOLDER_NAME = "batch"
+BATCH_PARSE_WORKERS = int(os.getenv("BATCH_PARSE_WORKERS", 4))
+
+# Prometheus metrics, shared by all web workers and pipeline processes
+METRICS_DB_PATH = os.path.join(DATA_FOLDER, "metrics.sqlite3")
+
+# GET /mapped: page size (default and cap), and how many snapshots each
+# process keeps open with their dictionaries parsed
+MAPPED_QUERY_DEFAULT_LIMIT = 100
+MAPPED_QUERY_MAX_LIMIT = int(os.getenv("MAPPED_QUERY_MAX_LIMIT", 1000))
+MAPPED_SNAPSHOT_MEMORY_ENTRIES = int(os.getenv("MAPPED_SNAPSHOT_MEMORY_ENTRIES", 8))
+
+# Fee ledger: latest mapped row per enrollment number, upserted by every run
+# and read by /students (at most LEDGER_LOOKUP_MAX_ERNOS per batch lookup)
+LEDGER_DB_PATH = os.path.join(DATA_FOLDER, "ledger.sqlite3")
+LEDGER_LOOKUP_MAX_ERNOS = int(os.getenv("LEDGER_LOOKUP_MAX_ERNOS", 10000))
+
+
+def print_config():
+    """Startup banner, printed once by the server entry point (not on import)."""
+    print(f"--- Python Config (Production Ready) ---")
+    print(f"Data folder: {DATA_FOLDER}")
+    print(f"Workspaces folder: {WORKSPACES_FOLDER} (TTL {WORKSPACE_TTL_SECONDS}s)")
+    print(f"Jobs database: {JOBS_DB_PATH} ({PIPELINE_WORKERS} pipeline workers)")
+    print(f"Fee ledger: {LEDGER_DB_PATH}")
+    print(f"----------------------------------------")
@@ -0,0 +1,155 @@
+import gzip
+import json
+import mimetypes
+import os
+import shutil
+import uuid
+
+from flask import current_app, request, send_file
+
+from config import DATA_FOLDER, PRECOMPRESS_DOWNLOADS, X_ACCEL_REDIRECT_PREFIX
+from hashing import file_sha256
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd variants are skipped without it
+    zstandard = None
+
+# Content hashes and pre-compressed copies of a file live in a hidden
+# folder next to it, so they never show up in /list_files
+DOWNLOAD_CACHE_SUBFOLDER = ".downloads"
+
+mimetypes.add_type("application/x-ndjson", ".ndjson")
+mimetypes.add_type("application/vnd.apache.parquet", ".parquet")
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODING_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def _cache_dir(path):
+    return os.path.join(os.path.dirname(path), DOWNLOAD_CACHE_SUBFOLDER)
+
+
+def _hash_sidecar(path):
+    return os.path.join(_cache_dir(path), f"{os.path.basename(path)}.sha256")
+
+
+def _variant_path(path, digest, encoding):
+    return os.path.join(_cache_dir(path), f"{os.path.basename(path)}.{digest[:16]}{ENCODING_SUFFIXES[encoding]}")
+
+
+def _write_atomically(dest_path, write):
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def content_hash(path):
+    """
+    SHA-256 of a file, remembered in a sidecar keyed by the file's size and
+    mtime so repeat downloads don't re-read it.
+    """
+    stat = os.stat(path)
+    sidecar = _hash_sidecar(path)
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = file_sha256(path)
+    os.makedirs(_cache_dir(path), exist_ok=True)
+    record = json.dumps({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}).encode()
+    _write_atomically(sidecar, lambda f: f.write(record))
+    return digest
+
+
+def _available_encodings():
+    return [encoding for encoding in ENCODING_SUFFIXES if encoding != "zstd" or zstandard is not None]
+
+
+def prepare_download(path, precompress=PRECOMPRESS_DOWNLOADS):
+    """
+    Records the content hash of a freshly written file and, if enabled,
+    writes its gzip/zstd variants (replacing those of older contents).
+    Returns the hash.
+    """
+    digest = content_hash(path)
+    if not precompress:
+        return digest
+
+    cache_dir = _cache_dir(path)
+    prefix = f"{os.path.basename(path)}."
+    current = {_variant_path(path, digest, encoding) for encoding in _available_encodings()}
+    for name in os.listdir(cache_dir):
+        stale = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and not name.endswith(".sha256") and stale not in current:
+            os.remove(stale)
+
+    for encoding in _available_encodings():
+        variant = _variant_path(path, digest, encoding)
+        if os.path.exists(variant):
+            continue
+        with open(path, "rb") as src:
+            if encoding == "gzip":
+                _write_atomically(variant, lambda f: _gzip_copy(src, f))
+            else:
+                _write_atomically(variant, lambda f: zstandard.ZstdCompressor().copy_stream(src, f))
+    return digest
+
+
+def _gzip_copy(src, dest):
+    # mtime=0 keeps the variant byte-identical for identical content
+    with gzip.GzipFile(fileobj=dest, mode="wb", mtime=0) as gz:
+        shutil.copyfileobj(src, gz)
+
+
+def _pick_variant(path, digest):
+    """(path to send, Content-Encoding or None) for the current request."""
+    for encoding in _available_encodings():
+        variant = _variant_path(path, digest, encoding)
+        if request.accept_encodings[encoding] and os.path.exists(variant):
+            return variant, encoding
+    return path, None
+
+
+def send_download(path, download_name=None):
+    """
+    Sends a workspace file as an attachment with a strong ETag derived from
+    its content hash. If-None-Match gets a 304 and Range requests a 206.
+    A pre-compressed variant is used when the client accepts it. With
+    X_ACCEL_REDIRECT_PREFIX set, nginx streams the file itself; with
+    USE_X_SENDFILE, the front server does.
+    """
+    digest = content_hash(path)
+    serve_path, encoding = _pick_variant(path, digest)
+    etag = digest if encoding is None else f"{digest}-{encoding}"
+    download_name = download_name or os.path.basename(path)
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + os.path.relpath(serve_path, DATA_FOLDER)
+        response.headers.set("Content-Disposition", "attachment", filename=download_name)
+        response.set_etag(etag)
+        # nginx serves the body and its ranges; only the 304 is decided here
+        response = response.make_conditional(request.environ)
+    else:
+        response = send_file(
+            serve_path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+            etag=etag, conditional=True,
+        )
+
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    # Clients may keep the file but must revalidate, which costs a 304
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,26 @@
+# Production entry point. From python_server/:
+#     gunicorn app:app
+# (gunicorn reads this file from the working directory automatically)
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+
+# Import the app once in the master and fork the workers from it, so they
+# start instantly and share its memory copy-on-write
+preload_app = True
+
+# Also load the pipeline engine (pandas, openpyxl) before forking. Off,
+# it is loaded by each worker on its first /run_pipeline call instead,
+# which lets the master come up faster.
+PRELOAD_PIPELINE = os.getenv("PRELOAD_PIPELINE", "True").lower() == "true"
+
+
+def when_ready(server):
+    from config import print_config
+    from pipeline.jobs import warm_pipeline
+
+    print_config()
+    if PRELOAD_PIPELINE:
+        warm_pipeline()
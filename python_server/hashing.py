@@ -0,0 +1,22 @@
+import hashlib
+import os
+
+# Standard library only: imported by the web layer, which must start
+# without loading the pipeline engine
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(source):
+    """SHA-256 hex digest of a file path or a binary file object (read from its start)."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    else:
+        source.seek(0)
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        source.seek(0)
+    return digest.hexdigest()
@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+from config import LEDGER_DB_PATH
+
+# The fee ledger: the latest mapped row of every enrollment number, kept in
+# SQLite (indexed by erno) so "has X paid?" is answered without a pipeline
+# run or opening mapped.xlsx. Every successful run upserts its rows.
+
+# Columns of the mapped output kept per student, erno first
+LEDGER_COLUMNS = ['erno', 'NAME', 'AMOUNT', 'epaymerchantorderno', 'TYPE', 'FEES', 'modifydate', 'sem', 'br_code']
+
+_COLUMN_LIST = ", ".join(LEDGER_COLUMNS)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS students (
+    {LEDGER_COLUMNS[0]} TEXT PRIMARY KEY,
+    {", ".join(LEDGER_COLUMNS[1:])},
+    updated_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+# A run's rows are first written to a file of their own (see write_run_rows),
+# with the time of the run, then upserted from it in one statement; a result
+# cache hit replays the file
+_RUN_ROWS_SCHEMA = [
+    f"CREATE TABLE rows ({_COLUMN_LIST})",
+    "CREATE TABLE run (ran_at REAL NOT NULL)",
+]
+
+
+def _has_transaction(table):
+    """SQL condition: the row carries a transaction (students without one get the "Not Paid" defaults)."""
+    return f"(coalesce({table}.epaymerchantorderno, '') <> '' OR coalesce({table}.modifydate, '') <> '')"
+
+
+# An entry is only replaced by a row of a run at least as recent (so a
+# replayed older run can't undo a newer one), and never by a row without a
+# transaction while it has one (a student missing from one export stays Paid)
+_UPSERT = (
+    f"INSERT INTO students ({_COLUMN_LIST}, updated_at) "
+    f"SELECT {_COLUMN_LIST}, (SELECT ran_at FROM run.run) FROM run.rows WHERE true "
+    f"ON CONFLICT (erno) DO UPDATE SET "
+    + ", ".join(f"{column} = excluded.{column}" for column in LEDGER_COLUMNS[1:] + ['updated_at'])
+    + " WHERE excluded.updated_at >= students.updated_at"
+    f" AND ({_has_transaction('excluded')} OR NOT {_has_transaction('students')})"
+)
+
+
+@contextmanager
+def _connect(db_path=LEDGER_DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_SCHEMA)
+        yield conn
+    finally:
+        conn.close()
+
+
+def write_run_rows(path, rows, ran_at=None):
+    """
+    Writes one run's ledger rows (tuples in LEDGER_COLUMNS order) and the
+    time of the run (ran_at, default now) to a standalone SQLite file at
+    path, replacing it atomically.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            # A scratch file rebuilt from scratch: no journal needed
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            for statement in _RUN_ROWS_SCHEMA:
+                conn.execute(statement)
+            with conn:
+                conn.execute("INSERT INTO run VALUES (?)", (time.time() if ran_at is None else ran_at,))
+                conn.executemany(f"INSERT INTO rows VALUES ({', '.join('?' * len(LEDGER_COLUMNS))})", rows)
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def apply_run_rows(path):
+    """
+    Upserts the rows of a write_run_rows file into the ledger (later rows of
+    the same erno win), leaving alone entries of a more recent run and
+    entries with a transaction the run has none for (see _UPSERT). Returns
+    the number of rows applied.
+    """
+    with _connect() as conn:
+        conn.execute("ATTACH DATABASE ? AS run", (path,))
+        with conn:
+            applied = conn.execute(_UPSERT).rowcount
+        conn.execute("DETACH DATABASE run")
+    return applied
+
+
+def _record(columns, row):
+    return dict(zip(columns, row))
+
+
+def get_student(erno):
+    """The ledger entry of one enrollment number, or None."""
+    with _connect() as conn:
+        cursor = conn.execute(f"SELECT {_COLUMN_LIST}, updated_at FROM students WHERE erno = ?", (erno,))
+        row = cursor.fetchone()
+        return _record([d[0] for d in cursor.description], row) if row else None
+
+
+def get_students(ernos):
+    """{erno: ledger entry} for those of the given enrollment numbers that are in the ledger."""
+    with _connect() as conn:
+        # One parameter however many ernos are asked for (no SQLite variable limit)
+        cursor = conn.execute(
+            f"SELECT {_COLUMN_LIST}, updated_at FROM students WHERE erno IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(ernos)),),
+        )
+        columns = [d[0] for d in cursor.description]
+        return {row[0]: _record(columns, row) for row in cursor}
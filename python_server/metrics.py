@@ -0,0 +1,166 @@
+import sqlite3
+from contextlib import contextmanager
+
+from config import METRICS_DB_PATH
+
+# Metrics are kept in SQLite rather than in memory so that every gunicorn
+# worker and pipeline pool process adds to the same numbers.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(2 ** power for power in range(10, 27, 2))  # 1KB .. 64MB, in steps of 4x
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "pipeline_runs_total": ("counter", "Pipeline runs by outcome.", None),
+    "pipeline_stage_duration_seconds": ("histogram", "Time spent in each pipeline stage.", LATENCY_BUCKETS),
+    "pipeline_duration_seconds": ("histogram", "Total time of successful pipeline runs.", LATENCY_BUCKETS),
+    "pipeline_rows_total": ("counter", "Rows handled by successful pipeline runs, by kind.", None),
+    "pipeline_file_bytes": ("histogram", "Size of pipeline input and output files.", BYTES_BUCKETS),
+    "http_request_duration_seconds": ("histogram", "Latency of upload and download requests.", LATENCY_BUCKETS),
+    "pipeline_result_cache_total": ("counter", "Result cache lookups of /run_pipeline, by outcome.", None),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+)
+"""
+
+
+@contextmanager
+def _connect(db_path=METRICS_DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=5)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_SCHEMA)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _format_labels(labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _bucket_labels(labels, bound):
+    """Label string of one histogram bucket: the series labels plus le."""
+    le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)!r}"'
+    return f"{labels},{le}" if labels else le
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _add_samples(samples):
+    """Adds each (name, labels, amount) to its stored value in one transaction."""
+    try:
+        with _connect() as conn:
+            conn.executemany(
+                "INSERT INTO samples (name, labels, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                samples,
+            )
+    except sqlite3.Error as e:
+        # Metrics must never break a request or a pipeline run
+        print(f"Warning: Could not record metrics: {e}")
+
+
+def _histogram_samples(name, value, labels):
+    """Samples for one histogram observation: its bucket, _sum and _count."""
+    bound = next((b for b in METRICS[name][2] if value <= b), float("inf"))
+    series = _format_labels(labels)
+    return [
+        (f"{name}_bucket", _bucket_labels(series, bound), 1),
+        (f"{name}_sum", series, value),
+        (f"{name}_count", series, 1),
+    ]
+
+
+def observe(name, value, **labels):
+    """Records one observation of a histogram."""
+    _add_samples(_histogram_samples(name, value, labels))
+
+
+def record_pipeline_run(result):
+    """Exports the outcome and the "metrics" of a run_pipeline_api result."""
+    samples = [("pipeline_runs_total", _format_labels({"status": result.get("status", "error")}), 1)]
+    run_metrics = result.get("metrics")
+    if run_metrics:
+        for stage, seconds in run_metrics["stages"].items():
+            samples += _histogram_samples("pipeline_stage_duration_seconds", seconds, {"stage": stage})
+        samples += _histogram_samples("pipeline_duration_seconds", run_metrics["total_seconds"], {})
+        for kind, count in run_metrics["rows"].items():
+            samples.append(("pipeline_rows_total", _format_labels({"kind": kind}), count))
+        for kind, size in run_metrics["bytes"].items():
+            samples += _histogram_samples("pipeline_file_bytes", size, {"file": kind})
+    _add_samples(samples)
+
+
+def record_request(route, method, status, seconds):
+    observe("http_request_duration_seconds", seconds, route=route, method=method, status=str(status))
+
+
+def record_result_cache(hit):
+    _add_samples([("pipeline_result_cache_total", _format_labels({"result": "hit" if hit else "miss"}), 1)])
+
+
+def result_cache_counts():
+    """Result cache lookups so far, as {"hits": n, "misses": n}."""
+    counts = {"hits": 0, "misses": 0}
+    try:
+        with _connect() as conn:
+            rows = conn.execute(
+                "SELECT labels, value FROM samples WHERE name = ?", ("pipeline_result_cache_total",)
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Warning: Could not read metrics: {e}")
+        return counts
+    for labels, value in rows:
+        counts["hits" if labels == _format_labels({"result": "hit"}) else "misses"] += int(value)
+    return counts
+
+
+def render_prometheus():
+    """All recorded metrics in the Prometheus text exposition format."""
+    try:
+        with _connect() as conn:
+            rows = conn.execute("SELECT name, labels, value FROM samples").fetchall()
+    except sqlite3.Error as e:
+        print(f"Warning: Could not read metrics: {e}")
+        rows = []
+
+    stored = {}
+    for name, labels, value in rows:
+        stored.setdefault(name, {})[labels] = value
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for labels, value in sorted(stored.get(name, {}).items()):
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}{suffix} {_format_value(value)}")
+            continue
+
+        # Buckets are stored per bucket and made cumulative here
+        bucket_counts = stored.get(f"{name}_bucket", {})
+        for labels, total in sorted(stored.get(f"{name}_sum", {}).items()):
+            cumulative = 0
+            for bound in buckets + (float("inf"),):
+                bucket_labels = _bucket_labels(labels, bound)
+                cumulative += bucket_counts.get(bucket_labels, 0)
+                lines.append(f"{name}_bucket{{{bucket_labels}}} {_format_value(cumulative)}")
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {_format_value(total)}")
+            lines.append(f"{name}_count{suffix} {_format_value(stored[f'{name}_count'][labels])}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,85 @@
+import os
+import pickle
+import uuid
+
+import pandas as pd
+
+# Bump when the saved state layout changes so old state files are ignored
+STATE_VERSION = 2
+
+_MISSING_REFERENCES = {'', 'nan', 'None'}
+
+
+def transaction_fingerprints(raw_df):
+    """
+    One identity string per parsed raw row: the Bank Reference No when the
+    row has one, otherwise a hash of the whole row.
+    """
+    if raw_df.empty:
+        return pd.Series([], dtype=object)
+
+    hashed = pd.util.hash_pandas_object(raw_df[sorted(raw_df.columns)].astype(str), index=False)
+    fingerprints = 'row:' + hashed.astype(str)
+    if 'Bank Reference No' in raw_df.columns:
+        refs = raw_df['Bank Reference No'].astype(str).str.strip()
+        has_ref = ~refs.isin(_MISSING_REFERENCES)
+        fingerprints = fingerprints.where(~has_ref, 'ref:' + refs)
+    return fingerprints.astype(object).reset_index(drop=True)
+
+
+def load_incremental_state(state_path, master_hash):
+    """
+    State saved by the previous incremental run, or None when there is none
+    or it was built from a different master file.
+    """
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, "rb") as f:
+            state = pickle.load(f)
+    except Exception as e:
+        print(f"Warning: Ignoring unreadable incremental state {state_path}: {e}")
+        return None
+    if state.get("version") != STATE_VERSION or state.get("master_hash") != master_hash:
+        print("Incremental state is stale (master file or format changed), doing a full run.")
+        return None
+    return state
+
+
+def save_incremental_state(state_path, master_hash, seen, resolved, mapped_master, read_position=None):
+    """
+    Saves what the next incremental run needs: the fingerprints already
+    applied, the cleaned per-student transactions, the mapped master
+    (before new students are appended) and where reading the raw file can
+    resume (see pp._read_new_raw_records; None to read it all next time).
+    """
+    state = {
+        "version": STATE_VERSION,
+        "master_hash": master_hash,
+        "seen": seen,
+        "resolved": resolved.reset_index(drop=True),
+        "mapped_master": mapped_master.copy(),
+        "read_position": read_position,
+    }
+    tmp_path = f"{state_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, state_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def merge_resolved_records(resolved, delta_df):
+    """
+    Folds newly cleaned transactions into the resolved set: a student's
+    newer transaction replaces the old one and moves to the end, the same
+    order drop_duplicates(keep='last') gives on the full file.
+    """
+    if delta_df.empty:
+        return resolved
+    if resolved.empty:
+        return delta_df.reset_index(drop=True)
+    kept = resolved[~resolved['Enrollment No'].isin(delta_df['Enrollment No'])]
+    return pd.concat([kept, delta_df], ignore_index=True)
@@ -0,0 +1,409 @@
+import json
+import math
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from config import (
+    DEFAULT_OUTPUT_FORMAT, JOBS_DB_PATH, LEDGER_ROWS_FILENAME, MAPPED_RESULT_FILENAME, MAPPED_SNAPSHOT_FILENAME, MAX_CONCURRENT_RUNS, MAX_QUEUED_RUNS, PIPELINE_WORKERS, RUN_MEMORY_BUDGET_MB,
+    RUN_MEMORY_PER_INPUT_BYTE, SCHEDULER_POLL_SECONDS,
+)
+from metrics import record_pipeline_run
+from pipeline.result_cache import store_result
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCESS = "success"
+JOB_ERROR = "error"
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+# Retry-After when no run has finished yet to estimate from
+DEFAULT_RUN_SECONDS = 30
+MAX_RETRY_AFTER_SECONDS = 300
+
+_executor = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    stage TEXT,
+    raw_path TEXT,
+    master_path TEXT,
+    output_file TEXT,
+    result TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+"""
+
+# Columns added after the first release, for databases created before them
+_ADDED_COLUMNS = {
+    "workspace": "TEXT",
+    "cost_bytes": "INTEGER NOT NULL DEFAULT 0",
+}
+_migrated_databases = set()
+
+
+class SchedulerBusy(Exception):
+    """A run was refused; status is the HTTP status and retry_after the seconds to wait."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _add_missing_columns(conn, db_path):
+    # Once per process; the write lock keeps two processes from adding a column twice
+    if db_path in _migrated_databases:
+        return
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in _ADDED_COLUMNS.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+    _migrated_databases.add(db_path)
+
+
+@contextmanager
+def _connect(db_path=JOBS_DB_PATH):
+    """Opens the jobs database, commits on success and always closes it."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_SCHEMA)
+        _add_missing_columns(conn, db_path)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _update_job(job_id, db_path=JOBS_DB_PATH, **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with _connect(db_path) as conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PIPELINE_WORKERS)
+    return _executor
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _mark_interrupted(conn, rows):
+    """
+    Fails the unfinished jobs among rows whose owning process has died
+    (e.g. a worker restart or an OOM kill) and returns the others.
+    """
+    alive = []
+    for row in rows:
+        if row["worker_pid"] and not _pid_alive(row["worker_pid"]):
+            result = {"status": "error", "message": "Job was interrupted before it finished. Please run it again."}
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                (JOB_ERROR, json.dumps(result), time.time(), row["id"]),
+            )
+        else:
+            alive.append(row)
+    return alive
+
+
+def _active_jobs(conn):
+    """Queued and running jobs, oldest first, after failing interrupted ones."""
+    rows = conn.execute(
+        "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", ACTIVE_STATUSES
+    ).fetchall()
+    return _mark_interrupted(conn, rows)
+
+
+def _average_run_seconds(conn, limit=20):
+    row = conn.execute(
+        "SELECT AVG(finished_at - started_at) FROM (SELECT finished_at, started_at FROM jobs "
+        "WHERE status = ? AND started_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+        (JOB_SUCCESS, limit),
+    ).fetchone()
+    return row[0] if row[0] is not None else DEFAULT_RUN_SECONDS
+
+
+def _retry_after(conn, active):
+    """Seconds until a run is likely to be admitted: the queue ahead, drained MAX_CONCURRENT_RUNS at a time."""
+    batches = max(1, math.ceil(len(active) / MAX_CONCURRENT_RUNS))
+    return min(MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(batches * _average_run_seconds(conn))))
+
+
+def estimate_run_cost(paths):
+    """Estimated peak memory in bytes of a run over these input files."""
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path)) * RUN_MEMORY_PER_INPUT_BYTE
+
+
+def _fits(running, cost):
+    """Whether a run of this cost may start next to the running ones."""
+    if not running:
+        # A run over the whole budget still gets to run on its own
+        return True
+    used = sum(row["cost_bytes"] for row in running)
+    return len(running) < MAX_CONCURRENT_RUNS and used + cost <= RUN_MEMORY_BUDGET_MB * 1024 * 1024
+
+
+def _wait_for_slot(job_id, db_path=JOBS_DB_PATH):
+    """
+    Blocks the pool process until the job may run: no older job is still
+    waiting and it fits next to the running ones (see _fits). Then marks it
+    running and returns True, or returns False if the job was failed
+    meanwhile.
+    """
+    while True:
+        with _connect(db_path) as conn:
+            # Taken before reading, so two workers can't admit runs at once
+            conn.execute("BEGIN IMMEDIATE")
+            active = _active_jobs(conn)
+            job = next((row for row in active if row["id"] == job_id), None)
+            if job is None:
+                return False
+            running = [row for row in active if row["status"] == JOB_RUNNING]
+            is_next = next(row for row in active if row["status"] == JOB_QUEUED)["id"] == job_id
+            if is_next and _fits(running, job["cost_bytes"]):
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = ?, started_at = ?, worker_pid = ? WHERE id = ?",
+                    (JOB_RUNNING, "starting", time.time(), os.getpid(), job_id),
+                )
+                return True
+        time.sleep(SCHEDULER_POLL_SECONDS)
+
+
+def _run_job(job_id, db_path, pipeline, kwargs, result_key=None):
+    """
+    Runs one pipeline job (run_pipeline_api or run_batch_pipeline_api with
+    kwargs) inside a pool process, recording progress in the jobs table.
+    A successful result is kept in the result cache under result_key.
+    """
+    if not _wait_for_slot(job_id, db_path):
+        return None
+
+    def report_progress(percent, stage):
+        _update_job(job_id, db_path, progress=percent, stage=stage)
+
+    try:
+        result = pipeline(progress_callback=report_progress, **kwargs)
+    except Exception as e:
+        result = {"status": "error", "message": f"Unexpected error: {e}"}
+    record_pipeline_run(result)
+    if result_key and result.get("status") == "success":
+        _cache_result(result_key, result)
+
+    if result.get("status") == "success":
+        final = {"status": JOB_SUCCESS, "stage": "done", "progress": 100}
+    else:
+        final = {"status": JOB_ERROR, "stage": "failed"}
+    _update_job(
+        job_id, db_path,
+        output_file=result.get("output_file"),
+        result=json.dumps(result, default=str),
+        finished_at=time.time(),
+        **final,
+    )
+    return result
+
+
+def _check_admission(conn, workspace):
+    """Raises SchedulerBusy if a new run for this workspace folder must be refused."""
+    active = _active_jobs(conn)
+    same_workspace = [row for row in active if row["workspace"] == workspace]
+    if same_workspace:
+        job = same_workspace[0]
+        elapsed = time.time() - (job["started_at"] or job["created_at"])
+        retry_after = max(1, math.ceil(_average_run_seconds(conn) - elapsed))
+        raise SchedulerBusy(
+            f"A pipeline run for this workspace is already {job['status']} (job {job['id']})",
+            429, min(MAX_RETRY_AFTER_SECONDS, retry_after),
+        )
+    if sum(row["status"] == JOB_QUEUED for row in active) >= MAX_QUEUED_RUNS:
+        raise SchedulerBusy("Too many pipeline runs are waiting. Please retry later.", 503,
+                            _retry_after(conn, active))
+
+
+def check_admission(workspace):
+    """
+    Raises SchedulerBusy if a run for this workspace folder would be refused
+    now, so callers can back off before touching the workspace's files.
+    Submitting checks again.
+    """
+    with _connect() as conn:
+        _check_admission(conn, workspace)
+
+
+def _cache_result(result_key, result):
+    folder = os.path.dirname(result["output_file"])
+    try:
+        extra_files = [
+            os.path.join(folder, name)
+            for name in (MAPPED_RESULT_FILENAME, LEDGER_ROWS_FILENAME, MAPPED_SNAPSHOT_FILENAME)
+        ]
+        store_result(result_key, result, folder, extra_files)
+    except OSError as e:
+        # The run itself succeeded; only the next identical run will recompute
+        print(f"Warning: Could not cache the pipeline result: {e}")
+
+
+def _submit_job(raw_path, master_path, pipeline, kwargs, workspace, cost, result_key=None):
+    """
+    Records a new job and hands it to the process pool. Returns the job id.
+    Raises SchedulerBusy (429) if the workspace already has a run queued or
+    running, and (503) if MAX_QUEUED_RUNS runs are already waiting.
+    """
+    job_id = uuid.uuid4().hex
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _check_admission(conn, workspace)
+        conn.execute(
+            "INSERT INTO jobs (id, status, stage, raw_path, master_path, worker_pid, created_at, workspace, cost_bytes) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, JOB_QUEUED, "queued", raw_path, master_path, os.getpid(), time.time(), workspace, cost),
+        )
+    _get_executor().submit(_run_job, job_id, JOBS_DB_PATH, pipeline, kwargs, result_key)
+    return job_id
+
+
+def record_cached_job(raw_path, master_path, workspace, result):
+    """Records a job answered from the result cache as already finished. Returns its id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, progress, stage, raw_path, master_path, output_file, result, "
+            "created_at, started_at, finished_at, workspace) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, JOB_SUCCESS, 100, "done", raw_path, master_path, result.get("output_file"),
+             json.dumps(result, default=str), now, now, now, workspace),
+        )
+    return job_id
+
+
+def warm_pipeline():
+    """
+    Imports the pipeline engine (pandas, numpy, openpyxl) now rather than
+    on the first job. The web layer doesn't import it at startup; call this
+    before forking workers so they all share one loaded copy.
+    """
+    start = time.perf_counter()
+    import pipeline.pp  # noqa: F401
+    print(f"Pipeline engine loaded in {time.perf_counter() - start:.2f}s")
+
+
+def submit_pipeline_job(raw_path, master_path, incremental=False, output_format=DEFAULT_OUTPUT_FORMAT,
+                        result_key=None):
+    """Queues a run_pipeline_api job. Returns the job id."""
+    from pipeline.pp import run_pipeline_api
+    kwargs = {
+        "raw_data_file_path": raw_path,
+        "master_file_path": master_path,
+        "incremental": incremental,
+        "output_format": output_format,
+    }
+    return _submit_job(raw_path, master_path, run_pipeline_api, kwargs,
+                       os.path.dirname(master_path), estimate_run_cost([raw_path, master_path]), result_key)
+
+
+def submit_batch_pipeline_job(raw_paths, master_paths, output_folder, all_sheets=False,
+                              output_format=DEFAULT_OUTPUT_FORMAT, result_key=None):
+    """Queues a run_batch_pipeline_api job. Returns the job id."""
+    from pipeline.pp import run_batch_pipeline_api
+    kwargs = {
+        "raw_data_file_paths": list(raw_paths),
+        "master_file_paths": list(master_paths),
+        "output_folder": output_folder,
+        "all_sheets": all_sheets,
+        "output_format": output_format,
+    }
+    return _submit_job(json.dumps(kwargs["raw_data_file_paths"]), json.dumps(kwargs["master_file_paths"]),
+                       run_batch_pipeline_api, kwargs, output_folder,
+                       estimate_run_cost(list(raw_paths) + list(master_paths)), result_key)
+
+
+def _job_to_dict(row):
+    created, started, finished = row["created_at"], row["started_at"], row["finished_at"]
+    now = time.time()
+    return {
+        "job_id": row["id"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "stage": row["stage"],
+        "timings": {
+            "created_at": created,
+            "started_at": started,
+            "finished_at": finished,
+            "queued_seconds": round((started or now) - created, 3),
+            "run_seconds": round((finished or now) - started, 3) if started else None,
+        },
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "output_file": row["output_file"],
+    }
+
+
+def get_job(job_id):
+    """
+    Returns the job as a dict, or None if it doesn't exist. An unfinished
+    job whose owning process has died (e.g. the worker was restarted) is
+    marked as failed. worker_pid is the submitting web worker while the job
+    is queued and the pool process once it runs. A queued job also has its
+    1-based queue_position.
+    """
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        if row["status"] in ACTIVE_STATUSES and not _mark_interrupted(conn, [row]):
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        job = _job_to_dict(row)
+        if row["status"] == JOB_QUEUED:
+            job["queue_position"] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= ?", (JOB_QUEUED, row["created_at"])
+            ).fetchone()[0]
+    return job
+
+
+def scheduler_status():
+    """Load of the run scheduler across all workers, for clients deciding whether to back off."""
+    with _connect() as conn:
+        active = _active_jobs(conn)
+        running = [row for row in active if row["status"] == JOB_RUNNING]
+        queued = [row for row in active if row["status"] == JOB_QUEUED]
+        average_wait = conn.execute(
+            "SELECT AVG(started_at - created_at) FROM (SELECT started_at, created_at FROM jobs "
+            "WHERE started_at IS NOT NULL ORDER BY started_at DESC LIMIT 20)"
+        ).fetchone()[0]
+        saturated = len(queued) >= MAX_QUEUED_RUNS
+        return {
+            "running": len(running),
+            "queued": len(queued),
+            "max_concurrent_runs": MAX_CONCURRENT_RUNS,
+            "max_queued_runs": MAX_QUEUED_RUNS,
+            "memory_budget_bytes": RUN_MEMORY_BUDGET_MB * 1024 * 1024,
+            "memory_in_use_bytes": sum(row["cost_bytes"] for row in running),
+            "oldest_wait_seconds": round(time.time() - queued[0]["created_at"], 3) if queued else 0,
+            "average_wait_seconds": round(average_wait or 0, 3),
+            "average_run_seconds": round(_average_run_seconds(conn), 3),
+            "saturated": saturated,
+            "retry_after": _retry_after(conn, active) if saturated else 0,
+        }
@@ -0,0 +1,103 @@
+import os
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+from config import MASTER_CACHE_FOLDER, MASTER_CACHE_MAX_ENTRIES, MASTER_CACHE_MEMORY_ENTRIES
+from hashing import file_sha256
+from pipeline.reader import read_master_file
+
+# Bump when the normalization below changes so old entries are ignored
+CACHE_FORMAT_VERSION = 1
+
+# In-process front tier: content hash -> normalized master DataFrame
+_memory_cache = OrderedDict()
+
+
+def _cache_path(digest):
+    return os.path.join(MASTER_CACHE_FOLDER, f"{digest}-v{CACHE_FORMAT_VERSION}.pkl")
+
+
+def _normalize_master(master_df):
+    """The per-run prep that only depends on the master file itself."""
+    if 'erno' in master_df.columns:
+        master_df['erno'] = master_df['erno'].astype(str).str.strip()
+    return master_df
+
+
+def _remember(digest, master_df):
+    _memory_cache[digest] = master_df
+    _memory_cache.move_to_end(digest)
+    while len(_memory_cache) > MASTER_CACHE_MEMORY_ENTRIES:
+        _memory_cache.popitem(last=False)
+
+
+def _evict_disk_entries():
+    """Keeps the on-disk tier to MASTER_CACHE_MAX_ENTRIES, dropping the least recently used."""
+    entries = [
+        os.path.join(MASTER_CACHE_FOLDER, name)
+        for name in os.listdir(MASTER_CACHE_FOLDER) if name.endswith(".pkl")
+    ]
+    if len(entries) <= MASTER_CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda path: os.path.getmtime(path))
+    for path in entries[:len(entries) - MASTER_CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _load_cached(digest):
+    """Normalized master for a content hash from memory or disk, or None."""
+    if digest in _memory_cache:
+        _memory_cache.move_to_end(digest)
+        return _memory_cache[digest]
+
+    path = _cache_path(digest)
+    try:
+        master_df = pd.read_pickle(path)
+        os.utime(path)
+    except Exception as e:
+        if os.path.exists(path):
+            print(f"Warning: Ignoring unreadable master cache entry {path}: {e}")
+        return None
+    _remember(digest, master_df)
+    return master_df
+
+
+def cache_master(master_file_path, digest=None):
+    """
+    Parses and stores the master file under its content hash unless it is
+    already cached. Returns (digest, hit).
+    """
+    digest = digest or file_sha256(master_file_path)
+    if _load_cached(digest) is not None:
+        return digest, True
+
+    master_df = _normalize_master(read_master_file(master_file_path))
+    os.makedirs(MASTER_CACHE_FOLDER, exist_ok=True)
+    path = _cache_path(digest)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        master_df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _remember(digest, master_df)
+    _evict_disk_entries()
+    return digest, False
+
+
+def load_master(master_file_path, digest=None):
+    """
+    Returns the normalized master DataFrame for a file, parsing it only if
+    no copy with the same content hash is cached. The caller gets its own
+    copy and may modify it.
+    """
+    digest, hit = cache_master(master_file_path, digest)
+    if hit:
+        print(f"Master file cache hit ({digest[:12]})")
+    return _load_cached(digest).copy()
@@ -1,13 +1,606 @@
+import datetime
+import numpy as np
 import pandas as pd
 import os
-from openpyxl import load_workbook 
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from config import (
+    BATCH_PARSE_WORKERS, DEFAULT_OUTPUT_FORMAT, INCREMENTAL_STATE_FILENAME, LEDGER_ROWS_FILENAME,
+    MAPPED_RESULT_FILENAME, MAPPED_SNAPSHOT_FILENAME,
+)
+from downloads import prepare_download
+from ledger import LEDGER_COLUMNS, apply_run_rows, write_run_rows
+from pipeline.incremental import (
+    load_incremental_state, merge_resolved_records, save_incremental_state, transaction_fingerprints,
+)
+from pipeline.master_cache import file_sha256, load_master
+from pipeline.reader import RawSheetStream, sheet_names
+from pipeline.records import BLANK_CELL, UnmappedRows
+from pipeline.snapshot import plain_value, write_snapshot
+from pipeline.writer import format_available, save_mapped_result, write_mapped_outputs
 
-def run_pipeline_api(raw_data_file_path, master_file_path):
+# Columns picked out of every "Category Name" header block (besides Enrollment No)
+REQUIRED_RAW_COLUMNS = [
+    'Amount', 'Bank Reference No', 'Category Name',
+    'Status', 'Name of Student', 'Transaction Date'
+]
+ENROLLMENT_HEADERS = ['Enrollment No', 'Enrollment/ACPC merit No']
+EMPTY_CELL_VALUES = ['None', '', 'nan']
+# Record columns with few distinct values, kept as categoricals
+CATEGORICAL_RAW_COLUMNS = ['Category Name', 'Status']
+RAW_SKIPROWS = 8
+RAW_SKIPFOOTER = 4
+
+# Raw transaction column -> master column it is mapped to, and the value a
+# master row gets when the student has no transaction
+MAPPED_COLUMNS = {
+    'Amount': 'AMOUNT',
+    'Bank Reference No': 'epaymerchantorderno',
+    'Category Name': 'TYPE',
+    'Status': 'FEES',
+    'Transaction Date': 'modifydate',
+}
+MAPPED_DEFAULTS = {'AMOUNT': 0, 'epaymerchantorderno': '', 'TYPE': '', 'FEES': 'Not Paid', 'modifydate': ''}
+
+_FLOAT_TYPES = (float, np.float64)
+_DATETIME_TYPES = (pd.Timestamp, datetime.datetime)
+_TIMEDELTA_TYPES = (pd.Timedelta, datetime.timedelta)
+_RAW_PREFIX = 'raw:'
+_ROW_SERIES_INFERS_STRING = str(pd.Series(np.array(['a', None], dtype=object)).iloc[1]) == 'nan'
+
+
+def _header_map_from_row(header_values, row_number):
+    """
+    Builds {column name: index} for one "Category Name" header row.
+    Returns an empty dict when the header has no enrollment column, which
+    sends every row under it to the unmapped block.
+    """
+    print(f"Header found at raw file row {row_number}. Re-mapping column indices...")
+    header_map = {}
+    for enroll_header in ENROLLMENT_HEADERS:
+        if enroll_header in header_values:
+            if enroll_header != 'Enrollment No':
+                print(f"Found '{enroll_header}' as Enrollment No")
+            header_map['Enrollment No'] = header_values.index(enroll_header)
+            break
+    else:
+        print("Warning: This header has no 'Enrollment No' column. Skipping.")
+        return {}
+
+    for col_name in REQUIRED_RAW_COLUMNS:
+        try:
+            header_map[col_name] = header_values.index(col_name)
+        except ValueError:
+            print(f"Warning: Header missing required column: {col_name}")
+    return header_map
+
+
+def _clean_enrollment_value(enroll_no):
+    """Scalar fallback: handles scientific notation (E+11) the same way as float()."""
+    try:
+        return str(int(float(enroll_no)))
+    except (ValueError, TypeError):
+        return str(enroll_no).strip()
+
+
+def _clean_enrollment_numbers(enroll_values):
+    """
+    Vectorized version of _clean_enrollment_value over an object array of
+    strings. Returns (cleaned array, mask of values that could not be
+    converted at all, e.g. 'inf', which the old row loop sent to the
+    unmapped block).
+    """
+    numeric = pd.to_numeric(pd.Series(enroll_values, dtype=object), errors='coerce').to_numpy(dtype='float64')
+    cleaned = np.array(enroll_values, dtype=object)
+
+    # Plain integers within int64 range convert in bulk
+    in_range = np.isfinite(numeric) & (np.abs(numeric) < 2 ** 63)
+    cleaned[in_range] = numeric[in_range].astype('int64').astype(str)
+
+    # Huge values and anything to_numeric rejected go through the scalar path
+    overflow = np.zeros(len(cleaned), dtype=bool)
+    for pos in np.flatnonzero(~in_range):
+        try:
+            cleaned[pos] = _clean_enrollment_value(enroll_values[pos])
+        except OverflowError:
+            overflow[pos] = True
+    return cleaned, overflow
+
+
+def _matches_any(values, candidates):
+    """Elementwise `values == c` for any c in candidates, on an object array."""
+    mask = np.zeros(values.shape, dtype=bool)
+    for candidate in candidates:
+        mask |= np.equal(values, np.asarray(candidate, dtype=object))
+    return mask
+
+
+def _rows_reinferred_by_iterrows(values):
+    """
+    iterrows() builds a Series per row, and pandas re-infers an object row
+    whose non-blank cells are all strings, all datetimes or all timedeltas.
+    That changes how some cells print (None -> 'nan', Timestamp -> ISO
+    form), so those rows are found here and stringified one by one.
+    """
+    cell_types = np.frompyfunc(type, 1, 1)(values)
+    missing = pd.isna(values)
+    is_str = _matches_any(cell_types, (str,))
+    is_datetime = _matches_any(cell_types, _DATETIME_TYPES)
+    is_timedelta = _matches_any(cell_types, _TIMEDELTA_TYPES)
+    is_other = ~(missing | is_str | is_datetime | is_timedelta)
+
+    kinds = is_str.any(axis=1).astype(int) + is_datetime.any(axis=1) + is_timedelta.any(axis=1)
+    non_float_blank = missing & ~_matches_any(cell_types, _FLOAT_TYPES)
+    affected = ~is_other.any(axis=1) & (kinds <= 1) & (non_float_blank | is_datetime | is_timedelta).any(axis=1)
+    if not _ROW_SERIES_INFERS_STRING:
+        affected &= ~is_str.any(axis=1)
+    return np.flatnonzero(affected)
+
+
+def _stringify_cells(raw_df_unparsed):
+    """
+    Returns the raw sheet as a 2D array of stripped strings, matching
+    str(val).strip() on every row the old iterrows() loop produced, and how
+    a blank cell prints in each row (a row re-inferred as dates pads with
+    'NaT', so the rows can be widened later to the same strings).
+    """
+    values = raw_df_unparsed.to_numpy()
+    blanks = np.full(values.shape[0], BLANK_CELL, dtype=object)
+    if values.size == 0:
+        return np.empty(values.shape, dtype=object), blanks
+
+    cells = np.char.strip(values.astype(str)).astype(object)
+    if values.dtype == object:
+        for pos in _rows_reinferred_by_iterrows(values):
+            printed = [str(val).strip() for val in pd.Series(np.append(values[pos], np.nan)).values]
+            cells[pos], blanks[pos] = printed[:-1], printed[-1]
+    return cells, blanks
+
+
+def _parse_raw_frame(raw_df_unparsed, row_offset=RAW_SKIPROWS + 1, header_map=None):
+    """
+    Splits the raw sheet into clean transaction records and leftover rows.
+
+    Header rows (first cell 'Category Name') are located with a mask, every
+    following row inherits the column indices of the header above it, and the
+    records are gathered column by column instead of row by row.
+
+    Returns (raw_df, unmapped_cells, unmapped_blanks, header_map), where
+    unmapped_cells is a 2D array of the leftover rows' stringified cells and
+    unmapped_blanks how a blank cell prints in each of them. Pass header_map
+    to continue parsing from a previous block; the returned one is the map
+    in effect after the last row.
+    """
+    cells, blanks = _stringify_cells(raw_df_unparsed)
+    n_rows = cells.shape[0]
+    record_cols = ['Enrollment No'] + REQUIRED_RAW_COLUMNS
+
+    if n_rows == 0:
+        return pd.DataFrame(), cells, blanks, header_map or {}
+
+    is_header = cells[:, 0] == 'Category Name'
+    is_empty = _matches_any(cells, EMPTY_CELL_VALUES).all(axis=1) & ~is_header
+
+    # Segment 0 is whatever came before the first header in this block
+    header_positions = np.flatnonzero(is_header)
+    segment_maps = [header_map or {}]
+    for pos in header_positions:
+        segment_maps.append(_header_map_from_row(cells[pos].tolist(), pos + row_offset))
+    segment_ids = np.cumsum(is_header)
+
+    # Column index per (segment, record column); -1 means missing
+    col_lookup = np.full((len(segment_maps), len(record_cols)), -1, dtype=np.intp)
+    for seg, seg_map in enumerate(segment_maps):
+        for j, col_name in enumerate(record_cols):
+            col_lookup[seg, j] = seg_map.get(col_name, -1)
+
+    has_header = col_lookup[segment_ids, 0] >= 0
+    data_rows = ~is_header & ~is_empty
+    candidate_pos = np.flatnonzero(data_rows & has_header)
+
+    columns = {}
+    row_col_idx = col_lookup[segment_ids[candidate_pos]]
+    for j, col_name in enumerate(record_cols):
+        idx = row_col_idx[:, j]
+        present = idx >= 0
+        col_values = np.full(len(candidate_pos), np.nan, dtype=object)
+        col_values[present] = cells[candidate_pos[present], idx[present]]
+        columns[col_name] = (col_values, present)
+
+    enroll_clean, overflow = _clean_enrollment_numbers(columns['Enrollment No'][0])
+    enroll_str = pd.Series(enroll_clean, dtype=object).astype(str)
+    is_valid = (
+        (enroll_str.str.len() > 5) & enroll_str.str[:1].str.isdigit()
+    ).to_numpy() & ~overflow
+
+    clean_pos = candidate_pos[is_valid]
+    unmapped_mask = data_rows.copy()
+    unmapped_mask[clean_pos] = False
+
+    raw_df = pd.DataFrame(index=pd.RangeIndex(len(clean_pos)))
+    raw_df['Enrollment No'] = enroll_clean[is_valid]
+    for col_name in REQUIRED_RAW_COLUMNS:
+        col_values, present = columns[col_name]
+        # Only keep columns that at least one clean record actually had
+        if present[is_valid].any():
+            if col_name in CATEGORICAL_RAW_COLUMNS:
+                raw_df[col_name] = pd.Categorical(col_values[is_valid])
+            else:
+                raw_df[col_name] = col_values[is_valid]
+    if raw_df.empty:
+        raw_df = pd.DataFrame()
+
+    return raw_df, cells[unmapped_mask], blanks[unmapped_mask], segment_maps[-1]
+
+
+def _concat_records(parts):
+    """
+    Concatenates record frames, keeping the categorical columns categorical
+    (a plain concat turns categoricals with different categories into
+    object columns) and the columns in the order one frame has them.
+    """
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return pd.DataFrame()
+    if len(parts) == 1:
+        return parts[0].reset_index(drop=True)
+    raw_df = pd.concat(parts, ignore_index=True)
+    raw_df = raw_df[[col for col in ['Enrollment No'] + REQUIRED_RAW_COLUMNS if col in raw_df.columns]]
+    for col_name in CATEGORICAL_RAW_COLUMNS:
+        if col_name in raw_df.columns and raw_df[col_name].dtype != 'category':
+            raw_df[col_name] = raw_df[col_name].astype('category')
+    return raw_df
+
+
+def _parse_raw_stream(stream, header_map=None):
+    parts, unmapped_data_list = [], UnmappedRows()
+    header_map = header_map or {}
+    for row_offset, chunk in stream:
+        part, unmapped, unmapped_blanks, header_map = _parse_raw_frame(chunk, row_offset, header_map)
+        if not part.empty:
+            parts.append(part)
+        unmapped_data_list.append_cells(unmapped, unmapped_blanks)
+
+    raw_df = _concat_records(parts)
+
+    # read_excel pads every row to the widest row in the sheet
+    unmapped_data_list.pad_to(stream.max_width)
+    return raw_df, unmapped_data_list, header_map
+
+
+def _read_raw_records(raw_data_file_path, sheet=0):
+    """
+    Streams the raw workbook (one sheet, by position) chunk by chunk through
+    _parse_raw_frame, so only the parsed records and leftover rows are ever
+    held in memory. Returns (raw_df, UnmappedRows).
+
+    A sheet where read_excel would give a column of numbers, dates or
+    durations its own dtype (see RawSheetStream) is read a second time.
+    """
+    stream = RawSheetStream(raw_data_file_path, skiprows=RAW_SKIPROWS, skipfooter=RAW_SKIPFOOTER, sheet=sheet)
+    raw_df, unmapped_data_list, _ = _parse_raw_stream(stream)
+    typed_stream = stream.typed_pass()
+    if typed_stream is not None:
+        raw_df, unmapped_data_list, _ = _parse_raw_stream(typed_stream)
+    return raw_df, unmapped_data_list
+
+
+def _read_new_raw_records(raw_data_file_path, read_position=None):
+    """
+    Incremental runs: reads the raw workbook from read_position, the point
+    where the previous call stopped, when it still starts with exactly the
+    rows read then (a bank export that only grew). Otherwise, or without a
+    read_position, it reads the whole sheet like _read_raw_records.
+
+    Returns (raw_df, UnmappedRows, resumed, read_position): the records of
+    the rows read this time only, the unmapped rows of the whole sheet,
+    whether the read was resumed, and the position to pass next time (None
+    when a column read_excel types as a whole rules out resuming).
+    """
+    if read_position is not None:
+        stream = RawSheetStream(raw_data_file_path, skiprows=RAW_SKIPROWS, skipfooter=RAW_SKIPFOOTER,
+                                resume=read_position["sheet"])
+        raw_df, unmapped_data_list, header_map = _parse_raw_stream(stream, read_position["header_map"])
+        if stream.prefix_changed:
+            print("Raw file no longer starts with the rows read last time, reading all of it.")
+        else:
+            typed_stream = stream.typed_pass()
+            if typed_stream is not None:
+                raw_df, unmapped_data_list, _ = _parse_raw_stream(typed_stream)
+                return raw_df, unmapped_data_list, False, None
+            print(f"Resumed reading the raw file at row {read_position['sheet']['rows'] + 1}.")
+            earlier_unmapped = read_position["unmapped"]
+            earlier_unmapped.extend(unmapped_data_list)
+            earlier_unmapped.set_width(stream.max_width)
+            position = {"sheet": stream.position(), "header_map": header_map, "unmapped": earlier_unmapped}
+            return raw_df, earlier_unmapped, True, position
+
+    stream = RawSheetStream(raw_data_file_path, skiprows=RAW_SKIPROWS, skipfooter=RAW_SKIPFOOTER)
+    raw_df, unmapped_data_list, header_map = _parse_raw_stream(stream)
+    typed_stream = stream.typed_pass()
+    if typed_stream is not None:
+        raw_df, unmapped_data_list, _ = _parse_raw_stream(typed_stream)
+        return raw_df, unmapped_data_list, False, None
+    position = {"sheet": stream.position(), "header_map": header_map, "unmapped": unmapped_data_list}
+    return raw_df, unmapped_data_list, False, position
+
+
+def _clean_raw_records(raw_df, dedup=True):
+    """
+    Step 3: drops records without an amount and (unless dedup is False)
+    keeps the last record per enrollment number.
+    """
+    if not raw_df.empty:
+        raw_df.dropna(subset=['Enrollment No'], inplace=True)
+        raw_df['Amount'] = pd.to_numeric(raw_df['Amount'], errors='coerce')
+        raw_df.dropna(subset=['Amount'], inplace=True)
+        raw_df['Enrollment No'] = raw_df['Enrollment No'].astype(str).str.strip()
+        if dedup:
+            raw_df.drop_duplicates(subset=['Enrollment No'], keep='last', inplace=True)
+    return raw_df
+
+
+def _parse_raw_source(raw_data_file_path, sheet=0):
+    """
+    Batch worker: reads and cleans one raw sheet (without the dedup, which
+    needs every source). Runs in a pool process, so it only takes and
+    returns picklable values: (raw_df, unmapped_data_list, stats).
+    """
+    start = time.perf_counter()
+    raw_df, unmapped_data_list = _read_raw_records(raw_data_file_path, sheet)
+    parsed_rows = len(raw_df)
+    raw_df = _clean_raw_records(raw_df, dedup=False)
+    stats = {
+        "file": os.path.basename(raw_data_file_path),
+        "sheet": sheet,
+        "parsed": parsed_rows,
+        "clean": len(raw_df),
+        "unmapped": len(unmapped_data_list),
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    return raw_df, unmapped_data_list, stats
+
+
+def _parse_raw_sources(sources, max_workers=BATCH_PARSE_WORKERS):
+    """
+    Runs _parse_raw_source for every (path, sheet) in sources, in parallel
+    when there is more than one. Results come back in source order.
+    """
+    if len(sources) == 1 or max_workers <= 1:
+        return [_parse_raw_source(path, sheet) for path, sheet in sources]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(sources))) as pool:
+        futures = [pool.submit(_parse_raw_source, path, sheet) for path, sheet in sources]
+        return [future.result() for future in futures]
+
+
+def _transaction_dates(values):
+    """
+    Transaction Date cells as datetimes (NaT when unparseable). ISO dates
+    are read as such; anything else is read day first, as the bank
+    exports write them.
+    """
+    values = pd.Series(values, dtype=object)
+    dates = pd.to_datetime(values, format='ISO8601', errors='coerce')
+    rest = dates.isna().to_numpy()
+    if rest.any():
+        dates[rest] = pd.to_datetime(values[rest], format='mixed', dayfirst=True, errors='coerce')
+    return dates
+
+
+def _latest_per_enrollment(frames):
+    """
+    Batch step 3: combines the cleaned records of all sources and keeps one
+    per enrollment number, the one with the latest transaction date.
+    Undated records lose to dated ones; ties go to the later source. The
+    kept records stay in source order. Returns (raw_df, kept rows per frame).
+    """
+    source = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames])
+    raw_df = _concat_records(frames)
+    if raw_df.empty:
+        return raw_df, [0] * len(frames)
+    if 'Transaction Date' in raw_df.columns:
+        order = pd.DataFrame({'date': _transaction_dates(raw_df['Transaction Date']).to_numpy()})
+        order = order.sort_values('date', kind='stable', na_position='first').index
+    else:
+        order = raw_df.index
+    latest = raw_df.loc[order].drop_duplicates(subset=['Enrollment No'], keep='last')
+    latest = latest.sort_index()
+    kept = np.bincount(source[latest.index], minlength=len(frames)).tolist()
+    return latest.reset_index(drop=True), kept
+
+
+def _merge_raw_records(master_df, raw_df):
+    """
+    Steps 4 and 5 as one keyed join: a single outer merge of the master
+    ernos against the cleaned raw records (unique per enrollment number).
+    Copies each student's transaction onto the master rows, fills the
+    defaults, and returns (master_df, new_students_df) where
+    new_students_df holds the raw records with no master row, in raw order.
+    """
+    if raw_df.empty:
+        for target in MAPPED_COLUMNS.values():
+            master_df[target] = np.nan
+        new_students_df = None
+    else:
+        # Raw columns are prefixed so they can't clash with master columns
+        lookup = raw_df.add_prefix(_RAW_PREFIX)
+        lookup['_raw_pos'] = np.arange(len(lookup))
+        keys = pd.DataFrame({'erno': master_df['erno'].to_numpy(), '_master_pos': np.arange(len(master_df))})
+        merged = keys.merge(
+            lookup, left_on='erno', right_on=_RAW_PREFIX + 'Enrollment No',
+            how='outer', sort=False, indicator=True,
+        )
+        # The outer merge sorts by key; put both sides back in their own order
+        is_new = (merged['_merge'] == 'right_only').to_numpy()
+        matched = merged[~is_new].sort_values('_master_pos', kind='stable')
+        for source, target in MAPPED_COLUMNS.items():
+            column = _RAW_PREFIX + source
+            master_df[target] = matched[column].to_numpy() if column in matched.columns else np.nan
+
+        new_students_df = merged[is_new].sort_values('_raw_pos', kind='stable')
+        new_students_df = new_students_df[lookup.columns[:-1]]
+        new_students_df.columns = raw_df.columns
+
+    master_df['ERNO'] = master_df['erno']
+    master_df['NAME'] = master_df['name']
+
+    # Fill missing values
+    master_df.fillna(MAPPED_DEFAULTS, inplace=True)
+    return master_df, new_students_df
+
+
+def _new_student_rows(master_columns, new_students_df, unnamed_col_name):
+    """
+    Step 6: master-shaped rows for students who paid but are not in the
+    master file (None if there are none).
+    """
+    if new_students_df is None or new_students_df.empty:
+        return None
+
+    print(f"Found {len(new_students_df)} new students.")
+    # Categorical record columns would reject the defaults filled in below
+    new_students_df = new_students_df.astype(object)
+    
+    # --- THIS IS THE BUG FIX ---
+    # Create a new DataFrame for these new students
+    new_rows_df = pd.DataFrame()
+    
+    # Use .values to safely extract data
+    new_rows_df['erno'] = new_students_df['Enrollment No'].values
+    new_rows_df['name'] = new_students_df['Name of Student'].values if 'Name of Student' in new_students_df.columns else ''
+    new_rows_df['AMOUNT'] = new_students_df['Amount'].values if 'Amount' in new_students_df.columns else 0
+    new_rows_df['modifydate'] = new_students_df['Transaction Date'].values if 'Transaction Date' in new_students_df.columns else ''
+    new_rows_df['epaymerchantorderno'] = new_students_df['Bank Reference No'].values if 'Bank Reference No' in new_students_df.columns else ''
+    new_rows_df['ERNO'] = new_students_df['Enrollment No'].values
+    new_rows_df['NAME'] = new_students_df['Name of Student'].values if 'Name of Student' in new_students_df.columns else ''
+    new_rows_df['TYPE'] = new_students_df['Category Name'].values if 'Category Name' in new_students_df.columns else ''
+    new_rows_df['FEES'] = new_students_df['Status'].values if 'Status' in new_students_df.columns else ''
+    # --- END OF BUG FIX ---
+
+    new_rows_df['sem'] = 'NEW'
+    new_rows_df['br_code'] = 'NEW'
+    
+    # Add the unnamed column if it exists in master_df
+    if unnamed_col_name in master_columns:
+        new_rows_df[unnamed_col_name] = ''
+    
+    # Ensure all columns from master_df are present
+    for col in master_columns:
+        if col not in new_rows_df.columns:
+            new_rows_df[col] = pd.NA
+    
+    # Reorder and select only columns that are in master_df
+    new_rows_df = new_rows_df[master_columns]
+    
+    new_rows_df.fillna({**MAPPED_DEFAULTS, 'FEES': 'Paid'}, inplace=True)
+    return new_rows_df
+
+
+def _stage_timer(progress_callback=None):
+    """
+    Returns (report_progress, end_stage, stage_seconds). Each stage runs
+    from its report_progress(percent, stage) call until the next one (or
+    end_stage()), and its seconds are recorded in stage_seconds.
+    """
+    stage_seconds = {}
+    running_stage = []  # (stage, start) of the stage in progress
+
+    def end_stage():
+        if running_stage:
+            stage, start = running_stage.pop()
+            stage_seconds[stage] = round(time.perf_counter() - start, 4)
+
+    def report_progress(percent, stage):
+        # Each step runs until the next one is reported
+        end_stage()
+        running_stage.append((stage, time.perf_counter()))
+        if progress_callback is not None:
+            progress_callback(percent, stage)
+
+    return report_progress, end_stage, stage_seconds
+
+
+def _write_run_outputs(output_folder, master_df, unmapped_data_list, output_format):
+    """
+    Step 7: writes the mapped (and unmapped) output files, the frames the
+    other formats are converted from on request, and the snapshot GET
+    /mapped queries, and records the content hash for downloads.
+    Returns (output_filename, unmapped_filename, content hash, result
+    message).
+    """
+    # xlsx gets the unmapped raw data appended in the same pass
+    if unmapped_data_list and output_format == "xlsx":
+        print(f"Appending {len(unmapped_data_list)} unmapped rows to the file...")
+    output_filename, unmapped_filename = write_mapped_outputs(
+        output_folder, master_df, unmapped_data_list, output_format
+    )
+    save_mapped_result(os.path.join(output_folder, MAPPED_RESULT_FILENAME), master_df, unmapped_data_list)
+    write_snapshot(os.path.join(output_folder, MAPPED_SNAPSHOT_FILENAME), master_df)
+    output_hash = prepare_download(output_filename)
+    print(f"✅ Main mapping complete. Saved to {output_filename}")
+
+    if output_format == "xlsx":
+        message = f"Mapping complete. {len(unmapped_data_list)} unmapped rows were appended."
+    else:
+        message = f"Mapping complete. {len(unmapped_data_list)} unmapped rows were written to a separate file."
+    return output_filename, unmapped_filename, output_hash, message
+
+
+def _ledger_column(column):
+    """A column as a list of values SQLite stores as they are (None when missing)."""
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return column.astype(object).where(column.notna(), None).tolist()
+    return [plain_value(value) for value in column.tolist()]
+
+
+def _update_ledger(output_folder, master_df):
+    """
+    Step 8: upserts the mapped rows into the fee ledger (see ledger.py), by
+    way of the run's ledger rows file. Returns the number of rows applied;
+    a ledger failure is reported but doesn't fail the run.
+    """
+    keyed = master_df[master_df['erno'].notna() & ~master_df['erno'].astype(str).isin(EMPTY_CELL_VALUES)]
+    columns = [
+        _ledger_column(keyed[column]) if column in keyed.columns else [None] * len(keyed)
+        for column in LEDGER_COLUMNS
+    ]
+    rows_path = os.path.join(output_folder, LEDGER_ROWS_FILENAME)
+    try:
+        write_run_rows(rows_path, zip(*columns))
+        applied = apply_run_rows(rows_path)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not update the fee ledger: {e}")
+        return 0
+    print(f"Fee ledger updated with {applied} students.")
+    return applied
+
+
+def run_pipeline_api(raw_data_file_path, master_file_path, progress_callback=None, incremental=False,
+                     output_format=DEFAULT_OUTPUT_FORMAT):
     """
     Cleans, maps, and merges student transaction data.
     This version is Flask-safe: takes file paths as args and returns a status dict.
-    It now also appends all unmapped data to the end of the file.
+    It now also writes out all unmapped data (see output_format below).
+    progress_callback(percent, stage), if given, is called as each step starts.
+    On success the result carries "metrics": seconds per stage, row counts
+    and input/output sizes in bytes.
+
+    With incremental=True the resolved state of the previous incremental run
+    in the same folder is reused: only raw transactions it hasn't seen (by
+    Bank Reference No) are cleaned and mapped. When the raw file still starts
+    with the rows that run read (an export that only grew), reading resumes
+    below them; otherwise the whole file is read and filtered. The output
+    files and the state are still written in full. The first run, or a run
+    with a different master file, does a full pass and saves that state.
+
+    output_format is csv (the default), parquet or ndjson (mapped and
+    unmapped rows in separate files) or xlsx (one workbook, unmapped rows
+    appended). The frames are also saved, so the other formats can be
+    produced later on request.
     """
+    report_progress, end_stage, stage_seconds = _stage_timer(progress_callback)
+
     try:
         print("--- Running Data Mapping Pipeline ---")
 
@@ -17,231 +610,235 @@ def run_pipeline_api(raw_data_file_path, master_file_path):
         if not os.path.exists(raw_data_file_path):
             return {"status": "error", "message": f"Raw data file not found: {raw_data_file_path}"}
 
-        output_filename = os.path.join(os.path.dirname(master_file_path), "mapped.xlsx")
+        if not format_available(output_format):
+            return {"status": "error", "message": f"Output format not available: {output_format}"}
+
+        output_folder = os.path.dirname(master_file_path)
+        state_path = os.path.join(output_folder, INCREMENTAL_STATE_FILENAME)
 
-        # 1️⃣ Read Master file
-        master_df = pd.read_excel(master_file_path, engine='openpyxl')
+        # 1️⃣ Read Master file (parsed and erno-normalized copy from the cache)
+        report_progress(5, "read_master")
+        master_digest = file_sha256(master_file_path)
+        master_df = load_master(master_file_path, master_digest)
 
         # 2️⃣ Read Raw data file robustly
+        report_progress(15, "read_raw")
         print("Reading raw data file with dynamic column handling...")
-        raw_df_unparsed = pd.read_excel(
-            raw_data_file_path, skiprows=8, skipfooter=4, header=None, engine='openpyxl'
-        )
-
-        clean_data_list = []
-        unmapped_data_list = [] # To store all leftover rows
-        
-        # This variable will hold the header definition for all rows that follow
-        current_header_map = {}
-
-        for index, row in raw_df_unparsed.iterrows():
-            row_values = [str(val).strip() for val in row.values]
-
-            # --- NEW LOGIC TO FIND HEADERS ---
-            if row_values[0] == 'Category Name':
-                print(f"Header found at raw file row {index + 9}. Re-mapping column indices...")
-                current_header_map = {} # Reset mapping
-                
-                # Try to find 'Enrollment No'
-                try:
-                    enroll_idx = row_values.index('Enrollment No')
-                except ValueError:
-                    # Try to find 'Enrollment/ACPC merit No'
-                    try:
-                        enroll_idx = row_values.index('Enrollment/ACPC merit No')
-                        print("Found 'Enrollment/ACPC merit No' as Enrollment No")
-                    except ValueError:
-                        print("Warning: This header has no 'Enrollment No' column. Skipping.")
-                        continue # Skip this header row
-                
-                current_header_map['Enrollment No'] = enroll_idx
-
-                # Find other required columns
-                required_cols = [
-                    'Amount', 'Bank Reference No', 'Category Name',
-                    'Status', 'Name of Student', 'Transaction Date'
-                ]
-                for col_name in required_cols:
-                    try:
-                         current_header_map[col_name] = row_values.index(col_name)
-                    except ValueError:
-                        print(f"Warning: Header missing required column: {col_name}")
-                        pass # Column is missing from this header
-                
-                continue # Skip the header row itself from processing
-
-            # --- NEW LOGIC TO SKIP EMPTY ROWS ---
-            if all(val == 'None' or val == '' or val.isspace() or val == 'nan' for val in row_values):
-                continue # Skip empty rows
-
-            # --- NEW LOGIC TO PROCESS OR CATCH DATA ---
-            # If we have found a valid header, process the row
-            if current_header_map and 'Enrollment No' in current_header_map:
-                try:
-                    # Create the record from the current header map
-                    record = {}
-                    for col_name, idx in current_header_map.items():
-                        if idx < len(row_values):
-                            record[col_name] = row_values[idx]
-                        else:
-                            record[col_name] = None
-
-                    enroll_no = record.get('Enrollment No', 'INVALID')
-                    
-                    # --- FIX: Handle scientific notation (E+11) ---
-                    enroll_no_clean = enroll_no
-                    try:
-                        enroll_no_clean = str(int(float(enroll_no)))
-                    except (ValueError, TypeError):
-                        enroll_no_clean = str(enroll_no).strip()
-                    # --- END FIX ---
-
-                    if len(enroll_no_clean) > 5 and enroll_no_clean[0].isdigit():
-                        record['Enrollment No'] = enroll_no_clean # Store the cleaned version
-                        clean_data_list.append(record)
-                    else:
-                        # Has a header but invalid enroll_no, so it's leftover
-                        unmapped_data_list.append(row_values)
-                except Exception as e:
-                    print(f"Error processing row: {e}. Row added to unmapped.")
-                    unmapped_data_list.append(row_values)
-            else:
-                # No valid header was found for this row, so it's leftover
-                unmapped_data_list.append(row_values)
-
-
-        raw_df = pd.DataFrame(clean_data_list)
+        state = load_incremental_state(state_path, master_digest) if incremental else None
+        if incremental:
+            # Picks up below the rows the previous incremental run read, if the file only grew
+            raw_df, unmapped_data_list, resumed, read_position = _read_new_raw_records(
+                raw_data_file_path, state["read_position"] if state is not None else None
+            )
+        else:
+            raw_df, unmapped_data_list = _read_raw_records(raw_data_file_path)
         if raw_df.empty:
             print("Warning: No valid data was parsed from the raw file.")
             # We can continue, to allow appending unmapped data
 
         print(f"Parsed {len(raw_df)} valid rows.")
+        parsed_rows = len(raw_df)
 
         # 3️⃣ Clean and prep data
-        if not raw_df.empty:
-            raw_df.dropna(subset=['Enrollment No'], inplace=True)
-            raw_df['Amount'] = pd.to_numeric(raw_df['Amount'], errors='coerce')
-            raw_df.dropna(subset=['Amount'], inplace=True)
-            raw_df['Enrollment No'] = raw_df['Enrollment No'].astype(str).str.strip()
-            raw_df.drop_duplicates(subset=['Enrollment No'], keep='last', inplace=True)
-
+        report_progress(60, "clean")
         unnamed_col_name = master_df.columns[4]
-        master_df['erno'] = master_df['erno'].astype(str).str.strip()
+        fingerprints = transaction_fingerprints(raw_df) if incremental else None
 
+        if state is not None:
+            # Only transactions the previous run hasn't seen are applied
+            delta_df = raw_df[~fingerprints.isin(state["seen"]).to_numpy()].reset_index(drop=True)
+            delta_rows = len(delta_df)
+            print(f"Incremental run: {delta_rows} new of {len(raw_df)} parsed rows.")
+            delta_df = _clean_raw_records(delta_df)
 
-        # 4️⃣ Mapping dictionaries
-        if not raw_df.empty:
-            amount_map = raw_df.set_index('Enrollment No')['Amount'].to_dict()
-            ref_map = raw_df.set_index('Enrollment No')['Bank Reference No'].to_dict() if 'Bank Reference No' in raw_df.columns else {}
-            type_map = raw_df.set_index('Enrollment No')['Category Name'].to_dict() if 'Category Name' in raw_df.columns else {}
-            status_map = raw_df.set_index('Enrollment No')['Status'].to_dict() if 'Status' in raw_df.columns else {}
-            date_map = raw_df.set_index('Enrollment No')['Transaction Date'].to_dict() if 'Transaction Date' in raw_df.columns else {}
+            # 4️⃣ 5️⃣ Re-map only the master rows those transactions touch
+            report_progress(65, "map")
+            raw_df = merge_resolved_records(state["resolved"], delta_df)
+            master_df = state["mapped_master"]
+            if not delta_df.empty:
+                touched = master_df['erno'].isin(delta_df['Enrollment No']).to_numpy()
+                updated, _ = _merge_raw_records(master_df.loc[touched].copy(), delta_df)
+                for col in MAPPED_COLUMNS.values():
+                    master_df[col] = master_df[col].mask(touched, updated[col])
+            new_students_df = raw_df[~raw_df['Enrollment No'].isin(master_df['erno'])] if not raw_df.empty else None
         else:
-            amount_map, ref_map, type_map, status_map, date_map = {}, {}, {}, {}, {}
-
-        # 5️⃣ Map data to master
-        master_df['AMOUNT'] = master_df['erno'].map(amount_map)
-        master_df['epaymerchantorderno'] = master_df['erno'].map(ref_map)
-        master_df['TYPE'] = master_df['erno'].map(type_map)
-        master_df['FEES'] = master_df['erno'].map(status_map)
-        master_df['modifydate'] = master_df['erno'].map(date_map)
-        master_df['ERNO'] = master_df['erno']
-        master_df['NAME'] = master_df['name']
-
-        # Fill missing values
-        master_df['AMOUNT'] = master_df['AMOUNT'].fillna(0)
-        master_df['epaymerchantorderno'] = master_df['epaymerchantorderno'].fillna('')
-        master_df['TYPE'] = master_df['TYPE'].fillna('')
-        master_df['FEES'] = master_df['FEES'].fillna('Not Paid')
-        master_df['modifydate'] = master_df['modifydate'].fillna('')
+            delta_rows = len(raw_df)
+            raw_df = _clean_raw_records(raw_df)
+
+            # 4️⃣ 5️⃣ Map data to master
+            report_progress(65, "map")
+            master_df, new_students_df = _merge_raw_records(master_df, raw_df)
+
+        if incremental:
+            seen = state["seen"] if state is not None else set()
+            seen.update(fingerprints)
+            save_incremental_state(state_path, master_digest, seen, raw_df, master_df, read_position)
 
         # 6️⃣ Add new students
-        if not raw_df.empty:
-            master_ernos = set(master_df['erno'])
-            raw_ernos = set(raw_df['Enrollment No'])
-            new_student_ernos = raw_ernos - master_ernos
-
-            if new_student_ernos:
-                print(f"Found {len(new_student_ernos)} new students.")
-                # Filter raw_df for new students
-                new_students_df = raw_df[raw_df['Enrollment No'].isin(new_student_ernos)].copy()
-                
-                # --- THIS IS THE BUG FIX ---
-                # Create a new DataFrame for these new students
-                new_rows_df = pd.DataFrame()
-                
-                # Use .values to safely extract data
-                new_rows_df['erno'] = new_students_df['Enrollment No'].values
-                new_rows_df['name'] = new_students_df['Name of Student'].values if 'Name of Student' in new_students_df.columns else ''
-                new_rows_df['AMOUNT'] = new_students_df['Amount'].values if 'Amount' in new_students_df.columns else 0
-                new_rows_df['modifydate'] = new_students_df['Transaction Date'].values if 'Transaction Date' in new_students_df.columns else ''
-                new_rows_df['epaymerchantorderno'] = new_students_df['Bank Reference No'].values if 'Bank Reference No' in new_students_df.columns else ''
-                new_rows_df['ERNO'] = new_students_df['Enrollment No'].values
-                new_rows_df['NAME'] = new_students_df['Name of Student'].values if 'Name of Student' in new_students_df.columns else ''
-                new_rows_df['TYPE'] = new_students_df['Category Name'].values if 'Category Name' in new_students_df.columns else ''
-                new_rows_df['FEES'] = new_students_df['Status'].values if 'Status' in new_students_df.columns else ''
-                # --- END OF BUG FIX ---
-
-                new_rows_df['sem'] = 'NEW'
-                new_rows_df['br_code'] = 'NEW'
-                
-                # Add the unnamed column if it exists in master_df
-                if unnamed_col_name in master_df.columns:
-                    new_rows_df[unnamed_col_name] = ''
-                
-                # Ensure all columns from master_df are present
-                for col in master_df.columns:
-                    if col not in new_rows_df.columns:
-                        new_rows_df[col] = pd.NA
-                
-                # Reorder and select only columns that are in master_df
-                new_rows_df = new_rows_df[master_df.columns]
-                
-                new_rows_df.fillna({
-                    'AMOUNT': 0, 'epaymerchantorderno': '', 'TYPE': '',
-                    'FEES': 'Paid', 'modifydate': ''
-                }, inplace=True)
-                
-                master_df = pd.concat([master_df, new_rows_df], ignore_index=True)
-
-        # 7️⃣ Save final file
-        master_df.to_excel(output_filename, index=False)
-        print(f"✅ Main mapping complete. Saved to {output_filename}")
-
-        # --- NEW LOGIC: APPEND UNMAPPED DATA ---
-        if unmapped_data_list:
-            print(f"Appending {len(unmapped_data_list)} unmapped rows to the file...")
-            try:
-                wb = load_workbook(output_filename)
-                ws = wb.active
-                
-                # Add a spacer and a title
-                ws.append([]) # Blank row
-                ws.append(["--- Unmapped Raw Data (Skipped by Pipeline) ---"])
-                
-                # Add a generic header
-                max_cols = max(len(row) for row in unmapped_data_list)
-                generic_header = [f"Raw Column {i+1}" for i in range(max_cols)]
-                ws.append(generic_header)
-
-                # Append each unmapped row
-                for row in unmapped_data_list:
-                    # Ensure row has full width to avoid data shifting
-                    full_row = row + [None] * (max_cols - len(row))
-                    ws.append(full_row)
-                
-                wb.save(output_filename)
-                print("✅ Unmapped data appended successfully.")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not append unmapped data to Excel file: {e}")
-        # --- END NEW LOGIC ---
+        report_progress(75, "new_students")
+        new_rows_df = _new_student_rows(master_df.columns, new_students_df, unnamed_col_name)
+        if new_rows_df is not None:
+            master_df = pd.concat([master_df, new_rows_df], ignore_index=True)
+
+        # 7️⃣ Save final file(s)
+        report_progress(80, "write")
+        output_filename, unmapped_filename, output_hash, message = _write_run_outputs(
+            output_folder, master_df, unmapped_data_list, output_format
+        )
+
+        # 8️⃣ Update the fee ledger
+        report_progress(95, "ledger")
+        ledger_rows = _update_ledger(output_folder, master_df)
+        end_stage()
+
+        result = {
+            "status": "success",
+            "message": message,
+            "format": output_format,
+            "output_file": output_filename,
+            "unmapped_file": unmapped_filename,
+            "content_hash": output_hash,
+            "records_processed": len(master_df),
+            "metrics": {
+                "stages": stage_seconds,
+                "total_seconds": round(sum(stage_seconds.values()), 4),
+                "rows": {
+                    "parsed": parsed_rows,
+                    "clean": len(raw_df),
+                    "unmapped": len(unmapped_data_list),
+                    "new_students": 0 if new_rows_df is None else len(new_rows_df),
+                    "processed": len(master_df),
+                    "ledger": ledger_rows,
+                },
+                "bytes": {
+                    "raw": os.path.getsize(raw_data_file_path),
+                    "master": os.path.getsize(master_file_path),
+                    "output": os.path.getsize(output_filename),
+                },
+            },
+        }
+        if incremental:
+            result["mode"] = "incremental" if state is not None else "full"
+            result["read_resumed"] = resumed
+            result["delta_rows"] = delta_rows
+        return result
+
+    except Exception as e:
+        return {"status": "error", "message": f"Unexpected error: {e}"}
+
+
+def run_batch_pipeline_api(raw_data_file_paths, master_file_paths, output_folder, progress_callback=None,
+                           all_sheets=False, output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Batch version of run_pipeline_api for several raw exports (e.g. one per
+    payment gateway) and master files (e.g. one per branch).
+
+    The masters are combined in the given order. Every raw file, or with
+    all_sheets=True every sheet of every raw file, is read and cleaned in
+    its own pool process; the records are then reduced to the latest
+    transaction per enrollment number (see _latest_per_enrollment) and
+    mapped in one pass. Unmapped rows of all sources are kept in source
+    order. The result has the same keys as run_pipeline_api plus "sources":
+    row counts and parse seconds per file/sheet, where "kept" is how many
+    of its records survived the dedup.
+    """
+    report_progress, end_stage, stage_seconds = _stage_timer(progress_callback)
+
+    try:
+        print(f"--- Running Batch Data Mapping Pipeline ({len(raw_data_file_paths)} raw files) ---")
+
+        if not raw_data_file_paths or not master_file_paths:
+            return {"status": "error", "message": "A batch needs at least one raw file and one master file"}
+
+        for path in list(master_file_paths) + list(raw_data_file_paths):
+            if not os.path.exists(path):
+                return {"status": "error", "message": f"Input file not found: {path}"}
+
+        if not format_available(output_format):
+            return {"status": "error", "message": f"Output format not available: {output_format}"}
+
+        # 1️⃣ Read Master files (parsed and erno-normalized copies from the cache)
+        report_progress(5, "read_master")
+        masters = [load_master(path) for path in master_file_paths]
+        unnamed_col_name = masters[0].columns[4]
+        master_df = pd.concat(masters, ignore_index=True) if len(masters) > 1 else masters[0]
+
+        # 2️⃣ Read and clean every raw file/sheet in parallel
+        report_progress(15, "read_raw")
+        sources, source_sheet_names = [], []
+        for path in raw_data_file_paths:
+            names = sheet_names(path)
+            if not all_sheets:
+                names = names[:1]
+            sources.extend((path, sheet) for sheet in range(len(names)))
+            source_sheet_names.extend(names)
+        print(f"Parsing {len(sources)} raw sheets...")
+        parsed = _parse_raw_sources(sources)
+
+        frames = [raw_df for raw_df, _, _ in parsed]
+        source_stats = [stats for _, _, stats in parsed]
+        for stats, name in zip(source_stats, source_sheet_names):
+            stats["sheet_name"] = name
+        unmapped_data_list = UnmappedRows()
+        for _, unmapped, _ in parsed:
+            unmapped_data_list.extend(unmapped)
+        parsed_rows = sum(stats["parsed"] for stats in source_stats)
+        print(f"Parsed {parsed_rows} valid rows.")
+
+        # 3️⃣ Keep the latest transaction per student across all sources
+        report_progress(60, "clean")
+        raw_df, kept = _latest_per_enrollment(frames)
+        for stats, kept_rows in zip(source_stats, kept):
+            stats["kept"] = kept_rows
+
+        # 4️⃣ 5️⃣ Map data to master
+        report_progress(65, "map")
+        master_df, new_students_df = _merge_raw_records(master_df, raw_df)
+
+        # 6️⃣ Add new students
+        report_progress(75, "new_students")
+        new_rows_df = _new_student_rows(master_df.columns, new_students_df, unnamed_col_name)
+        if new_rows_df is not None:
+            master_df = pd.concat([master_df, new_rows_df], ignore_index=True)
+
+        # 7️⃣ Save final file(s)
+        report_progress(80, "write")
+        output_filename, unmapped_filename, output_hash, message = _write_run_outputs(
+            output_folder, master_df, unmapped_data_list, output_format
+        )
+
+        # 8️⃣ Update the fee ledger
+        report_progress(95, "ledger")
+        ledger_rows = _update_ledger(output_folder, master_df)
+        end_stage()
 
         return {
             "status": "success",
-            "message": f"Mapping complete. {len(unmapped_data_list)} unmapped rows were appended.",
+            "message": message,
+            "format": output_format,
             "output_file": output_filename,
-            "records_processed": len(master_df)
+            "unmapped_file": unmapped_filename,
+            "content_hash": output_hash,
+            "records_processed": len(master_df),
+            "sources": source_stats,
+            "metrics": {
+                "stages": stage_seconds,
+                "total_seconds": round(sum(stage_seconds.values()), 4),
+                "rows": {
+                    "parsed": parsed_rows,
+                    "clean": len(raw_df),
+                    "unmapped": len(unmapped_data_list),
+                    "new_students": 0 if new_rows_df is None else len(new_rows_df),
+                    "processed": len(master_df),
+                    "ledger": ledger_rows,
+                },
+                "bytes": {
+                    "raw": sum(os.path.getsize(path) for path in raw_data_file_paths),
+                    "master": sum(os.path.getsize(path) for path in master_file_paths),
+                    "output": os.path.getsize(output_filename),
+                },
+            },
         }
 
     except Exception as e:
-        return {"status": "error", "message": f"Unexpected error: {e}"}
\ No newline at end of file
+        return {"status": "error", "message": f"Unexpected error: {e}"}
@@ -0,0 +1,416 @@
+import datetime
+import hashlib
+import re
+import zipfile
+from collections import deque
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+
+try:
+    import python_calamine
+except ImportError:  # optional, much faster xlsx/xls reader
+    python_calamine = None
+
+READ_CHUNK_ROWS = 5000
+
+# Text that pd.read_excel turns into NaN (its default na_values)
+NA_TEXT_VALUES = frozenset(pd.io.parsers.readers.STR_NA_VALUES)
+
+# Cells calamine reads as blank while openpyxl does not: text of nothing
+# but XML whitespace, and error values. Found in the sheet XML so they can
+# be put back.
+_WHITESPACE_TEXT = rb"<t(?:\s[^>]*)?>([ \t\r\n]+)</t>"
+# (one pattern each: a single literal prefix keeps the scan fast)
+_LOST_VALUES = (
+    re.compile(rb"<is>" + _WHITESPACE_TEXT + rb"</is>"),
+    re.compile(rb't="e"[^>]*>(?:<f[^>]*/>|<f[^>]*>[^<]*</f>)?<v>([^<]*)</v>'),
+)
+# The r attribute may come anywhere in the <c> tag, or be left out
+_CELL_REF = re.compile(rb'\sr="([A-Z]+)([0-9]+)"')
+_SHARED_WHITESPACE = re.compile(rb"<si>" + _WHITESPACE_TEXT + rb"</si>")
+_XML_CHUNK_BYTES = 1 << 20
+
+_INT64_MAX = np.iinfo(np.int64).max
+_UINT64_MAX = np.iinfo(np.uint64).max
+
+
+def excel_engine():
+    """Engine used for whole-sheet reads: calamine when installed, openpyxl otherwise."""
+    return 'calamine' if python_calamine is not None else 'openpyxl'
+
+
+def read_master_file(master_file_path):
+    """
+    Reads the master roster (first sheet, first row as header). A roster
+    with whitespace-only or error cells is read with openpyxl, as calamine
+    reads those cells as blank.
+    """
+    engine = excel_engine()
+    if engine == 'calamine' and _lost_cells(master_file_path) != {}:
+        engine = 'openpyxl'
+    return pd.read_excel(master_file_path, engine=engine)
+
+
+def _convert_cell(value):
+    """
+    Normalizes one cell the way pd.read_excel does before building a frame:
+    blanks, error cells and NA text become NaN, integral floats become int.
+    """
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        return np.nan if value in NA_TEXT_VALUES or value in ERROR_CODES else value
+    if isinstance(value, float):
+        as_int = int(value) if np.isfinite(value) else None
+        return as_int if as_int == value else value
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def sheet_names(path):
+    """Names of a workbook's sheets, in workbook order."""
+    if python_calamine is not None:
+        return python_calamine.CalamineWorkbook.from_path(path).sheet_names
+    wb = load_workbook(path, read_only=True, keep_links=False)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def _iter_openpyxl_rows(path, sheet=0):
+    wb = load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[sheet]
+        ws.reset_dimensions()
+        for row in ws.iter_rows(values_only=True):
+            yield row
+    finally:
+        wb.close()
+
+
+def _scan_xml(archive, name, patterns, boundary, counted=False):
+    """
+    Yields (match, number of boundary tags before it) for every match of
+    each pattern in one part of an xlsx archive; the number is only worked
+    out when counted is set (None otherwise). The part is read in chunks
+    cut at a boundary tag, so no element is split between two chunks and
+    every chunk starts with one.
+    """
+    seen, tail = 0, b""
+    with archive.open(name) as f:
+        while True:
+            data = f.read(_XML_CHUNK_BYTES)
+            buffer = tail + data
+            cut = max(buffer.rfind(boundary), 0) if data else len(buffer)
+            for pattern in patterns:
+                count, position = seen, 0
+                for match in pattern.finditer(buffer, 0, cut):
+                    if counted:
+                        count += buffer.count(boundary, position, match.start())
+                        position = match.start()
+                    yield match, count if counted else None
+            if counted:
+                seen += buffer.count(boundary, 0, cut)
+            tail = buffer[cut:]
+            if not data:
+                return
+
+
+def _sheet_part(archive, sheet_name):
+    """Path inside the archive of the worksheet called sheet_name."""
+    workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    rels = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    for node in workbook.iterfind("{*}sheets/{*}sheet"):
+        if node.get("name") == sheet_name:
+            rel_id = next(value for key, value in node.attrib.items() if key.endswith("}id"))
+            target = next(rel.get("Target") for rel in rels if rel.get("Id") == rel_id)
+            return target.lstrip("/") if target.startswith("/") else "xl/" + target
+    raise KeyError(sheet_name)
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + letter - ord("A") + 1
+    return index - 1
+
+
+def _cell_position(match):
+    """
+    0-based (row, column) of the <c> element a sheet match falls in, or None
+    when the element has no cell reference.
+    """
+    start = match.string.rfind(b"<c ", 0, match.start())
+    ref = _CELL_REF.search(match.string, start, match.string.find(b">", start)) if start >= 0 else None
+    return (int(ref[2]) - 1, _column_index(ref[1])) if ref else None
+
+
+def _lost_cells(path, sheet=0):
+    """
+    {(row, column): value}, 0-based, of the cells of one sheet (by position)
+    that calamine reads as blank: whitespace-only text and error values, as
+    openpyxl reads them. Empty for files that are not xlsx; None when one of
+    those cells has no cell reference to place it by (read the sheet with
+    openpyxl then).
+    """
+    if python_calamine is None or not zipfile.is_zipfile(path):
+        return {}
+    sheet_name = python_calamine.CalamineWorkbook.from_path(path).sheet_names[sheet]
+    cells = {}
+    with zipfile.ZipFile(path) as archive:
+        part = _sheet_part(archive, sheet_name)
+        for match, _ in _scan_xml(archive, part, _LOST_VALUES, b"<c "):
+            position = _cell_position(match)
+            if position is None:
+                return None
+            cells[position] = match[1].decode()
+
+        shared = {}
+        if "xl/sharedStrings.xml" in archive.namelist():
+            for match, index in _scan_xml(archive, "xl/sharedStrings.xml", (_SHARED_WHITESPACE,), b"<si>", counted=True):
+                shared[str(index).encode()] = match[1].decode()
+        if shared:
+            shared_cell = re.compile(rb't="s"[^>]*><v>(' + b"|".join(shared) + rb")</v>")
+            for match, _ in _scan_xml(archive, part, (shared_cell,), b"<c "):
+                position = _cell_position(match)
+                if position is None:
+                    return None
+                cells[position] = shared[match[1]]
+    return cells
+
+
+def _iter_calamine_rows(path, lost_cells, sheet=0):
+    lost = {}
+    for (row_number, column), value in lost_cells.items():
+        lost.setdefault(row_number, []).append((column, value))
+
+    sheet = python_calamine.CalamineWorkbook.from_path(path).get_sheet_by_index(sheet)
+    # iter_rows() starts at the first used column; put the leading blanks back
+    lead = [None] * sheet.start[1] if sheet.height and sheet.start[1] else []
+    for row_number, row in enumerate(sheet.iter_rows()):
+        row = lead + [None if cell == '' else cell for cell in row]
+        for column, value in lost.get(row_number, ()):
+            row.extend([None] * (column + 1 - len(row)))
+            row[column] = value
+        yield row
+
+
+def iter_sheet_rows(path, sheet=0):
+    """
+    Streams one sheet of a workbook (by position, the first by default) row
+    by row without loading it, as lists of converted cell values with
+    trailing empty cells trimmed. Like read_excel, only cells that are empty
+    in the sheet count as such, not NA text or error values.
+    """
+    lost_cells = _lost_cells(path, sheet) if python_calamine is not None else None
+    if lost_cells is not None:
+        rows = _iter_calamine_rows(path, lost_cells, sheet)
+    else:
+        rows = _iter_openpyxl_rows(path, sheet)
+    for row in rows:
+        end = len(row)
+        while end and (row[end - 1] is None or row[end - 1] == ''):
+            end -= 1
+        yield [_convert_cell(value) for value in row[:end]]
+
+
+def _cell_kind(value):
+    """
+    What about a cell decides the dtype read_excel gives a column of
+    numbers, dates or durations (type, sign and size of ints, blanks, the
+    shape of numeric text), or None for a cell that keeps a column object.
+    """
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            float(text)
+        except ValueError:
+            return None
+        digits = text.lstrip('+-')
+        return str, digits.isdigit(), text.startswith('-'), len(digits) > 18
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, int):
+        return int, value < 0, value > _INT64_MAX, value > _UINT64_MAX
+    if isinstance(value, float):
+        return float, value != value
+    if isinstance(value, (datetime.datetime, datetime.timedelta)):
+        return type(value)
+    return None
+
+
+class RawSheetStream:
+    """
+    Iterates over the raw bank export in DataFrame chunks, honouring the
+    skiprows / skipfooter framing of pd.read_excel without holding the sheet
+    in memory. Trailing blank rows don't count towards the footer, the same
+    as read_excel.
+
+    Yields (row_offset, chunk) where row_offset is the 1-based sheet row of
+    the chunk's first row. max_width is the widest row of the whole sheet
+    (read_excel pads every row to it) and is only final once the iteration
+    is over. sheet is the position of the sheet to read.
+
+    read_excel also looks at each column as a whole. In a column of text,
+    equal values share the form met first (a False after a 0 reads as 0),
+    which the chunks reproduce. A column holding only numbers, only dates
+    or only durations (and blanks) gets one dtype for all its cells, which
+    is only known at the end: typed_pass() then returns a stream that reads
+    the sheet again with those dtypes (column_dtypes, with width the final
+    max_width).
+
+    position() is where the iteration stopped: the rows passed on so far
+    (everything but the footer), a digest of them and what the chunks
+    remember of them. A stream built with resume=<that position> skips
+    those rows without framing them, as long as the sheet still starts with
+    exactly the same rows; otherwise it stops at once with prefix_changed
+    set, and the sheet has to be read from the top.
+    """
+
+    def __init__(self, path, skiprows=8, skipfooter=4, chunk_rows=READ_CHUNK_ROWS, sheet=0,
+                 width=0, column_dtypes=None, resume=None):
+        self.path = path
+        self.sheet = sheet
+        self.skiprows = skiprows
+        self.skipfooter = skipfooter
+        self.chunk_rows = chunk_rows
+        self.column_dtypes = column_dtypes or {}
+        self.max_width = width
+        self.rows_read = 0
+        self.prefix_changed = False
+        self._rows_framed = 0
+        self._first_values = {}     # (column, value) -> first equal value met in the column
+        self._column_samples = {}   # column -> {_cell_kind: cell}, None once it held an object cell
+        self._rows_passed = 0       # rows handed on (or dropped as preamble), never footer
+        self._passed_width = 0
+        self._digest = hashlib.blake2b(digest_size=16)  # of the rows passed
+        self._resume = resume
+        if resume is not None:
+            self.max_width = self._passed_width = resume["width"]
+            self._rows_framed = resume["rows_framed"]
+            self._first_values = dict(resume["first_values"])
+            # Wider columns only held the padding of rows that were footer then
+            self._column_samples = {
+                column: None if samples is None else dict(samples)
+                for column, samples in resume["column_samples"].items() if column < self._passed_width
+            }
+
+    def position(self):
+        """Where a resumed stream can pick up, once the iteration is over."""
+        return {
+            "rows": self._rows_passed,
+            "digest": self._digest.hexdigest(),
+            "width": self._passed_width,
+            "rows_framed": self._rows_framed,
+            "first_values": dict(self._first_values),
+            "column_samples": {
+                column: None if samples is None else dict(samples)
+                for column, samples in self._column_samples.items()
+            },
+        }
+
+    def _pass_row(self, row):
+        self._rows_passed += 1
+        self._passed_width = max(self._passed_width, len(row))
+        self._digest.update(repr(row).encode())
+
+    def _framed_rows(self):
+        # Rows wait in `pending` until enough non-blank rows follow them to
+        # prove they are not part of the footer
+        pending = deque()
+        skip = self._resume["rows"] if self._resume is not None else 0
+        for row_number, row in enumerate(iter_sheet_rows(self.path, self.sheet)):
+            self.rows_read += 1
+            if row_number < skip:
+                self._pass_row(row)
+                continue
+            if row_number == skip and skip and self._digest.hexdigest() != self._resume["digest"]:
+                self.prefix_changed = True
+                return
+            if not row:
+                pending.append((row_number, row))
+                continue
+            self.max_width = max(self.max_width, len(row))
+            pending.append((row_number, row))
+            while pending and pending[0][0] <= row_number - self.skipfooter:
+                pending_number, pending_row = pending.popleft()
+                self._pass_row(pending_row)
+                if pending_number >= self.skiprows:
+                    yield pending_number, pending_row
+        if skip and self.rows_read <= skip and self._digest.hexdigest() != self._resume["digest"]:
+            # The sheet ends within the rows already read (or is shorter)
+            self.prefix_changed = True
+
+    def __iter__(self):
+        chunk, chunk_start = [], None
+        for row_number, row in self._framed_rows():
+            if chunk_start is None:
+                chunk_start = row_number
+            chunk.append(row)
+            if len(chunk) >= self.chunk_rows:
+                yield chunk_start + 1, self._to_frame(chunk)
+                chunk, chunk_start = [], None
+        if chunk:
+            yield chunk_start + 1, self._to_frame(chunk)
+
+    def _to_frame(self, rows):
+        width = self.max_width
+        padded = np.full((len(rows), width), np.nan, dtype=object)
+        for i, row in enumerate(rows):
+            padded[i, :len(row)] = row
+        for column in range(width):
+            self._sample_column(column, padded[:, column])
+            if column not in self.column_dtypes:
+                self._share_equal_values(column, padded[:, column])
+        self._rows_framed += len(rows)
+        frame = pd.DataFrame(padded, dtype=object)
+        for column, dtype in self.column_dtypes.items():
+            frame[column] = TextParser(padded[:, [column]].tolist(), header=None).read()[0].astype(dtype)
+        return frame
+
+    def _share_equal_values(self, column, values):
+        # Only 0/False and 1/True are equal while printing differently
+        for pos in np.flatnonzero((values == 0) | (values == 1)):
+            values[pos] = self._first_values.setdefault((column, values[pos]), values[pos])
+
+    def _sample_column(self, column, values):
+        if column not in self._column_samples:
+            # Earlier chunks were narrower: the column was blank in their rows
+            self._column_samples[column] = {(float, True): np.nan} if self._rows_framed else {}
+        samples = self._column_samples[column]
+        if samples is None:
+            return
+        for value in values:
+            kind = _cell_kind(value)
+            if kind is None:
+                self._column_samples[column] = None
+                return
+            samples.setdefault(kind, value)
+
+    def typed_pass(self):
+        """
+        Once the iteration is over: a stream reading the sheet again with the
+        dtypes read_excel gives whole columns, or None when that would change
+        nothing (no such column holds anything but blanks). The dtypes come
+        from running read_excel's parser on one sample cell per _cell_kind.
+        """
+        column_dtypes, blank_only = {}, True
+        for column, samples in self._column_samples.items():
+            if samples:
+                dtype = TextParser([[value] for value in samples.values()], header=None).read()[0].dtype
+                if dtype != object:
+                    column_dtypes[column] = dtype
+                    blank_only &= samples.keys() == {(float, True)}
+        if blank_only:
+            return None
+        return RawSheetStream(self.path, self.skiprows, self.skipfooter, self.chunk_rows, self.sheet,
+                              width=self.max_width, column_dtypes=column_dtypes)
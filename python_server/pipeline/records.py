@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+# How an empty cell of the raw sheet reads once stringified
+BLANK_CELL = 'nan'
+
+
+class UnmappedRows:
+    """
+    The raw rows the parser could not map, stored compactly.
+
+    Every distinct cell string is kept once and rows are int32 codes into
+    that table, so repeated values ('nan', 'None', category names, headers)
+    cost four bytes per cell. Trailing blank cells are not stored at all:
+    each row keeps its own length and is padded back to the width of the
+    sheet it came from when read, with the way a blank cell prints in that
+    row ('nan', or 'NaT' in a row pandas read as dates).
+
+    Iterating yields each row as a list of strings, exactly as the old
+    lists of cells looked; to_frame() builds a frame without going through
+    those lists.
+    """
+
+    def __init__(self):
+        self._values = []       # distinct cell strings, by code
+        self._codes = {}        # cell string -> code
+        self._blocks = []       # [codes of the stored cells, row end offsets, sheet width, blank code per row]
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def __iter__(self):
+        values = np.array(self._values, dtype=object)
+        for codes, ends, width, blanks in self._blocks:
+            start = 0
+            for end, blank in zip(ends, values[blanks]):
+                row = values[codes[start:end]].tolist()
+                row.extend([blank] * (width - (end - start)))
+                start = end
+                yield row
+
+    def __setstate__(self, state):
+        # Rows pickled before blanks were kept per row all pad with 'nan'
+        self.__dict__.update(state)
+        for block in self._blocks:
+            if len(block) == 3:
+                block.append(np.full(len(block[1]), self._code(BLANK_CELL), dtype=np.int32))
+
+    @property
+    def max_width(self):
+        return max((block[2] for block in self._blocks), default=0)
+
+    def _code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def _encode(self, values):
+        """int32 codes of a 1D object array, growing the table as needed."""
+        local_codes, uniques = pd.factorize(values)
+        remap = np.fromiter((self._code(value) for value in uniques), dtype=np.int32, count=len(uniques))
+        return remap[local_codes]
+
+    def append_cells(self, cells, blanks=None):
+        """
+        Adds a 2D object array of stringified cells, one row per unmapped
+        row. blanks is how a blank cell prints in each row (default 'nan').
+        """
+        if cells.shape[0] == 0:
+            return
+        n_rows, width = cells.shape
+        codes = self._encode(cells.ravel()).reshape(cells.shape)
+        if blanks is None:
+            blank_codes = np.full(n_rows, self._code(BLANK_CELL), dtype=np.int32)
+        else:
+            blank_codes = self._encode(blanks)
+        filled = codes != blank_codes[:, None]
+        lengths = np.where(filled.any(axis=1), width - np.argmax(filled[:, ::-1], axis=1), 0)
+        stored = np.arange(width) < lengths[:, None]
+        self._blocks.append([codes[stored], np.cumsum(lengths), width, blank_codes])
+        self._rows += n_rows
+
+    def pad_to(self, width):
+        """Widens every row added so far to at least width (read_excel pads to the widest row)."""
+        for block in self._blocks:
+            block[2] = max(block[2], width)
+
+    def set_width(self, width):
+        """
+        Gives every row the same width, narrower than before if need be; it
+        must be at least the width of every row's own cells.
+        """
+        for block in self._blocks:
+            block[2] = width
+
+    def extend(self, other):
+        """Appends the rows of another UnmappedRows, keeping their widths."""
+        if not other._blocks:
+            return
+        remap = self._encode(np.array(other._values, dtype=object))
+        for codes, ends, width, blanks in other._blocks:
+            self._blocks.append([remap[codes], ends.copy(), width, remap[blanks]])
+        self._rows += len(other)
+
+    def to_frame(self, columns):
+        """
+        The rows as an object frame with the given column names (one per
+        column of the widest row). Cells past a row's own sheet width are
+        None.
+        """
+        width = len(columns)
+        values = np.array(self._values + [None], dtype=object)
+        dense = np.full((self._rows, width), len(self._values), dtype=np.int32)
+        row = 0
+        for codes, ends, block_width, blanks in self._blocks:
+            lengths = np.diff(ends, prepend=0)
+            block = dense[row:row + len(ends)]
+            block[:, :block_width] = blanks[:, None]
+            block[np.arange(width) < lengths[:, None]] = codes
+            row += len(ends)
+        return pd.DataFrame(values[dense], columns=columns, dtype=object)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from config import RESULT_CACHE_FOLDER, RESULT_CACHE_MAX_MB
+
+# Bump whenever a change to the pipeline changes its output for the same
+# inputs, so results of the old code are never served
+PIPELINE_VERSION = 4
+
+RESULT_FILENAME = "result.json"
+# Keys of the results a workspace stored or restored, dropped on /reset
+WORKSPACE_KEYS_FILENAME = ".result_keys"
+
+# Result fields that point at workspace files; rewritten on restore
+_PATH_FIELDS = ("output_file", "unmapped_file")
+
+
+def result_key(input_hashes, **options):
+    """
+    Cache key of a run: the content hashes of its inputs (in order), the
+    options that change the output (format, sheets, ...) and PIPELINE_VERSION.
+    """
+    payload = json.dumps(
+        {"version": PIPELINE_VERSION, "inputs": list(input_hashes), "options": options}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(RESULT_CACHE_FOLDER, key)
+
+
+def _link_or_copy(src, dest):
+    # Outputs are always replaced, never modified in place, so a hard link is safe
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def _remember_key(workspace_folder, key):
+    with open(os.path.join(workspace_folder, WORKSPACE_KEYS_FILENAME), "a") as f:
+        f.write(key + "\n")
+
+
+def _entry_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def _evict_entries():
+    """Keeps the cache within RESULT_CACHE_MAX_MB, dropping the least recently used entries."""
+    entries = []
+    for name in os.listdir(RESULT_CACHE_FOLDER):
+        path = os.path.join(RESULT_CACHE_FOLDER, name)
+        if name.endswith(".tmp") or not os.path.isdir(path):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), _entry_bytes(path), path))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RESULT_CACHE_MAX_MB * 1024 * 1024:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def store_result(key, result, workspace_folder, extra_files=()):
+    """
+    Keeps the output files of a successful run (plus extra_files, e.g. the
+    saved frames for lazy format conversion) and its result dict under key.
+    """
+    os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+    entry = _entry_dir(key)
+    if os.path.isdir(entry):
+        return
+    tmp_entry = f"{entry}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(tmp_entry)
+        cached = dict(result)
+        files = [result.get(field) for field in _PATH_FIELDS] + list(extra_files)
+        for path in files:
+            if path and os.path.exists(path):
+                _link_or_copy(path, os.path.join(tmp_entry, os.path.basename(path)))
+        for field in _PATH_FIELDS:
+            if cached.get(field):
+                cached[field] = os.path.basename(cached[field])
+        cached["cached_at"] = time.time()
+        with open(os.path.join(tmp_entry, RESULT_FILENAME), "w") as f:
+            json.dump(cached, f, default=str)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            pass  # stored meanwhile by another process
+    finally:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    _remember_key(workspace_folder, key)
+    _evict_entries()
+
+
+def restore_result(key, workspace_folder):
+    """
+    Puts a cached run's files into the workspace and returns its result
+    dict (paths pointing into the workspace), or None on a miss.
+    """
+    entry = _entry_dir(key)
+    try:
+        with open(os.path.join(entry, RESULT_FILENAME)) as f:
+            result = json.load(f)
+        for name in os.listdir(entry):
+            if name == RESULT_FILENAME:
+                continue
+            dest = os.path.join(workspace_folder, name)
+            tmp_dest = f"{dest}.{uuid.uuid4().hex}.tmp"
+            try:
+                _link_or_copy(os.path.join(entry, name), tmp_dest)
+                os.replace(tmp_dest, dest)
+            finally:
+                if os.path.exists(tmp_dest):
+                    os.remove(tmp_dest)
+        os.utime(entry)
+    except (OSError, ValueError):
+        # Missing, or evicted while being read
+        return None
+    for field in _PATH_FIELDS:
+        if result.get(field):
+            result[field] = os.path.join(workspace_folder, result[field])
+    _remember_key(workspace_folder, key)
+    return result
+
+
+def forget_workspace_results(workspace_folder):
+    """Drops the cached results this workspace stored or restored. Returns how many."""
+    keys_path = os.path.join(workspace_folder, WORKSPACE_KEYS_FILENAME)
+    try:
+        with open(keys_path) as f:
+            keys = {line.strip() for line in f if line.strip()}
+        os.remove(keys_path)
+    except OSError:
+        return 0
+    removed = 0
+    for key in keys:
+        if os.path.isdir(_entry_dir(key)):
+            shutil.rmtree(_entry_dir(key), ignore_errors=True)
+            removed += 1
+    return removed
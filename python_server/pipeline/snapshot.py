@@ -0,0 +1,245 @@
+import base64
+import datetime
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from config import MAPPED_SNAPSHOT_MEMORY_ENTRIES
+
+# A run's mapped rows as one columnar file that GET /mapped memory-maps and
+# queries without loading the whole result. Layout: MAGIC, the header length
+# (uint64, little-endian), a JSON header, then one block per column aligned
+# to _ALIGN bytes. Numeric columns are stored as they are; every other
+# column as int32 codes into a dictionary of its distinct values, kept in
+# the header (-1 for a missing value).
+MAGIC = b"MAPSNAP1"
+_ALIGN = 64
+_PREAMBLE = len(MAGIC) + 8
+_CODES = "codes"
+
+# Open snapshots: (path, inode, mtime) -> MappedSnapshot
+_open_snapshots = OrderedDict()
+_open_lock = threading.Lock()
+
+
+class StaleCursor(Exception):
+    """Raised when a pagination cursor was issued for another snapshot."""
+
+
+def plain_value(value):
+    """A cell as a JSON/SQLite-ready Python value (None when missing)."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return None
+        # JSON has no infinities; written the way the xlsx writer does
+        return float(value) if np.isfinite(value) else ("inf" if value > 0 else "-inf")
+    if pd.isna(value):
+        return None
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+
+def _encode_column(column):
+    """(numpy block, header entry) of one column."""
+    kind = column.dtype.kind if isinstance(column.dtype, np.dtype) else None
+    if kind == "b":
+        return column.to_numpy(np.bool_), {"dtype": "bool"}
+    if kind in ("i", "u"):
+        return column.to_numpy(np.int64), {"dtype": "int64"}
+    if kind == "f":
+        return column.to_numpy(np.float64), {"dtype": "float64"}
+    codes, uniques = pd.factorize(column)
+    return codes.astype(np.int32), {"dtype": _CODES, "values": [plain_value(value) for value in uniques]}
+
+
+def write_snapshot(path, df):
+    """Writes df as a snapshot file at path, replacing it atomically."""
+    blocks, columns, offset = [], [], 0
+    for name in df.columns:
+        block, entry = _encode_column(df[name])
+        offset = _aligned(offset)
+        columns.append({"name": str(name), "offset": offset, **entry})
+        blocks.append((offset, block))
+        offset += block.nbytes
+    header = json.dumps({"version": uuid.uuid4().hex, "rows": len(df), "columns": columns}).encode()
+    data_start = _aligned(_PREAMBLE + len(header))
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+            for block_offset, block in blocks:
+                f.seek(data_start + block_offset)
+                f.write(block.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class MappedSnapshot:
+    """
+    A memory-mapped snapshot file. Column blocks are views into the mapping,
+    so a query only pages in the columns (and rows) it touches; dictionary
+    values are parsed with the header, once per process.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a mapped snapshot: {path}")
+            header_length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_length))
+        data_start = _aligned(_PREAMBLE + header_length)
+        self.version = header["version"]
+        self.rows = header["rows"]
+        self.columns = [entry["name"] for entry in header["columns"]]
+        self._entries = {entry["name"]: entry for entry in header["columns"]}
+        self._sort_keys = {}
+
+        mapping = np.memmap(path, dtype=np.uint8, mode="r")
+        self._blocks = {}
+        for entry in header["columns"]:
+            dtype = np.int32 if entry["dtype"] == _CODES else np.dtype(entry["dtype"])
+            self._blocks[entry["name"]] = np.frombuffer(
+                mapping, dtype=dtype, count=self.rows, offset=data_start + entry["offset"]
+            )
+            if entry["dtype"] == _CODES:
+                # A trailing None, so code -1 looks up as missing
+                entry["lookup"] = np.array(entry["values"] + [None], dtype=object)
+
+    def _match(self, name, wanted):
+        """Row mask of the rows whose value in column name is one of the wanted strings."""
+        entry, block = self._entries[name], self._blocks[name]
+        if entry["dtype"] == _CODES:
+            codes = [
+                code for code, value in enumerate(entry["values"])
+                if str(value) in wanted
+                or (isinstance(value, float) and value.is_integer() and str(int(value)) in wanted)
+            ]
+            return np.isin(block, np.array(codes, dtype=np.int32))
+        numbers = []
+        for value in wanted:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                pass
+        return np.isin(block, np.array(numbers, dtype=np.float64))
+
+    def _sort_key(self, name):
+        """float64 key per row, ascending, with missing values as +inf."""
+        if name not in self._sort_keys:
+            entry, block = self._entries[name], self._blocks[name]
+            if entry["dtype"] == _CODES:
+                # Rank of each dictionary value: numbers before strings, missing last
+                values = entry["values"]
+                order = sorted(
+                    (code for code, value in enumerate(values) if value is not None),
+                    key=lambda code: (isinstance(values[code], str), values[code]),
+                )
+                ranks = np.full(len(values) + 1, np.inf)
+                ranks[order] = np.arange(len(order))
+                key = ranks[block]
+            else:
+                key = block.astype(np.float64)
+                key[np.isnan(key)] = np.inf
+            self._sort_keys[name] = key
+        return self._sort_keys[name]
+
+    def query(self, filters=None, sort=None, descending=False, after=None, limit=100):
+        """
+        Row positions of one page: rows matching every {column: wanted
+        strings} filter, ordered by the sort column (then row order), that
+        come after the cursor. Returns (matching rows, page positions, cursor
+        of the next page or None).
+        """
+        mask = np.ones(self.rows, dtype=bool)
+        for name, wanted in (filters or {}).items():
+            mask &= self._match(name, set(wanted))
+        positions = np.flatnonzero(mask)
+
+        if sort:
+            key = self._sort_key(sort)[positions]
+            if descending:
+                missing = np.isinf(key) & (key > 0)
+                key = -key
+                key[missing] = np.inf
+            order = np.lexsort((positions, key))
+            positions, key = positions[order], key[order]
+        else:
+            key = positions.astype(np.float64)
+
+        start = 0
+        if after is not None:
+            after_key, after_position = self._decode_cursor(after, sort, descending)
+            low, high = np.searchsorted(key, after_key, "left"), np.searchsorted(key, after_key, "right")
+            start = low + int(np.searchsorted(positions[low:high], after_position, "right"))
+
+        page = positions[start:start + limit]
+        next_cursor = None
+        if start + limit < len(positions):
+            last = start + limit - 1
+            next_cursor = self._encode_cursor(float(key[last]), int(positions[last]), sort, descending)
+        return len(positions), page, next_cursor
+
+    def _encode_cursor(self, key, position, sort, descending):
+        payload = json.dumps([self.version, sort, descending, key, position]).encode()
+        return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+    def _decode_cursor(self, cursor, sort, descending):
+        try:
+            payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            version, cursor_sort, cursor_descending, key, position = json.loads(payload)
+        except ValueError:
+            raise ValueError("Malformed cursor")
+        if version != self.version:
+            raise StaleCursor("The mapped result changed since this cursor was issued; start from the first page")
+        if (cursor_sort, cursor_descending) != (sort, descending):
+            raise ValueError("The cursor belongs to a different sort order")
+        return key, position
+
+    def records(self, positions, columns):
+        """Yields the rows at positions as {column: value} dicts."""
+        values = []
+        for name in columns:
+            entry, block = self._entries[name], self._blocks[name]
+            if entry["dtype"] == _CODES:
+                values.append(entry["lookup"][block[positions]].tolist())
+            else:
+                values.append([plain_value(value) for value in block[positions].tolist()])
+        for row in zip(*values):
+            yield dict(zip(columns, row))
+
+
+def open_snapshot(path):
+    """The MappedSnapshot of the file at path, reusing one this process has open."""
+    stat = os.stat(path)
+    key = (path, stat.st_ino, stat.st_mtime_ns)
+    with _open_lock:
+        snapshot = _open_snapshots.get(key)
+        if snapshot is not None:
+            _open_snapshots.move_to_end(key)
+            return snapshot
+    snapshot = MappedSnapshot(path)
+    with _open_lock:
+        _open_snapshots[key] = snapshot
+        while len(_open_snapshots) > MAPPED_SNAPSHOT_MEMORY_ENTRIES:
+            _open_snapshots.popitem(last=False)
+    return snapshot
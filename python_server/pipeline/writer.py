@@ -0,0 +1,211 @@
+import datetime
+import decimal
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+
+from config import DEFAULT_OUTPUT_FORMAT
+
+try:
+    import pyarrow
+except ImportError:  # optional, only needed for Parquet output
+    pyarrow = None
+
+SHEET_NAME = "Sheet1"
+UNMAPPED_TITLE = "--- Unmapped Raw Data (Skipped by Pipeline) ---"
+WRITE_CHUNK_ROWS = 10000
+
+# Output formats of a pipeline run; the file extension is the format name
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet", "ndjson")
+
+# Same number formats DataFrame.to_excel uses
+DATETIME_FORMAT = "YYYY-MM-DD HH:MM:SS"
+DATE_FORMAT = "YYYY-MM-DD"
+
+
+def _excel_value(ws, val):
+    """Converts one value the way DataFrame.to_excel would before writing it."""
+    if val is None or val is pd.NA or val is pd.NaT:
+        return None
+    if isinstance(val, (bool, np.bool_)):
+        return bool(val)
+    if isinstance(val, (int, np.integer)):
+        return int(val)
+    if isinstance(val, (float, np.floating)):
+        if np.isnan(val):
+            return None
+        if np.isinf(val):
+            return "inf" if val > 0 else "-inf"
+        return float(val)
+    if isinstance(val, decimal.Decimal):
+        return val
+    if isinstance(val, datetime.datetime):
+        cell = WriteOnlyCell(ws, value=val)
+        cell.number_format = DATETIME_FORMAT
+        return cell
+    if isinstance(val, datetime.date):
+        cell = WriteOnlyCell(ws, value=val)
+        cell.number_format = DATE_FORMAT
+        return cell
+    if isinstance(val, datetime.timedelta):
+        cell = WriteOnlyCell(ws, value=val.total_seconds() / 86400)
+        cell.number_format = "0"
+        return cell
+    return str(val)
+
+
+def _frame_rows(ws, df, chunk_rows=WRITE_CHUNK_ROWS):
+    """
+    Yields the rows of df as lists of Excel-ready values. Conversion runs
+    column by column over blocks of rows, so memory stays bounded by the
+    block size rather than the sheet.
+    """
+    for start in range(0, len(df), chunk_rows):
+        block = df.iloc[start:start + chunk_rows]
+        columns = [
+            [_excel_value(ws, val) for val in block[col].to_numpy(dtype=object)]
+            for col in block.columns
+        ]
+        for row in zip(*columns):
+            yield list(row)
+
+
+def write_mapped_workbook(output_filename, master_df, unmapped_data_list):
+    """
+    Writes the mapped master rows and the "Unmapped Raw Data" block in one
+    streaming pass (openpyxl write-only mode), so the output is serialized
+    once and never re-parsed. The workbook is written to a temp file and
+    renamed into place, so downloads never see a partial file.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(SHEET_NAME)
+
+    ws.append([_excel_value(ws, col) for col in master_df.columns])
+    for row in _frame_rows(ws, master_df):
+        ws.append(row)
+
+    if unmapped_data_list:
+        # Add a spacer, a title and a generic header
+        ws.append([])
+        ws.append([UNMAPPED_TITLE])
+        max_cols = unmapped_data_list.max_width
+        ws.append([f"Raw Column {i+1}" for i in range(max_cols)])
+
+        for row in unmapped_data_list:
+            # Ensure row has full width to avoid data shifting
+            ws.append(row + [None] * (max_cols - len(row)))
+
+    tmp_filename = f"{output_filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        wb.save(tmp_filename)
+        os.replace(tmp_filename, output_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def format_available(output_format):
+    return output_format in OUTPUT_FORMATS and (output_format != "parquet" or pyarrow is not None)
+
+
+def output_path(folder, output_format, part="mapped"):
+    """Path of the mapped (or unmapped) artifact in a given format."""
+    return os.path.join(folder, f"{part}.{output_format}")
+
+
+def unmapped_frame(unmapped_data_list):
+    """The unmapped raw rows (an UnmappedRows) as a frame with "Raw Column N" headers."""
+    return unmapped_data_list.to_frame([f"Raw Column {i+1}" for i in range(unmapped_data_list.max_width)])
+
+
+def _parquet_frame(df):
+    # Arrow needs one type per column; mixed object columns are written as text
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = [None if pd.isna(val) else str(val) for val in df[col]]
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+
+def write_table(output_filename, df, output_format):
+    """
+    Writes one frame as csv, ndjson or parquet (or a plain xlsx sheet),
+    block by block where the format allows it, via a temp file renamed
+    into place.
+    """
+    tmp_filename = f"{output_filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        if output_format == "csv":
+            df.to_csv(tmp_filename, index=False, chunksize=WRITE_CHUNK_ROWS)
+        elif output_format == "ndjson":
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                for start in range(0, len(df), WRITE_CHUNK_ROWS):
+                    block = df.iloc[start:start + WRITE_CHUNK_ROWS].to_json(
+                        orient="records", lines=True, date_format="iso", force_ascii=False
+                    )
+                    f.write(block if block.endswith("\n") else block + "\n")
+        elif output_format == "parquet":
+            _parquet_frame(df).to_parquet(tmp_filename, index=False, row_group_size=WRITE_CHUNK_ROWS)
+        elif output_format == "xlsx":
+            write_mapped_workbook(tmp_filename, df, [])
+        else:
+            raise ValueError(f"Unknown output format: {output_format}")
+        os.replace(tmp_filename, output_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def write_mapped_outputs(folder, master_df, unmapped_data_list, output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Writes the run's artifacts and returns (mapped path, unmapped path or
+    None). xlsx keeps the single workbook with the unmapped block appended;
+    the other formats put the unmapped rows in their own file.
+    """
+    mapped_path = output_path(folder, output_format)
+    if output_format == "xlsx":
+        write_mapped_workbook(mapped_path, master_df, unmapped_data_list)
+        return mapped_path, None
+
+    write_table(mapped_path, master_df, output_format)
+    unmapped_path = None
+    if unmapped_data_list:
+        unmapped_path = output_path(folder, output_format, "unmapped")
+        write_table(unmapped_path, unmapped_frame(unmapped_data_list), output_format)
+    return mapped_path, unmapped_path
+
+
+def save_mapped_result(path, master_df, unmapped_data_list):
+    """Keeps the run's frames so other formats can be produced on request."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"master": master_df, "unmapped": unmapped_data_list}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_mapped_result(result_path, folder, output_format, part="mapped"):
+    """
+    Produces one artifact of an earlier run in another format from its
+    saved frames (the lazy xlsx conversion) and returns its path. mapped
+    xlsx has the usual layout with the unmapped block appended.
+    """
+    with open(result_path, "rb") as f:
+        saved = pickle.load(f)
+    path = output_path(folder, output_format, part)
+    if part == "unmapped":
+        write_table(path, unmapped_frame(saved["unmapped"]), output_format)
+    elif output_format == "xlsx":
+        write_mapped_workbook(path, saved["master"], saved["unmapped"])
+    else:
+        write_table(path, saved["master"], output_format)
+    return path
@@ -0,0 +1,219 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+from flask import Request
+
+from config import MAX_FILE_SIZE, UPLOAD_CHUNK_SIZE, WORKSPACES_FOLDER
+from hashing import file_sha256
+
+# Resumable upload sessions live in a hidden folder of their workspace
+UPLOADS_SUBFOLDER = ".uploads"
+
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# upload id -> (offset, sha256 object) for sessions appended to by this
+# process, so consecutive chunks are hashed on the fly. Another worker
+# picking up a session re-hashes what is already on disk once.
+_running_hashes = {}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+def _copy_stream(stream, f, digest, written, max_size):
+    """Copies stream into f chunk by chunk. Returns the new byte count."""
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return written
+        written += len(chunk)
+        if written > max_size:
+            raise UploadTooLarge(f"File too large. Maximum size is {max_size / (1024*1024)}MB")
+        f.write(chunk)
+        digest.update(chunk)
+
+
+def stream_to_path(stream, dest_path, max_size=MAX_FILE_SIZE):
+    """
+    Writes a request body straight to dest_path, enforcing max_size and
+    hashing while it streams. The body goes to a temp file that is renamed
+    into place, and the rename is skipped when dest_path already has the
+    same content. Returns (size, sha256 hex digest).
+    """
+    digest = hashlib.sha256()
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            size = _copy_stream(stream, f, digest, 0, max_size)
+        content_hash = digest.hexdigest()
+        if not (os.path.exists(dest_path) and file_sha256(dest_path) == content_hash):
+            os.replace(tmp_path, dest_path)
+        return size, content_hash
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class UploadPart:
+    """
+    Where the form parser writes a multipart file part: a temp file next to
+    the workspaces (so it can be renamed into one), size-checked and hashed
+    as the part arrives instead of being spooled and copied afterwards.
+    Closing it removes the temp file unless place() moved it.
+    """
+
+    def __init__(self, folder=WORKSPACES_FOLDER, max_size=MAX_FILE_SIZE):
+        self.path = os.path.join(folder, f".{uuid.uuid4().hex}.upload.tmp")
+        self.size = 0
+        self.max_size = max_size
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, "w+b")
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadTooLarge(f"File too large. Maximum size is {self.max_size / (1024*1024)}MB")
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read, seek, tell, ... of the temp file
+        return getattr(self._file, name)
+
+    def place(self, dest_path):
+        """Renames the part to dest_path, unless dest_path already holds the same content."""
+        self._file.close()
+        if not (os.path.exists(dest_path) and file_sha256(dest_path) == self.sha256):
+            os.replace(self.path, dest_path)
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StreamedUploadRequest(Request):
+    """
+    Request whose multipart file parts are written as UploadParts (see
+    app.request_class). Parts not moved anywhere are removed when the
+    request is closed, including those of a body that failed to parse.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        part = UploadPart()
+        self.__dict__.setdefault("upload_parts", []).append(part)
+        return part
+
+    def close(self):
+        super().close()
+        for part in self.__dict__.get("upload_parts", ()):
+            part.close()
+
+
+def _session_paths(folder, upload_id):
+    base = os.path.join(folder, UPLOADS_SUBFOLDER, upload_id)
+    return f"{base}.json", f"{base}.part"
+
+
+def create_upload(folder, kind, filename, length=None):
+    """Starts a resumable upload session in a workspace and returns its id."""
+    if length is not None and length > MAX_FILE_SIZE:
+        raise UploadTooLarge(f"File too large. Maximum size is {MAX_FILE_SIZE / (1024*1024)}MB")
+    os.makedirs(os.path.join(folder, UPLOADS_SUBFOLDER), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path = _session_paths(folder, upload_id)
+    open(part_path, "wb").close()
+    with open(meta_path, "w") as f:
+        json.dump({"kind": kind, "filename": filename, "length": length, "created_at": time.time()}, f)
+    return upload_id
+
+
+def get_upload(folder, upload_id):
+    """Session metadata with its current offset, or None if it doesn't exist."""
+    if not _UPLOAD_ID_RE.match(upload_id or ""):
+        return None
+    meta_path, part_path = _session_paths(folder, upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["offset"] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    meta["upload_id"] = upload_id
+    return meta
+
+
+def _resume_hash(upload_id, part_file, offset):
+    cached = _running_hashes.get(upload_id)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    digest = hashlib.sha256()
+    part_file.seek(0)
+    for chunk in iter(lambda: part_file.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest
+
+
+def append_upload_chunk(folder, upload_id, offset, stream):
+    """
+    Appends a request body to a session at the given offset and returns the
+    new offset. The offset must equal what the server already has, so a
+    client that timed out asks for the offset and resends only the rest.
+    """
+    meta = get_upload(folder, upload_id)
+    _, part_path = _session_paths(folder, upload_id)
+    limit = min(meta["length"], MAX_FILE_SIZE) if meta.get("length") is not None else MAX_FILE_SIZE
+    with open(part_path, "r+b") as f:
+        # One writer per session at a time, across workers
+        fcntl.flock(f, fcntl.LOCK_EX)
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            raise UploadOffsetMismatch(current)
+        digest = _resume_hash(upload_id, f, current)
+        f.seek(current)
+        try:
+            new_offset = _copy_stream(stream, f, digest, current, limit)
+        except Exception:
+            # Drop the partial chunk so the session stays at a known offset
+            f.truncate(current)
+            _running_hashes.pop(upload_id, None)
+            raise
+        _running_hashes[upload_id] = (new_offset, digest)
+        return new_offset
+
+
+def complete_upload(folder, upload_id, dest_path):
+    """
+    Moves a finished session's data to dest_path (unless it already holds
+    the same content) and removes the session. Returns (size, sha256 hex).
+    """
+    meta = get_upload(folder, upload_id)
+    meta_path, part_path = _session_paths(folder, upload_id)
+    size = meta["offset"]
+    if meta.get("length") is not None and size != meta["length"]:
+        raise UploadOffsetMismatch(size)
+
+    cached = _running_hashes.pop(upload_id, None)
+    content_hash = cached[1].hexdigest() if cached and cached[0] == size else file_sha256(part_path)
+    if os.path.exists(dest_path) and file_sha256(dest_path) == content_hash:
+        os.remove(part_path)
+    else:
+        os.replace(part_path, dest_path)
+    os.remove(meta_path)
+    return size, content_hash
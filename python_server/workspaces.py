@@ -0,0 +1,115 @@
+import os
+import re
+import shutil
+import time
+import uuid
+
+from config import (
+    WORKSPACES_FOLDER, WORKSPACE_TTL_SECONDS, JANITOR_INTERVAL_SECONDS,
+    RAW_DATA_FILENAME, MASTER_FILE_FILENAME, MAPPED_FILE_FILENAME, INCREMENTAL_STATE_FILENAME,
+    MAPPED_RESULT_FILENAME, LEDGER_ROWS_FILENAME, MAPPED_SNAPSHOT_FILENAME, BATCH_FOLDER_NAME,
+)
+
+WORKSPACE_HEADER = "X-Workspace-Token"
+
+_TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+_SWEEP_MARKER = os.path.join(WORKSPACES_FOLDER, ".last_sweep")
+
+
+def is_valid_token(token):
+    return bool(_TOKEN_RE.match(token or ""))
+
+
+def workspace_dir(token):
+    return os.path.join(WORKSPACES_FOLDER, token)
+
+
+def workspace_paths(token):
+    """Input, output and saved-state file paths of a workspace."""
+    folder = workspace_dir(token)
+    return {
+        "folder": folder,
+        "raw": os.path.join(folder, RAW_DATA_FILENAME),
+        "master": os.path.join(folder, MASTER_FILE_FILENAME),
+        "mapped": os.path.join(folder, MAPPED_FILE_FILENAME),
+        "incremental_state": os.path.join(folder, INCREMENTAL_STATE_FILENAME),
+        "mapped_result": os.path.join(folder, MAPPED_RESULT_FILENAME),
+        "ledger_rows": os.path.join(folder, LEDGER_ROWS_FILENAME),
+        "snapshot": os.path.join(folder, MAPPED_SNAPSHOT_FILENAME),
+        "batch": os.path.join(folder, BATCH_FOLDER_NAME),
+    }
+
+
+def create_workspace():
+    """Creates a fresh workspace and returns its token."""
+    cleanup_expired_workspaces()
+    token = uuid.uuid4().hex
+    os.makedirs(workspace_dir(token), exist_ok=True)
+    return token
+
+
+def open_workspace(token):
+    """
+    Marks an existing workspace as recently used and returns its folder,
+    or None if the token is malformed, unknown or expired.
+    """
+    if not is_valid_token(token):
+        return None
+    folder = workspace_dir(token)
+    if not os.path.isdir(folder):
+        return None
+    os.utime(folder)
+    return folder
+
+
+def request_workspace_token(request):
+    """Workspace token sent with a request (header, form field or query string)."""
+    return request.headers.get(WORKSPACE_HEADER) or request.values.get("workspace")
+
+
+def save_atomically(file_storage, dest_path):
+    """
+    Saves an uploaded file next to its destination and renames it into
+    place, so readers never see a half-written file. A multipart part the
+    form parser already wrote to disk (uploads.UploadPart) is just renamed.
+    """
+    if hasattr(file_storage.stream, "place"):
+        file_storage.stream.place(dest_path)
+        return
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        file_storage.save(tmp_path)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cleanup_expired_workspaces(ttl=WORKSPACE_TTL_SECONDS, force=False):
+    """
+    Deletes workspaces that haven't been used for `ttl` seconds. Runs at
+    most once per JANITOR_INTERVAL_SECONDS across all workers (tracked with
+    a marker file) unless force is set. Returns the removed tokens.
+    """
+    now = time.time()
+    os.makedirs(WORKSPACES_FOLDER, exist_ok=True)
+    if not force and os.path.exists(_SWEEP_MARKER):
+        if now - os.path.getmtime(_SWEEP_MARKER) < JANITOR_INTERVAL_SECONDS:
+            return []
+    with open(_SWEEP_MARKER, "a"):
+        os.utime(_SWEEP_MARKER)
+
+    removed = []
+    for token in os.listdir(WORKSPACES_FOLDER):
+        folder = workspace_dir(token)
+        if not is_valid_token(token) or not os.path.isdir(folder):
+            continue
+        try:
+            if now - os.path.getmtime(folder) > ttl:
+                shutil.rmtree(folder)
+                removed.append(token)
+        except OSError as e:
+            print(f"Warning: Could not remove expired workspace {token}: {e}")
+    if removed:
+        print(f"Janitor removed {len(removed)} expired workspace(s)")
+    return removed